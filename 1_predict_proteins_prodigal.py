@@ -1,39 +1,81 @@
 #!/usr/bin/env python
 
-import os, sys, re, subprocess, shlex, argparse
+import os, sys, re, argparse
+from dnds_pipeline.jobs import run_measured, run_pool, print_status_table
+from dnds_pipeline.manifest import Manifest
+from dnds_pipeline.preflight import preflight, report
+from dnds_pipeline.telemetry import Telemetry
 
-def predict_proteins(input_dir,outfolder, quiet):
-	for i in os.listdir(input_dir):
-		if i.endswith(".fna"): 
+def prodigal_genome(fasta, prot, nucl, log_prefix, quiet, telemetry=None):
+	if quiet == 1:
+		cmd = "prodigal -i "+ fasta +" -a "+ prot +" -d "+ nucl
+	else:
+		cmd = "prodigal -i "+ fasta +" -a "+ prot +" -d "+ nucl + " -q"
+	print (cmd)
+	exit_code, usage = run_measured(cmd, log_prefix + ".prodigal.out", log_prefix + ".prodigal.err")
+	if telemetry is not None:
+		telemetry.tool(os.path.basename(log_prefix), "prodigal", exit_code, usage, cmd)
+	return exit_code
+
+def predict_proteins(input_dir,outfolder, quiet, jobs=1, force=False):
+	manifest = Manifest(outfolder, force)
+	telemetry = Telemetry(outfolder, "predict_proteins")
+	tasks = list()
+	signatures = dict()
+	for i in sorted(os.listdir(input_dir)):
+		if i.endswith(".fna") and not i.endswith(".genes.fna"): 
 			fasta = os.path.join(input_dir, i)
 			core = re.sub(".fna", "", i)
 
 			prot = os.path.join(outfolder, core+".faa")
 			nucl = os.path.join(outfolder, core+".genes.fna")
+			log_prefix = os.path.join(outfolder, core)
+
+			signature = manifest.signature([fasta], tools=["prodigal"])
+			if manifest.is_current("predict_proteins", core, signature, [prot, nucl]):
+				print("Proteins for", core, "are up to date, skipping.")
+				continue
+			signatures[core] = (signature, [prot, nucl], fasta)
+			tasks.append((core, prodigal_genome, (fasta, prot, nucl, log_prefix, quiet, telemetry)))
 
-			if quiet == 1:
-				cmd = "prodigal -i "+ fasta +" -a "+ prot +" -d "+ nucl
-			else:
-				cmd = "prodigal -i "+ fasta +" -a "+ prot +" -d "+ nucl + " -q"
-			print (cmd)
-			cmd2 = shlex.split(cmd)
-			subprocess.call(cmd2, stdout=open("prodigal_log.out", "w"), stderr=open("prodigal.err", "w"))
+	###Each genome gets its own log files, so genomes can run side by side
+	results = run_pool(tasks, jobs)
+	for core, exit_code in results:
+		if exit_code == 0:
+			manifest.record("predict_proteins", core, signatures[core][0], signatures[core][1])
+		telemetry.gene(core, exit_code, {"bytes": os.path.getsize(signatures[core][2])}, signatures[core][1])
+	failed = print_status_table(results, "Genome")
+	telemetry.finish(genomes=len(results), failed=len(failed))
+	if len(failed) > 0:
+		print("Prodigal failed for:", ", ".join(failed), "- check their .prodigal.err files.", file=sys.stderr)
 
 	print("DONE.")
+	return results
 
 def main(argv=None):
 	args_parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO:\nThis script will run Prodigal on a set of genome files. Make sure Prodigal is installed.\n\nIMPORTANT:\nYour input files must have an .fna extension.", epilog='*******************************************************************\n\n*******************************************************************\n\nMake sure you cite Prodigal and our book chapter!')
 	args_parser.add_argument('-i', '--input', required=True, help='Input folder where genome files are located with ".fna" extension.')
 	args_parser.add_argument('-o', '--output', required=True, help='Output folder where your output files will go.We suggest you use the same folder as your input to keep your files more organized.')
 	args_parser.add_argument('-q', '--quiet', required=False, default=int(1), help='Run Prodigal quietly? yes? use 0, no? use 1. Default is 1.')
+	args_parser.add_argument('-j', '--jobs', required=False, default=int(1), help='Number of genomes to run through Prodigal at the same time. Default is 1.')
+	args_parser.add_argument('--force', required=False, action='store_true', help='Run Prodigal on every genome, even those whose outputs are up to date.')
+	args_parser.add_argument('--no_check', required=False, action='store_true', help='Skip the pre-flight check that Prodigal is on PATH (see dnds-pipeline check).')
 	args_parser = args_parser.parse_args()
 
 	#Setting up parameters
 	input_dir = args_parser.input
 	outfolder = args_parser.output
 	quiet = int(args_parser.quiet)
+	jobs = int(args_parser.jobs)
+	force = args_parser.force
+
+	#Checking the tools before any genome starts
+	if not args_parser.no_check:
+		problems = report(preflight(None, stages=["predict_proteins"]))
+		if problems > 0:
+			sys.exit('Error: the pre-flight check found ' + str(problems) + ' problem(s), nothing was run.')
 	
-	predict_proteins(input_dir,outfolder, quiet)
+	predict_proteins(input_dir,outfolder, quiet, jobs, force)
 
 if __name__ == '__main__':
 	status = main()
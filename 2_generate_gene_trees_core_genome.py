@@ -1,102 +1,134 @@
 #!/usr/bin/env python
 
-import os, sys, subprocess, shlex, argparse
-from collections import defaultdict
+import os, sys, argparse
 from Bio import SeqIO
-from Bio import Phylo
-
-def gene_trees(core_genome, genome_folder, ingroup_branch, quiet):
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from dnds_pipeline.compression import open_text
+from dnds_pipeline.core_set import CoreSet
+from dnds_pipeline.layout import Layout, LAYOUTS
+from dnds_pipeline.manifest import Manifest
+from dnds_pipeline.options import parse_shard
+from dnds_pipeline.preflight import preflight, report
+from dnds_pipeline.scheduler import Job, run_jobs, split_cores, chain_status, report_failures
+from dnds_pipeline.seqindex import GeneIndex
+from dnds_pipeline.shards import folder_shard
+from dnds_pipeline.telemetry import Telemetry, measure_call
+from dnds_pipeline.trees import gene_tree, read_species_tree, species_gene_tree
+
+def gene_trees(core_genome, genome_folder, ingroup_branch, quiet, threads=1, force=False, core_set=None, codon_trees=False, shard=None, species_tree=None, layout=None):
+	manifest = Manifest(core_genome, force, shard)
+	telemetry = Telemetry(core_genome, "gene_trees", shard)
 	###Getting a nucleotide file for each core gene
-	aminoacid_seqs = defaultdict(list)
-	protein2genome = dict()
-	for file in os.listdir(core_genome):
-		if file.endswith(".faa"):
-			file_path = os.path.join(core_genome, file)
-			core_gene = file.replace(".faa","")
-
-			for record in SeqIO.parse(file_path, "fasta"):
-				seq_name = str(record.id).split("&")
-				protein_name = seq_name[1]
-				aminoacid_seqs[core_gene].append(protein_name)
-				genome_name = seq_name[0].replace(".faa","")
-				protein2genome[protein_name] = genome_name
+	if core_set is None:
+		core_set = CoreSet(core_genome)
+	#The layout of the per-gene files, and the index of core genes the later stages look them up with
+	layout = Layout(core_genome, layout)
+	layout.save(core_set.genes())
+	protein2genome = core_set.protein2genome
+	#With a shard, only its share of the core genes, balanced by the size of their protein files
+	selected = folder_shard(core_genome, shard)
+	genes = [gene for gene in core_set.genes() if selected is None or gene in selected]
+	aminoacid_seqs = dict((gene, core_set.proteins[gene]) for gene in genes)
 
 	###Finding nuc sequences that are part of the core genome
-	all_genomes_seqs = dict()
-	for file in os.listdir(genome_folder):
-		if file.endswith(".genes.fna"):
-			file_path = os.path.join(genome_folder, file)
-			
-			for record in SeqIO.parse(file_path, "fasta"):
-				seq_name = str(record.id)
-				all_genomes_seqs[seq_name] = record
+	#Sequences are read straight from the Prodigal .genes.fna files through a .fai index,
+	#so only the core genes are ever held in memory
+	gene_index = GeneIndex(genome_folder)
 
 	###Linking core gene and nucleotide sequences
+	gene_sizes = dict()
+	gene_taxa = dict()
 	for key, value in aminoacid_seqs.items():
 		core_seqs = list()
-		output = os.path.join(core_genome, key + ".fna")
+		output = layout.path(key, ".fna")
 		for i in value:
 			genome_name = protein2genome[i]
-			i_seq = all_genomes_seqs[i]
-			i_seq.id = genome_name
-			i_seq.description = ""
+			i_seq = SeqRecord(Seq(gene_index.fetch(genome_name, i)), id=genome_name, description="")
 			core_seqs.append(i_seq)
-		SeqIO.write(core_seqs, output, "fasta")
+		with open_text(output, "w") as handle:
+			SeqIO.write(core_seqs, handle, "fasta")
+		gene_sizes[key] = {"taxa": len(core_seqs), "codons": max(len(i_seq) for i_seq in core_seqs) // 3}
+		gene_taxa[key] = [i_seq.id for i_seq in core_seqs]
 		print("Nucleotide sequences for core gene", key, "are ready!")
 
-	###Getting nucleotide alignments
-	for file in os.listdir(core_genome):
-		if file.endswith(".fna"):
-			file_path = os.path.join(core_genome, file)
-			output = file_path.replace(".fna",".fna.aln")
-			
-			if quiet == 1:
-				cmd = "mafft --auto "+ file_path 
-			else:
-				cmd = "mafft --auto --quiet "+ file_path 
-			cmd2 = shlex.split(cmd)
-			print("Running alignment: ",cmd)
-			subprocess.call(cmd2, stdout=open(output, "w"), stderr=open("mafft_log.txt", "w"))
-
-	###Getting gene trees from our freshly made nucleotide alignments :D
-	for file in os.listdir(core_genome):
-		if file.endswith(".fna.aln"):
-			family_name = file.replace(".fna.aln","")
-			input_aln = os.path.join(core_genome, file)
-			output_tree = input_aln.replace(".fna.aln", ".fasttree")
-
-			cmd = "fasttree -nt "+ input_aln 
-			cmd2 = shlex.split(cmd)
-			print("Running your tree with FastTree --> ",cmd)
-			subprocess.call(cmd2, stdout=open(output_tree, "w"), stderr=open("fasttree_log.txt", "a"))
-
-			print("Modifying your tree to have it ready for CODEML...")
-
-			treefile = Phylo.read(output_tree, "newick")
-			output_tree_mod = input_aln.replace(".fna.aln", ".temporary")
-			output_tree_nwk = open(input_aln.replace(".fna.aln", ".nwk"), "w")
-
-			total_tips = 0
-			for tip in treefile.get_terminals():
-				total_tips = total_tips + 1
-				if str(tip.name) == ingroup_branch:
-					tip.name = ingroup_branch + " #1"
-				else:
-					pass
-
-			Phylo.write(treefile, output_tree_mod, "newick")
-
-			output_tree_nwk.write(str(total_tips)+"  1\n")
-			with open(output_tree_mod) as temporary:
-				for line in temporary:
-					line = line.rstrip()
-					line = line.replace("'","")
-					output_tree_nwk.write(line +"\n")		
-			temporary.close()
-			output_tree_nwk.close()
-
-			os.remove(output_tree_mod)
-			print("Your output tree for CODEML is", family_name+ ".nwk")
+	if species_tree is not None:
+		pruned_trees(layout, species_tree, gene_taxa, gene_sizes, ingroup_branch, manifest, telemetry)
+		return
+
+	if codon_trees:
+		print("Gene trees will be built from the codon alignments by 3_create_codon_alignments.py.")
+		telemetry.finish(genes=len(aminoacid_seqs), codon_trees=True)
+		return
+
+	###Getting nucleotide alignments and gene trees
+	#Each core gene is a MAFFT -> FastTree chain, and a gene's tree starts as soon as its own alignment is done
+	queued = list()
+	for key in sorted(aminoacid_seqs.keys()):
+		file_path = layout.path(key, ".fna")
+		outputs = [layout.path(key, ".fna.aln"), layout.path(key, ".fasttree"), layout.path(key, ".nwk")]
+		signature = manifest.signature([file_path], {"ingroup_branch": ingroup_branch}, ["mafft", "fasttree"])
+		if manifest.is_current("gene_trees", key, signature, outputs):
+			print("Alignment and tree for core gene", key, "are up to date, skipping.")
+			continue
+		queued.append((key, file_path, outputs, signature))
+
+	#The cores are shared between the genes that actually run
+	mafft_threads = split_cores(len(queued), threads)
+
+	jobs = list()
+	chains = dict()
+	for key, file_path, outputs, signature in queued:
+		output = outputs[0]
+		log_dir = layout.log_dir(key)
+		if quiet == 1:
+			cmd = "mafft --auto "+ file_path 
+		else:
+			cmd = "mafft --auto --quiet "+ file_path 
+		if mafft_threads > 1:
+			cmd = cmd.replace("mafft --auto", "mafft --auto --thread " + str(mafft_threads))
+		align = Job(key + " alignment", cmd=cmd, stdout=output, stderr=os.path.join(log_dir, key + ".mafft.log"), threads=mafft_threads, telemetry=telemetry, key=key)
+		tree = Job(key + " tree", function=gene_tree, args=(output, layout.path(key, ""), ingroup_branch, log_dir, telemetry), deps=[align])
+		done = Job(key + " manifest", function=manifest.record, args=("gene_trees", key, signature, outputs), deps=[tree])
+		jobs.extend([align, tree, done])
+		chains[key] = ([align, tree], outputs)
+
+	results = run_jobs(jobs, threads)
+	failed = 0
+	for key, (chain, outputs) in chains.items():
+		exit_code = chain_status(results, chain)
+		if exit_code != 0:
+			failed += 1
+		telemetry.gene(key, exit_code, gene_sizes.get(key), outputs)
+	report_failures(results, "Alignment/tree jobs")
+	telemetry.finish(genes=len(chains), failed=failed)
+
+
+def pruned_trees(layout, species_tree, gene_taxa, gene_sizes, ingroup_branch, manifest, telemetry):
+	###Pruning one species tree to the taxa of each core gene, instead of a MAFFT -> FastTree chain per gene
+	#The species tree is read once, and every gene's CODEML tree is written straight from it
+	try:
+		reference = read_species_tree(species_tree)
+	except Exception as error:
+		sys.exit('Error: cannot read the species tree ' + species_tree + ': ' + str(error))
+	failed = 0
+	for key in sorted(gene_taxa.keys()):
+		outputs = [layout.path(key, ".nwk")]
+		signature = manifest.signature([species_tree, layout.path(key, ".fna")], {"ingroup_branch": ingroup_branch, "species_tree": True})
+		if manifest.is_current("gene_trees", key, signature, outputs):
+			print("Tree for core gene", key, "is up to date, skipping.")
+			continue
+		exit_code, usage = measure_call(species_gene_tree, reference, gene_taxa[key], layout.path(key, ""), ingroup_branch)
+		telemetry.tool(key, key + " species tree", exit_code, usage)
+		if exit_code == 0:
+			manifest.record("gene_trees", key, signature, outputs)
+			print("Your output tree for CODEML is", key + ".nwk")
+		else:
+			failed += 1
+		telemetry.gene(key, exit_code, gene_sizes.get(key), outputs)
+	if failed > 0:
+		print(failed, "core genes have taxa that are not in the species tree, no tree was written for them.", file=sys.stderr)
+	telemetry.finish(genes=len(gene_taxa), failed=failed, species_tree=species_tree)
 
 
 def main(argv=None):
@@ -105,6 +137,13 @@ def main(argv=None):
 	args_parser.add_argument('-g', '--genomes', required=True, help='Folder where genome files (.fna) and Prodigal output files are located.')
 	args_parser.add_argument('-ib', '--ingroup_branch', required=True, help='What is your ingroup branch? Make sure you write the name of the branch exactly as it appears in your tree, including special characters.')	
 	args_parser.add_argument('-q', '--quiet', required=False, default=int(1), help='Run MAFFT quietly? yes? use 0, no? use 1. Default is 1.')
+	args_parser.add_argument('-t', '--threads', required=False, default=int(1), help='Total number of cores that MAFFT and FastTree jobs can use at the same time. Default is 1.')
+	args_parser.add_argument('--codon_trees', required=False, action='store_true', help='Only write the nucleotide file of each core gene, and build the gene trees from the codon alignments in step 3 instead (run it with --codon_trees too). Saves one MAFFT run per gene.')
+	args_parser.add_argument('--species_tree', required=False, help='Use this species tree (Newick, tips named after the genomes) for every core gene instead of building a gene tree: it is pruned to the taxa of each gene and the ingroup branch is labelled. No MAFFT or FastTree is run.')
+	args_parser.add_argument('--layout', required=False, choices=LAYOUTS, help='Where to write the per-gene files: flat (all in the core folder) or genes (one folder per gene under <core>/genes/, for large core genomes). The later steps use the same layout. Default is the layout of the previous run, or flat.')
+	args_parser.add_argument('--shard', required=False, type=parse_shard, help='Only process one share of the core genes, given as INDEX/COUNT (e.g., --shard 2/8 for the second of eight array tasks). Shares are balanced by gene size and are the same on every node.')
+	args_parser.add_argument('--force', required=False, action='store_true', help='Redo the alignment and tree of every core gene, even those that are up to date.')
+	args_parser.add_argument('--no_check', required=False, action='store_true', help='Skip the pre-flight check of the core genes, their CDS, the ingroup branch and the tools (see dnds-pipeline check).')
 	args_parser = args_parser.parse_args()
 
 	#Setting up parameters
@@ -112,8 +151,22 @@ def main(argv=None):
 	genome_folder = args_parser.genomes
 	ingroup_branch = str(args_parser.ingroup_branch)
 	quiet = int(args_parser.quiet)
+	threads = int(args_parser.threads)
+	force = args_parser.force
+	codon_trees = args_parser.codon_trees
+	shard = args_parser.shard
+	species_tree = args_parser.species_tree
+	layout = args_parser.layout
+	if codon_trees and species_tree is not None:
+		sys.exit('Error: use either --codon_trees or --species_tree.')
+
+	#Checking every input before any alignment starts
+	if not args_parser.no_check:
+		problems = report(preflight(core_genome, genome_folder, ingroup_branch, ["gene_trees"], codon_trees, species_tree))
+		if problems > 0:
+			sys.exit('Error: the pre-flight check found ' + str(problems) + ' problem(s), nothing was run.')
 	
-	gene_trees(core_genome, genome_folder, ingroup_branch, quiet)
+	gene_trees(core_genome, genome_folder, ingroup_branch, quiet, threads, force, None, codon_trees, shard, species_tree, layout)
 
 if __name__ == '__main__':
 	status = main()
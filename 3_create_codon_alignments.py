@@ -1,72 +1,141 @@
 #!/usr/bin/env python
 
-import os, sys, subprocess, shlex, argparse
-from collections import defaultdict
+import os, sys, argparse
 from Bio import SeqIO
+from dnds_pipeline.compression import open_text
+from dnds_pipeline.core_set import CoreSet
+from dnds_pipeline.layout import Layout, LAYOUTS
+from dnds_pipeline.manifest import Manifest
+from dnds_pipeline.options import parse_shard
+from dnds_pipeline.preflight import preflight, report
+from dnds_pipeline.backtranslate import align_codons
+from dnds_pipeline.paml_io import alignment_size, write_paml, write_fasta
+from dnds_pipeline.scheduler import Job, run_jobs, split_cores, chain_status, report_failures
+from dnds_pipeline.shards import folder_shard
+from dnds_pipeline.telemetry import Telemetry
+from dnds_pipeline.trees import gene_tree
 
-def codon_alignment(core_genome, quiet):
-	core2genome = dict()
-	core2seqs = defaultdict(list)
-	###Getting amino acid alignments
-	for file in os.listdir(core_genome):
-		if file.endswith(".faa"):
-			core_gene = file.replace(".faa","")
-			file_path = os.path.join(core_genome, file)
-			output = file_path.replace(".faa",".aln")
+def codon_alignment(core_genome, quiet, threads=1, force=False, core_set=None, ingroup_branch=None, codon_trees=False, shard=None, layout=None):
+	if codon_trees and ingroup_branch is None:
+		sys.exit('Error: the ingroup branch (-ib) is needed to build gene trees from the codon alignments.')
+	manifest = Manifest(core_genome, force, shard)
+	telemetry = Telemetry(core_genome, "codon_alignment", shard)
+	if core_set is None:
+		core_set = CoreSet(core_genome)
+	layout = Layout(core_genome, layout)
+	layout.save(core_set.genes())
+	#With a shard, only its share of the core genes, balanced by the size of their protein files
+	selected = folder_shard(core_genome, shard)
+	genes = [gene for gene in core_set.genes() if selected is None or gene in selected]
+	core2seqs = dict((gene, core_set.proteins[gene]) for gene in genes)
 
-			for record in SeqIO.parse(file_path, "fasta"):
-				seq_name = str(record.id).split("&")
-				protein_name = seq_name[1]
-				genome_name = seq_name[0].replace(".faa", "")
-				core2genome[protein_name] = genome_name
-				core2seqs[core_gene].append(protein_name)
-				
-			if quiet == 1:
-				cmd = "mafft --auto "+ file_path 
-			else:
-				cmd = "mafft --auto --quiet "+ file_path 
-			cmd2 = shlex.split(cmd)
-			print("Running: ",cmd)
-			subprocess.call(cmd2, stdout=open(output, "w"), stderr=open("mafft_log.txt", "w"))
+	###Getting amino acid alignments, then codon alignments
+	#Each core gene is a MAFFT -> back-translation chain, so the back-translation starts as soon as the gene's own alignment is done
+	queued = list()
+	for core_gene in sorted(core2seqs.keys()):
+		file_path = layout.path(core_gene, ".faa")
+		genes_seq = layout.path(core_gene, ".fna")
+		outputs = [layout.path(core_gene, ".faa.aln"), layout.path(core_gene, ".pal2nal")]
+		tools = ["mafft"]
+		params = {"back_translation": "nogap"}
+		if codon_trees:
+			outputs.extend([layout.path(core_gene, ".codon.aln"), layout.path(core_gene, ".fasttree"), layout.path(core_gene, ".nwk")])
+			tools.append("fasttree")
+			params["ingroup_branch"] = ingroup_branch
 
-	for file in os.listdir(core_genome):
-		if file.endswith(".aln") and ".faa.aln" not in file and ".fna.aln" not in file:
-			file_path = os.path.join(core_genome, file)
-			output = file_path.replace(".aln",".faa.aln")
+		signature = manifest.signature([file_path, genes_seq], params, tools)
+		if manifest.is_current("codon_alignment", core_gene, signature, outputs):
+			print("Codon alignment for core gene", core_gene, "is up to date, skipping.")
+			continue
+		queued.append((core_gene, file_path, genes_seq, outputs, signature))
 
-			all_seqs = list()
-			for record in SeqIO.parse(file_path, "fasta"):
-				name = str(record.id).split("&")
-				genome_name = name [0].replace(".faa","")
-				record.id = genome_name
-				record.description = ""
-				all_seqs.append(record)
-			SeqIO.write(all_seqs, output, "fasta")
-			os.remove(file_path)
+	#The cores are shared between the genes that actually run
+	mafft_threads = split_cores(len(queued), threads)
 
-	###Getting codon alignments with PAL2NAL
-	for file in os.listdir(core_genome):
-		if file.endswith(".faa.aln"):
-			input_alignment = os.path.join(core_genome, file)
-			genes_seq = input_alignment.replace(".faa.aln",".fna")
-			output_pal2nal = input_alignment.replace(".faa.aln",".pal2nal")
+	jobs = list()
+	chains = dict()
+	for core_gene, file_path, genes_seq, outputs, signature in queued:
+		output, output_pal2nal = outputs[:2]
+		codon_fasta = outputs[2] if codon_trees else None
+		log_dir = layout.log_dir(core_gene)
+		if quiet == 1:
+			cmd = "mafft --auto "+ file_path 
+		else:
+			cmd = "mafft --auto --quiet "+ file_path 
+		if mafft_threads > 1:
+			cmd = cmd.replace("mafft --auto", "mafft --auto --thread " + str(mafft_threads))
+		align = Job(core_gene + " alignment", cmd=cmd, stdout=output, stderr=os.path.join(log_dir, core_gene + ".mafft.log"), threads=mafft_threads, telemetry=telemetry, key=core_gene)
+		codons = Job(core_gene + " codons", function=write_codon_alignment, args=(output, genes_seq, output_pal2nal, codon_fasta), deps=[align], telemetry=telemetry, key=core_gene)
+		chain = [align, codons]
+		if codon_trees:
+			#The gene tree comes from the same codon alignment that codeml analyzes
+			tree = Job(core_gene + " tree", function=gene_tree, args=(codon_fasta, layout.path(core_gene, ""), ingroup_branch, log_dir, telemetry), deps=[codons])
+			chain.append(tree)
+		jobs.extend(chain)
+		jobs.append(Job(core_gene + " manifest", function=manifest.record, args=("codon_alignment", core_gene, signature, outputs), deps=chain[-1:]))
+		chains[core_gene] = (chain, outputs)
 
-			cmd = "pal2nal.pl " + input_alignment + " " + genes_seq + " -output paml -nogap"
-			print ("Running: ",cmd)
-			cmd2 = shlex.split(cmd)
-			subprocess.call(cmd2, stdout = open(output_pal2nal, "w"), stderr = open("pal2nal_log.txt", "w"))
+	results = run_jobs(jobs, threads)
+	failed = 0
+	for core_gene, (chain, outputs) in chains.items():
+		exit_code = chain_status(results, chain)
+		if exit_code == 0:
+			taxa, codons = alignment_size(outputs[1])
+			inputs = {"taxa": taxa, "codons": codons}
+		else:
+			inputs = {"taxa": len(core2seqs[core_gene])}
+			failed += 1
+		telemetry.gene(core_gene, exit_code, inputs, outputs)
+	report_failures(results, "Alignment/codon alignment jobs")
+	telemetry.finish(genes=len(chains), failed=failed)
+
+def write_codon_alignment(protein_alignment, genes_seq, output_pal2nal, codon_fasta=None):
+	###Back-translating the MAFFT alignment, PAL2NAL style (-output paml -nogap)
+	#Records are named after their genome (G0.faa&G0_c_1 -> G0) in both files
+	proteins = list()
+	with open_text(protein_alignment) as handle:
+		for record in SeqIO.parse(handle, "fasta"):
+			proteins.append((str(record.id).split("&")[0].replace(".faa",""), str(record.seq)))
+	cds = dict()
+	with open_text(genes_seq) as handle:
+		for record in SeqIO.parse(handle, "fasta"):
+			cds[str(record.id).split("&")[0].replace(".faa","")] = str(record.seq)
+
+	codons = align_codons(proteins, cds)
+	write_paml(codons, output_pal2nal)
+	if codon_fasta is not None:
+		write_fasta(codons, codon_fasta)
 
 def main(argv=None):
-	args_parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO:\nThis script will build individual codon core-genome alignments with the extension .pal2nal. Make sure you have MAFFT and PAL2NAL installed.", epilog='*******************************************************************\n\n*******************************************************************\n\nMake sure you cite MAFFT, PAL2NAL, and our book chapter!')
+	args_parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO:\nThis script will build individual codon core-genome alignments with the extension .pal2nal. Make sure you have MAFFT installed. Proteins are back-translated to codons the way PAL2NAL does with -output paml -nogap.", epilog='*******************************************************************\n\n*******************************************************************\n\nMake sure you cite MAFFT, PAL2NAL, and our book chapter!')
 	args_parser.add_argument('-c', '--core', required=True, help='Input folder where core genome files are located/Corecruncher output files. Your output files will be located here!')
 	args_parser.add_argument('-q', '--quiet', required=False, default=int(1), help='Run MAFFT quietly? yes? use 0, no? use 1. Default is 1.')
+	args_parser.add_argument('-t', '--threads', required=False, default=int(1), help='Total number of cores that MAFFT and back-translation jobs can use at the same time. Default is 1.')
+	args_parser.add_argument('--codon_trees', required=False, action='store_true', help='Also build each gene tree (.nwk) from its codon alignment, for runs where step 2 was run with --codon_trees. Needs -ib.')
+	args_parser.add_argument('-ib', '--ingroup_branch', required=False, help='What is your ingroup branch? Only needed with --codon_trees. Make sure you write the name of the branch exactly as it appears in your tree, including special characters.')
+	args_parser.add_argument('--layout', required=False, choices=LAYOUTS, help='Where the per-gene files are: flat (all in the core folder) or genes (one folder per gene under <core>/genes/). Default is the layout step 2 used.')
+	args_parser.add_argument('--shard', required=False, type=parse_shard, help='Only process one share of the core genes, given as INDEX/COUNT (e.g., --shard 2/8). Use the same COUNT as in step 2, so each node finds its own genes.')
+	args_parser.add_argument('--force', required=False, action='store_true', help='Redo the codon alignment of every core gene, even those that are up to date.')
+	args_parser.add_argument('--no_check', required=False, action='store_true', help='Skip the pre-flight check of the core genes, their CDS in the .fna files, the ingroup branch and the tools (see dnds-pipeline check).')
 	args_parser = args_parser.parse_args()
 
 	#Setting up parameters
 	core_genome = args_parser.core
 	quiet = int(args_parser.quiet)
+	threads = int(args_parser.threads)
+	force = args_parser.force
+	codon_trees = args_parser.codon_trees
+	ingroup_branch = args_parser.ingroup_branch
+	shard = args_parser.shard
+	layout = args_parser.layout
+
+	#Checking every input before any alignment starts
+	if not args_parser.no_check:
+		problems = report(preflight(core_genome, None, ingroup_branch, ["codon_alignment"], codon_trees, None, shard, layout))
+		if problems > 0:
+			sys.exit('Error: the pre-flight check found ' + str(problems) + ' problem(s), nothing was run.')
 	
-	codon_alignment(core_genome, quiet)
+	codon_alignment(core_genome, quiet, threads, force, None, ingroup_branch, codon_trees, shard, layout)
 
 if __name__ == '__main__':
 	status = main()
@@ -1,67 +1,265 @@
 #!/usr/bin/env python
 
-import os, sys, re, argparse
-from Bio.Phylo.PAML import codeml
-
-def run_codeml(input_dir, extension, model, nssites, clean, rubbish):
-	for file in os.listdir(input_dir):
-		if file.endswith(".pal2nal"):
-			alignment = os.path.join(input_dir,file)
-			tree = alignment.replace(".pal2nal", ".nwk")
-			codeml_output = re.sub(".pal2nal", extension, alignment)
-			core_gene = file.replace(".pal2nal","")
-			print("Your input files are: ", alignment, "and", tree)
-			
-			#Let's run codeml!
-			print("Running codeml for core gene:", core_gene)
-			cml = codeml.Codeml()
-			cml.alignment = alignment
-			cml.tree = tree
-			cml.out_file = codeml_output
-			cml.working_dir = input_dir
-
-	 		#Setting options
-			cml.set_options(noisy=rubbish) #Limited information on screen 
-			cml.set_options(verbose=1) #Details of output file
-			cml.set_options(seqtype=1) #Analysis on codons
-			cml.set_options(ndata = 1) #Number of alignments
-			cml.set_options(icode = 0) #Universal genetic code
-			cml.set_options(cleandata=clean) #Remove positions with ambiguous data (might be bad if too many positions are)		
-			cml.set_options(runmode=0) #Analysis will use tree topology 
-			cml.set_options(model = model) #Compute an omega value for each branch		
-			cml.set_options(NSsites = nssites)#One omega for all sites
-			cml.set_options(CodonFreq=1) #Mutation-selection model with observed codon frequencies used as estimates. This model accounts for the mutational bias and selection affecting codon usage,
-			cml.set_options(clock=0) #Clock assumption is not used (unrooted phylogeny must be used)
-			cml.set_options(fix_omega=0)#Estimate omega (not used for seqtype 1)
-			cml.set_options(omega=0.5)#Starting omega value (not used for seqtype 1)
-
-			cml.print_options()#Print the options on the screen
-
-
-			result = cml.run(verbose=True)
-			print("Omega for core gene", core_gene, "succesfully calculated.")
+import os, sys, argparse, sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dnds_pipeline.alignment_qc import TRIMMED, assess, profile_alignments, write_report
+from dnds_pipeline.codeml_parser import parse_codeml
+from dnds_pipeline.codeml_runner import run_gene
+from dnds_pipeline.cost_model import CostModel, makespan
+from dnds_pipeline.layout import Layout
+from dnds_pipeline.manifest import Manifest
+from dnds_pipeline.options import parse_hypothesis, parse_shard, quality_thresholds
+from dnds_pipeline.paml_io import alignment_size
+from dnds_pipeline.preflight import preflight, report
+from dnds_pipeline.results_db import ResultsStore
+from dnds_pipeline.shards import folder_shard, shard_suffix
+from dnds_pipeline.telemetry import Telemetry, read_events, telemetry_files
+
+def run_codeml(input_dir, extension, model, nssites, clean, rubbish, force=False, jobs=1, tmp_dir=None, hypotheses=None, warm_start=True, shard=None, plan=False, qc=None, compress=False, timeout_factor=None, min_timeout=60, retries=0, starts=1, wal=False):
+	#Each hypothesis is a (model, NSsites, extension) to fit, from the simplest to the most complex
+	if hypotheses is None:
+		hypotheses = [(model, nssites, extension)]
+
+	manifest = Manifest(input_dir, force, shard)
+	telemetry = Telemetry(input_dir, "run_codeml", shard)
+	#With a shard, only its share of the core genes (the same share as in steps 2 and 3)
+	selected = folder_shard(input_dir, shard, ".pal2nal")
+	#The codon alignments are looked up through the layout of the core folder (flat, or one folder per gene)
+	layout = Layout(input_dir)
+	alignments = dict((core_gene, path) for core_gene, path in layout.files(".pal2nal").items() if selected is None or core_gene in selected)
+
+	#Alignment quality pre-filter: every alignment is profiled before any codeml starts
+	passed = None
+	if qc is not None:
+		passed = quality_filter(input_dir, alignments, qc, jobs, telemetry, shard)
+
+	#Predicted codeml seconds, calibrated with the timings of previous runs in this folder
+	cost_model = CostModel()
+	if len(telemetry_files(input_dir)) > 0:
+		cost_model.calibrate(read_events(input_dir))
+	#Uncalibrated predictions are far too short to be time limits
+	if timeout_factor is not None and cost_model.samples == 0:
+		print("Warning: no codeml timings from a previous run in the telemetry of " + input_dir + ", so codeml runs get no time limit (--timeout_factor is ignored).", file=sys.stderr)
+		timeout_factor = None
+
+	tasks = list()
+	costs = dict()
+	limits = dict()
+	sizes = dict()
+	signatures = dict()
+	for core_gene, alignment in sorted(alignments.items()):
+		if passed is not None and core_gene not in passed:
+			continue
+		tree = layout.path(core_gene, ".nwk")
+		#A trimmed alignment replaces the original one
+		if passed is not None:
+			alignment = passed[core_gene]
+		print("Your input files are: ", alignment, "and", tree)
+		taxa, codons = alignment_size(alignment)
+		sizes[core_gene] = (taxa, codons)
+
+		gene_hypotheses = list()
+		timeouts = None if timeout_factor is None else dict()
+		for model, nssites, extension in hypotheses:
+			codeml_output = layout.path(core_gene, extension)
+			signature = manifest.signature([alignment, tree], {"model": str(model), "NSsites": str(nssites), "cleandata": str(clean)}, ["codeml"])
+			up_to_date = manifest.is_current("run_codeml", core_gene + extension, signature, [codeml_output])
+			if up_to_date:
+				print("Omega for core gene", core_gene, "with model", model, "and NSsites", nssites, "is up to date, skipping.")
+			signatures[codeml_output] = (core_gene, extension, signature, model, nssites, taxa, codons)
+			gene_hypotheses.append((model, nssites, codeml_output, up_to_date))
+			#Time limit of each codeml run, scaled by the predicted time of the model for this alignment
+			if timeouts is not None and not up_to_date:
+				timeouts[codeml_output] = max(min_timeout, timeout_factor * cost_model.predict(taxa, codons, model, nssites))
+
+		if not all(hypothesis[3] for hypothesis in gene_hypotheses):
+			tasks.append((core_gene, alignment, tree, gene_hypotheses, clean, rubbish, tmp_dir, warm_start, compress, timeouts, retries, starts))
+			costs[core_gene] = sum(cost_model.predict(taxa, codons, model, nssites) for model, nssites, codeml_output, up_to_date in gene_hypotheses if not up_to_date)
+			#With time limits, no gene can take longer than every model timing out on every retry (each retry doubles the limit)
+			if timeouts is not None:
+				limits[core_gene] = sum(timeouts.values()) * (2 ** (retries + 1) - 1)
+
+	#Longest genes first, so no big gene is left to run on its own at the end of the batch
+	tasks.sort(key=lambda task: (-costs[task[0]], task[0]))
+	if plan:
+		print_plan(tasks, costs, sizes, jobs, cost_model, limits)
+		return list()
 
+	#Let's run codeml!
+	#Every gene runs in its own scratch directory, so several genes can run at the same time
+	#Each gene's results go to the SQLite results store as soon as it is done
+	#The store is only a cache of the outputs: if it can not be written, the run goes on without it
+	#Timeouts and retries of every run are counted here, and recorded one by one in the telemetry
+	try:
+		store = ResultsStore(input_dir, shard, wal)
+	except sqlite3.Error as error:
+		print("Warning: the results database can not be opened (" + str(error) + "), results are not stored.", file=sys.stderr)
+		store = None
+	results = list()
+	watchdog = {"timeouts": 0, "retries": 0}
+	try:
+		if jobs > 1:
+			with ProcessPoolExecutor(max_workers=jobs) as pool:
+				futures = [pool.submit(run_gene, *task) for task in tasks]
+				for future in as_completed(futures):
+					results.extend(codeml_done(manifest, telemetry, store, signatures, future.result(), watchdog))
+		else:
+			for task in tasks:
+				results.extend(codeml_done(manifest, telemetry, store, signatures, run_gene(*task), watchdog))
+	finally:
+		if store is not None:
+			store.close()
+	if watchdog["timeouts"] > 0 or watchdog["retries"] > 0:
+		print("codeml runs timed out", watchdog["timeouts"], "times, and", watchdog["retries"], "model fits were retried.")
+
+	failed = [output for output, status in results if status != 0]
+	if len(failed) > 0:
+		print("codeml failed for", len(failed), "runs:", file=sys.stderr)
+		for codeml_output, status in sorted(results):
+			if status != 0:
+				print(codeml_output + "\t" + str(status), file=sys.stderr)
+
+	telemetry.finish(genes=len(tasks), runs=len(results), failed=len(failed), skipped=0 if passed is None else len(alignments) - len(passed), timeouts=watchdog["timeouts"], retries=watchdog["retries"])
 	print("Run finished!")
+	return results
+
+def quality_filter(input_dir, alignments, qc, jobs, telemetry, shard):
+	###Profiles the alignments and decides which genes go to codeml, writing the decisions to alignment_qc.tsv
+	#Returns the alignment to run (the trimmed one, if trimmed) of every gene that is not skipped
+	genes = sorted(alignments.keys())
+	profiles = profile_alignments([alignments[core_gene] for core_gene in genes], qc.get("trim"), jobs)
+	passed = dict()
+	rows = list()
+	for core_gene, result in zip(genes, profiles):
+		result["reasons"] = assess(result, qc)
+		if len(result["reasons"]) == 0:
+			result["decision"] = "pass"
+		else:
+			result["decision"] = qc.get("action", "skip")
+			print("Alignment of core gene", core_gene, "fails the quality thresholds (" + "; ".join(result["reasons"]) + ")" + (", skipping." if result["decision"] == "skip" else ", flagged."))
+		if result["decision"] == "skip":
+			telemetry.gene(core_gene, None, {"taxa": result["taxa"], "codons": result["codons"]})
+		else:
+			passed[core_gene] = result["alignment"]
+			#A trimmed alignment left by an earlier run would make step 6 describe the wrong alignment
+			stale = alignments[core_gene][:-len(".pal2nal")] + TRIMMED
+			if result["alignment"] != stale and os.path.exists(stale):
+				os.remove(stale)
+		rows.append((core_gene, result))
+
+	report = os.path.join(input_dir, "alignment_qc" + shard_suffix(shard) + ".tsv")
+	write_report(rows, report)
+	skipped = len(rows) - len(passed)
+	print("Alignment quality report written to", report + ":", skipped, "of", len(rows), "core genes skipped.")
+	return passed
+
+def print_plan(tasks, costs, sizes, jobs, cost_model, limits=None):
+	###Dry run: predicted codeml seconds per gene, in the order the genes would run
+	if cost_model.samples > 0:
+		print("Cost model calibrated with", cost_model.samples, "codeml runs from previous runs.")
+	else:
+		print("Cost model not calibrated yet (no codeml timings in this folder), predictions are rough.")
+	print("Core gene\tTaxa\tCodons\tModels to run\tPredicted seconds" + ("\tTime limit (s)" if limits else ""))
+	for task in tasks:
+		core_gene, alignment, tree, gene_hypotheses = task[:4]
+		to_run = [str(model) + ":" + str(nssites) for model, nssites, codeml_output, up_to_date in gene_hypotheses if not up_to_date]
+		taxa, codons = sizes[core_gene]
+		print("\t".join([core_gene, str(taxa), str(codons), ",".join(to_run), str(round(costs[core_gene], 1))] + ([str(round(limits[core_gene], 1))] if limits else [])))
+	total = sum(costs.values())
+	print("Genes to run:", len(tasks))
+	print("Predicted CPU time:", round(total, 1), "seconds")
+	print("Predicted wall time with", jobs, "jobs:", round(makespan([costs[task[0]] for task in tasks], jobs), 1), "seconds")
+	if limits:
+		print("Worst-case wall time with", jobs, "jobs (every run timing out and retried):", round(makespan([limits[task[0]] for task in tasks], jobs), 1), "seconds")
+
+def codeml_done(manifest, telemetry, store, signatures, gene_results, watchdog):
+	#Records the gene's codeml runs (every start, timeout and retry), and returns them as (codeml output, status) pairs
+	gene_status = 0
+	for codeml_output, status, runs in gene_results:
+		core_gene, extension, signature, model, nssites, taxa, codons = signatures[codeml_output]
+		for run in runs or [{"status": status}]:
+			usage = dict(run)
+			telemetry.tool(core_gene, core_gene + " codeml " + extension, usage.pop("status"), usage, model=model, nssites=str(nssites), taxa=taxa, codons=codons)
+		watchdog["timeouts"] += sum(1 for run in runs if run.get("timed_out"))
+		watchdog["retries"] += max([run["attempt"] for run in runs] or [1]) - 1
+		if status == 0:
+			manifest.record("run_codeml", core_gene + extension, signature, [codeml_output])
+			if store is not None:
+				try:
+					store.upsert(core_gene, extension, codeml_output, parse_codeml(codeml_output))
+				except sqlite3.Error as error:
+					print("Warning: the results of", codeml_output, "could not be stored in", store.path, "(" + str(error) + ").", file=sys.stderr)
+			print("Omega for core gene", core_gene, "succesfully calculated.")
+		elif gene_status == 0:
+			gene_status = status
+	if len(gene_results) > 0:
+		telemetry.gene(core_gene, gene_status, {"taxa": taxa, "codons": codons}, [result[0] for result in gene_results])
+	return [(codeml_output, status) for codeml_output, status, runs in gene_results]
 
 def main(argv=None):
 	args_parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO: \n script to estimate dN/dS a.k.a omega values on codon alignemnts.", epilog='*******************************************************************\n\n*******************************************************************\n\nMake sure you cite PAML and our book chapter!')
 	args_parser.add_argument('-i', '--input', required=True, help='Input folder of codon alignments (ending in .pal2nal, obtained using PAL2NAL).')
-	args_parser.add_argument('-e', '--extension', required=True, help='Extension of output files (e.g., .cml.out).')
+	args_parser.add_argument('-e', '--extension', required=False, help='Extension of output files (e.g., .cml.out).')
 	args_parser.add_argument('-m', '--model', required=False, default=int(0), help='Model for omega estimation. Default value is 0, meaning that all branches have the same rate.')
 	args_parser.add_argument('-n', '--nssites', required=False, default=int(0), help='NSsites option available to estimate omega. Default value is 0, meaning that codons in the alignment have the same rate.')
 	args_parser.add_argument('-c', '--clean', required=False, default=int(0), help='Do you expect your data to have a lot of gaps and/or ambiguous sites? yes? use -c 1, no? use default value -c 0.')
 	args_parser.add_argument('-r', '--rubbish', required=False, default=int(0), help='From 0 to 3, how much rubbish do you want on your screen? Pick a number! (default is 0).')
+	args_parser.add_argument('-H', '--hypothesis', required=False, action='append', type=parse_hypothesis, help='Fit several models in one run, given as MODEL:NSSITES:EXTENSION (e.g., -H 0:0:.null -H 2:0:.alt). List them from the simplest to the most complex model. Replaces -e, -m and -n.')
+	args_parser.add_argument('--no_warm_start', required=False, action='store_true', help='With several hypotheses, start every model from scratch instead of from the estimates of the previous one.')
+	args_parser.add_argument('-j', '--jobs', required=False, default=int(1), help='Number of core genes to run through codeml at the same time. Default is 1.')
+	args_parser.add_argument('--tmp', required=False, default=None, help='Folder for the scratch directory of each codeml run. Default is the system temporary folder.')
+	args_parser.add_argument('--shard', required=False, type=parse_shard, help='Only run one share of the core genes, given as INDEX/COUNT (e.g., --shard 2/8 for the second of eight array tasks). Use the same COUNT as in steps 2 and 3: each shard then gets the same genes in every step.')
+	args_parser.add_argument('--force', required=False, action='store_true', help='Run codeml on every core gene, even those whose output is up to date.')
+	args_parser.add_argument('--max_gap_fraction', required=False, type=float, help='Skip core genes whose codon alignment has more than this fraction of gap codons (e.g., 0.3). Not checked by default.')
+	args_parser.add_argument('--max_ambiguous_fraction', required=False, type=float, help='Skip core genes whose codon alignment has more than this fraction of codons with ambiguous bases. Not checked by default.')
+	args_parser.add_argument('--min_codons', required=False, type=int, help='Skip core genes with fewer codon columns free of gaps and ambiguous bases than this. Not checked by default.')
+	args_parser.add_argument('--min_identity', required=False, type=float, help='Skip core genes whose sequences share less than this fraction of identical codons, on average over all pairs. Not checked by default.')
+	args_parser.add_argument('--max_identity', required=False, type=float, help='Skip core genes whose sequences share more than this fraction of identical codons, on average over all pairs (near-identical alignments). Not checked by default.')
+	args_parser.add_argument('--trim_columns', required=False, type=float, help='Before the checks, remove codon columns where more than this fraction of the sequences has a gap or an ambiguous codon. codeml then runs on the trimmed alignment (.pal2nal.trimmed). Not done by default.')
+	args_parser.add_argument('--qc_action', required=False, default="skip", choices=["skip", "flag"], help='What to do with core genes that fail the quality thresholds: skip them, or run them anyway and only flag them in the report. Default is skip.')
+	args_parser.add_argument('--compress', required=False, action='store_true', help='gzip-compress the codeml output files as they are written, keeping their names. Steps 5 and 6 read them as they are; use zless or zcat to look at them.')
+	args_parser.add_argument('--timeout_factor', required=False, type=float, help='Kill a codeml run that takes more than this many times its predicted time (see --plan), which scales with the size of its alignment, e.g., 10. Needs codeml timings from a previous run in the folder telemetry; without them, no time limit is set. No time limit by default.')
+	args_parser.add_argument('--min_timeout', required=False, type=float, default=60, help='Shortest time limit given to a codeml run with --timeout_factor, in seconds. Default is 60.')
+	args_parser.add_argument('--retries', required=False, type=int, default=0, help='Fit a model again, from other starting omega and kappa values and with twice the time limit, when its codeml runs all failed or timed out, up to this many times. Default is 0.')
+	args_parser.add_argument('--starts', required=False, type=int, default=1, help='Fit every model from this many starting omega and kappa values at the same time, and keep the output with the best lnL. Each core gene then runs this many codeml processes. Default is 1.')
+	args_parser.add_argument('--sqlite_wal', required=False, action='store_true', help='Use SQLite write-ahead logging for the results database, so it can be queried without waiting while codeml results are written. Only when every process using the core folder runs on the same host (not over a network filesystem).')
+	args_parser.add_argument('--no_check', required=False, action='store_true', help='Skip the pre-flight check that codeml is on PATH (see dnds-pipeline check).')
+	args_parser.add_argument('--plan', required=False, action='store_true', help='Do not run codeml: print the predicted time of every core gene left to run, in the order they would run, and the predicted total wall time with -j jobs. Predictions get better once codeml timings from a previous run are in the folder telemetry.')
 	args_parser = args_parser.parse_args()
+	if args_parser.extension is None and args_parser.hypothesis is None:
+		sys.exit('Error: either -e/--extension or -H/--hypothesis is required.')
 
 	#Setting up parameters to run omega
 	input_dir = args_parser.input
-	extension = str(args_parser.extension)
+	extension = args_parser.extension
 	model = int(args_parser.model)
 	nssites = args_parser.nssites
 	clean = args_parser.clean
 	rubbish = int(args_parser.rubbish)
+	force = args_parser.force
+	jobs = int(args_parser.jobs)
+	tmp_dir = args_parser.tmp
+	hypotheses = args_parser.hypothesis
+	warm_start = not args_parser.no_warm_start
+	shard = args_parser.shard
+	plan = args_parser.plan
+	compress = args_parser.compress
+	qc = quality_thresholds(args_parser)
+	timeout_factor = args_parser.timeout_factor
+	min_timeout = args_parser.min_timeout
+	retries = args_parser.retries
+	starts = args_parser.starts
+	wal = args_parser.sqlite_wal
+	if retries < 0 or starts < 1:
+		sys.exit('Error: --retries must be 0 or more, and --starts 1 or more.')
+
+	#Checking the tools before any gene starts (a plan runs nothing)
+	if not args_parser.no_check and not plan:
+		problems = report(preflight(input_dir, stages=["run_codeml"]))
+		if problems > 0:
+			sys.exit('Error: the pre-flight check found ' + str(problems) + ' problem(s), nothing was run.')
 	
-	run_codeml(input_dir, extension, model, nssites, clean, rubbish)
+	run_codeml(input_dir, extension, model, nssites, clean, rubbish, force, jobs, tmp_dir, hypotheses, warm_start, shard, plan, qc, compress, timeout_factor, min_timeout, retries, starts, wal)
 
 if __name__ == '__main__':
 	status = main()
@@ -2,95 +2,141 @@
 
 import os
 import sys
-import re
 import argparse
-import scipy
-from statsmodels.sandbox.stats.multicomp import multipletests
-
-def lrt_test(input_dir, null_ext, alt_ext, df, alpha):
-	alternative2lnl = dict()
-	null2lnl = dict()
-	for file in os.listdir(input_dir):
-		if file.endswith(alt_ext):
-			file_path = os.path.join(input_dir, file)
-			null_file = file_path.replace(alt_ext, null_ext)
-			core_gene = file.replace(alt_ext, "")
-
-			null_dict = dict()
-			with open(null_file) as null_file:
-				for line in null_file:
-					line = line.rstrip()
-					line = re.sub("[\t ]+", "\t", line)
-					tabs = line.split("\t")
-
-					if "lnL" in line:
-						lnl_value = float(tabs [4])
-						null2lnl[core_gene] = lnl_value
-					else:
-						pass
-			null_file.close()	
-
-			with open(file_path) as file_path:
-				for line in file_path:
-					line = line.rstrip()
-					line = re.sub("[\t ]+", "\t", line)
-					tabs = line.split("\t")
-
-					if "lnL" in line:
-						lnl_value = float(tabs [4])
-						alternative2lnl[core_gene] = lnl_value
-					else:
-						pass
-
-			file_path.close()
-			
-	###Doing test
-	all_p_vals = list()
-	all_core_genes = list()
-	all_lr_stats = list()
-	for key, value in alternative2lnl.items():
-		lnl_alt = value
-		lnl_null = null2lnl[key]
-		LR_statistic = -2*(lnl_null-lnl_alt)
-		p_val = scipy.stats.chi2.sf(LR_statistic, df)
-		all_p_vals.append(p_val)
-		all_core_genes.append(key)
-		all_lr_stats.append(LR_statistic)
-
-	##Correcting p-vals
-	p_adjusted = multipletests(all_p_vals, alpha=alpha, method='bonferroni')
-	p_adjusted_vals = p_adjusted[1]
-
-	print("Core gene" + "\t" + "LR_stat"+ "\t" + "P value" + "\t" + "Corrected P value" + "\t" + "Result")
-	count = 0
-	for x in p_adjusted_vals:
-		core = all_core_genes[count]
-		p_val = all_p_vals[count]
-		lr_stat = all_lr_stats[count]
+import numpy as np
+from scipy.special import chdtrc
+from dnds_pipeline.manifest import Manifest
+from dnds_pipeline.options import parse_pair
+from dnds_pipeline.results_db import collect_results, results_signature
+from dnds_pipeline.telemetry import Telemetry
+
+CORRECTION_METHODS = ["bonferroni", "fdr_bh", "fdr_by"]
+
+def adjust_pvalues(p_vals, method):
+	#Bonferroni, Benjamini-Hochberg (fdr_bh) or Benjamini-Yekutieli (fdr_by) adjusted P values
+	p_vals = np.asarray(p_vals, dtype=float)
+	m = len(p_vals)
+	if m == 0:
+		return p_vals
+	if method == "bonferroni":
+		return np.minimum(p_vals * m, 1.0)
+	if method not in ("fdr_bh", "fdr_by"):
+		raise ValueError("Unknown correction method: " + method)
+
+	order = np.argsort(p_vals)
+	ranked = p_vals[order] * m / np.arange(1, m + 1)
+	if method == "fdr_by":
+		ranked = ranked * np.sum(1.0 / np.arange(1, m + 1))
+	ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+	adjusted = np.empty(m)
+	adjusted[order] = np.minimum(ranked, 1.0)
+	return adjusted
+
+def lrt_engine(lnl_null, lnl_alt, dfs, families, method):
+	#All LR statistics and P values at once. Every row is one gene under one hypothesis pair,
+	#with its own df; P values are corrected separately within each family (hypothesis pair).
+	lnl_null = np.asarray(lnl_null, dtype=float)
+	lnl_alt = np.asarray(lnl_alt, dtype=float)
+	dfs = np.asarray(dfs, dtype=float)
+	families = np.asarray(families)
+
+	lr_stats = -2*(lnl_null-lnl_alt)
+	#A negative LR (alternative fit no better than the null) gives P = 1, like chi2.sf does
+	p_vals = chdtrc(dfs, np.maximum(lr_stats, 0.0))
+	p_adjusted = np.empty_like(p_vals)
+	for family in np.unique(families):
+		in_family = families == family
+		p_adjusted[in_family] = adjust_pvalues(p_vals[in_family], method)
+	return lr_stats, p_vals, p_adjusted
+
+def lrt_test(input_dir, null_ext, alt_ext, df, alpha, force=False, jobs=1, pairs=None, method="bonferroni"):
+	#Each pair is a (null extension, alternative extension, df) hypothesis pair
+	if pairs is None:
+		pairs = [(null_ext, alt_ext, df)]
+
+	#input_dir can also be a list of folders (e.g., one per shard), whose outputs are tested together
+	input_dirs = [input_dir] if isinstance(input_dir, str) else list(input_dir)
+
+	###Finding the codeml outputs of every hypothesis pair in the SQLite results store (outputs missing from it are parsed once and stored, --force checks every output again)
+	results = dict()
+	for extension in sorted(set([null_ext for null_ext, alt_ext, df in pairs] + [alt_ext for null_ext, alt_ext, df in pairs])):
+		results[extension] = dict((os.path.basename(path)[:-len(extension)], (path, parsed)) for path, parsed in collect_results(input_dirs, extension, jobs, force))
+	rows = list()
+	lnl = dict()
+	used = dict()
+	for null_ext, alt_ext, df in pairs:
+		for core_gene, (alt_file, alt_parsed) in sorted(results[alt_ext].items()):
+			if core_gene not in results[null_ext]:
+				print("No " + null_ext + " output for core gene " + core_gene + ", skipping.", file=sys.stderr)
+				continue
+			null_file, null_parsed = results[null_ext][core_gene]
+			rows.append((core_gene, null_ext, alt_ext, df, null_file, alt_file))
+			for path, parsed in ((null_file, null_parsed), (alt_file, alt_parsed)):
+				lnl[path] = parsed["lnL"]
+				used[path] = parsed
+
+	###Reusing the previous table if no codeml output changed
+	manifest = Manifest(input_dirs[0], force)
+	telemetry = Telemetry(input_dirs[0], "lrt_test")
+	manifest_key = ", ".join(null_ext + " vs " + alt_ext for null_ext, alt_ext, df in pairs)
+	if len(input_dirs) > 1:
+		manifest_key += " from " + ", ".join(os.path.abspath(folder) for folder in input_dirs)
+	inputs = sorted(used)
+	signature = manifest.signature([], {"pairs": pairs, "alpha": alpha, "method": method, "outputs": results_signature([(path, used[path]) for path in inputs])})
+	if manifest.is_current("lrt_test", manifest_key, signature):
+		print("\n".join(manifest.get("lrt_test", manifest_key)["data"]))
+		telemetry.finish(pairs=manifest_key, tests=len(rows), up_to_date=True)
+		return
+
+	missing = [row for row in rows if lnl[row[4]] is None or lnl[row[5]] is None]
+	if len(missing) > 0:
+		print("No lnL found for: " + ", ".join(row[0] + " (" + row[1] + " vs " + row[2] + ")" for row in missing), file=sys.stderr)
+	rows = [row for row in rows if lnl[row[4]] is not None and lnl[row[5]] is not None]
+
+	###Doing all tests at once
+	lr_stats, p_vals, p_adjusted_vals = lrt_engine([lnl[row[4]] for row in rows], [lnl[row[5]] for row in rows], [row[3] for row in rows], [row[1] + " vs " + row[2] for row in rows], method)
+
+	table = ["\t".join(["Core gene", "LR_stat", "P value", "Corrected P value", "Result", "Null", "Alternative", "df", "lnL null", "lnL alternative", "Correction"])]
+	for row, lr_stat, p_val, x in zip(rows, lr_stats, p_vals, p_adjusted_vals):
+		core, null_ext, alt_ext, df, null_file, alt_file = row
 		if x<alpha:
-			print(core + "\t" + str(lr_stat) +"\t" + str(p_val) +"\t" + str(x) + "\t" + "*")
+			result = "*"
 		else:
-			print(core + "\t" + str(lr_stat) +"\t" + str(p_val) +"\t" + str(x) + "\t" + "NS")
-		count = count + 1
+			result = "NS"
+		table.append("\t".join([core, str(float(lr_stat)), str(float(p_val)), str(float(x)), result, null_ext, alt_ext, str(df), str(lnl[null_file]), str(lnl[alt_file]), method]))
+
+	print("\n".join(table))
+	manifest.record("lrt_test", manifest_key, signature, data=table)
+	telemetry.finish(pairs=manifest_key, tests=len(rows), files=len(inputs))
 
 
 def main(argv=None):
-	args_parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO:\nThis script will perform a Likelihood-ratio test, which will assesses the goodness of fit of two competing statistical models.\nP-values will be correctec through the bonferroni method.", epilog='*******************************************************************\n\n*******************************************************************\n\nMake sure you cite our book chapter!')
-	args_parser.add_argument('-i', '--input', required=True, help='Input folder where codeml output files are located.')
-	args_parser.add_argument('-n', '--null', required=True, help='Extension of codeml output files that resulted from model = 0 and NSsites = 0 (null hypothesis).')
-	args_parser.add_argument('-a', '--alternative', required=True, help='Extension of codeml output files that resulted from model = 1 and NSsites = 0 in our example (alternative hypothesis). Moel and NSsites may change depending on your question.')
-	args_parser.add_argument('-df', '--df', required=True, help='Degrees of freedom for LR test.')
-	args_parser.add_argument('-alpha', '--alpha', required=False, default=int(0.05), help='Alpha value for P-values correction.')
+	args_parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO:\nThis script will perform a Likelihood-ratio test, which will assesses the goodness of fit of two competing statistical models.\nSeveral pairs of models can be tested at once. P-values will be corrected through the bonferroni (default), Benjamini-Hochberg or Benjamini-Yekutieli method, separately for each pair of models.", epilog='*******************************************************************\n\n*******************************************************************\n\nMake sure you cite our book chapter!')
+	args_parser.add_argument('-i', '--input', required=True, nargs='+', help='Input folder where codeml output files are located. Give several folders (e.g., one per shard) to test their outputs together, with a single P-value correction.')
+	args_parser.add_argument('-n', '--null', required=False, help='Extension of codeml output files that resulted from model = 0 and NSsites = 0 (null hypothesis).')
+	args_parser.add_argument('-a', '--alternative', required=False, help='Extension of codeml output files that resulted from model = 1 and NSsites = 0 in our example (alternative hypothesis). Moel and NSsites may change depending on your question.')
+	args_parser.add_argument('-df', '--df', required=False, help='Degrees of freedom for LR test.')
+	args_parser.add_argument('-p', '--pair', required=False, action='append', type=parse_pair, help='Test several pairs of models at once, given as NULL:ALTERNATIVE:DF (e.g., -p .null:.alt:1 -p .m7:.m8:2). Replaces -n, -a and -df.')
+	args_parser.add_argument('-alpha', '--alpha', required=False, default=0.05, help='Alpha value for P-values correction. Default is 0.05.')
+	args_parser.add_argument('-m', '--method', required=False, default="bonferroni", choices=CORRECTION_METHODS, help='P-value correction method: bonferroni, fdr_bh (Benjamini-Hochberg) or fdr_by (Benjamini-Yekutieli). Default is bonferroni.')
+	args_parser.add_argument('-j', '--jobs', required=False, default=int(1), help='Number of processes used to parse the codeml output files. Default is 1.')
+	args_parser.add_argument('--force', required=False, action='store_true', help='Redo the test even if no codeml output changed since the last run.')
 	args_parser = args_parser.parse_args()
+	if args_parser.pair is None and (args_parser.null is None or args_parser.alternative is None or args_parser.df is None):
+		sys.exit('Error: either -n, -a and -df, or -p/--pair is required.')
 
 	#Setting up parameters
 	input_dir = args_parser.input
 	null = args_parser.null
 	alternative = args_parser.alternative
-	df = int(args_parser.df)
+	df = int(args_parser.df) if args_parser.df is not None else None
+	pairs = args_parser.pair
 	alpha = float(args_parser.alpha)
-	
-	lrt_test(input_dir, null, alternative, df, alpha)
+	method = args_parser.method
+	force = args_parser.force
+	jobs = int(args_parser.jobs)
+
+	lrt_test(input_dir, null, alternative, df, alpha, force, jobs, pairs, method)
 
 if __name__ == '__main__':
 	status = main()
@@ -5,17 +5,55 @@ import os
 from collections import defaultdict
 import sys
 
-
-def parse_dnds(input_folder, output, ext):
-    # Get list of all infiles.
-    files = os.listdir(input_folder)
-    files = [f for f in files if f.endswith(ext)]
+from dnds_pipeline.alignment_qc import TRIMMED
+from dnds_pipeline.manifest import Manifest
+from dnds_pipeline.results_db import collect_results, results_signature
+from dnds_pipeline.site_patterns import COLUMNS, bulk_statistics
+from dnds_pipeline.telemetry import Telemetry
+
+
+def parse_dnds(input_folder, output, ext, force=False, jobs=1):
+    # Get list of all infiles. input_folder can also be a list of folders
+    # (e.g., one per shard), whose files are merged into one summary.
+    # Parsed outputs come from the SQLite results store; only files missing from it
+    # are read by the shared streaming parser, over `jobs` processes (with --force,
+    # every file is checked against the store and read again if it changed).
+    input_folders = [input_folder] if isinstance(input_folder, str) else list(input_folder)
+    collected = collect_results(input_folders, ext, jobs, force)
+    paths = [path for path, parsed in collected]
+    parsed_files = [parsed for path, parsed in collected]
+    files = [os.path.basename(path) for path in paths]
 
     # Throw error if 0 files found.
     if len(files) == 0:
         print('No files found with extension:', ext, file=sys.stderr)
         sys.exit(1)
 
+    # The codon alignment each codeml output was run on, when it is still next to it:
+    # the trimmed one if step 4 trimmed it (--trim_columns), otherwise the .pal2nal.
+    # Each folder is listed once rather than looking for every file.
+    listed = dict((folder, set(os.listdir(folder))) for folder in set(os.path.dirname(path) for path in paths))
+    alignments = dict()
+    for path, f in zip(paths, files):
+        for suffix in (TRIMMED, '.pal2nal'):
+            if f.replace(ext, '') + suffix in listed[os.path.dirname(path)]:
+                alignments[f.replace(ext, '')] = os.path.join(os.path.dirname(path), f.replace(ext, '') + suffix)
+                break
+
+    # Nothing to do if no codeml output changed since the last run into this output folder
+    # (step 4 writes a new output whenever it redoes a gene on a new alignment).
+    manifest = Manifest(input_folders[0], force)
+    telemetry = Telemetry(input_folders[0], 'parse_dnds')
+    manifest_key = ext + ' -> ' + os.path.abspath(output)
+    if len(input_folders) > 1:
+        manifest_key += ' from ' + ', '.join(os.path.abspath(folder) for folder in input_folders)
+    outputs = [os.path.join(output, 'summary_tab.tsv'), os.path.join(output, 'branch_tab.tsv')]
+    signature = manifest.signature([], {'outputs': results_signature(collected), 'alignments': sorted(os.path.basename(alignment) for alignment in alignments.values())})
+    if manifest.is_current('parse_dnds', manifest_key, signature, outputs):
+        print('Summaries in ' + output + ' are up to date, skipping.')
+        telemetry.finish(extension=ext, files=len(files), up_to_date=True)
+        return
+
     # Make output directory, unless it exists.
     if not os.path.exists(output):
         os.makedirs(output)
@@ -27,15 +65,11 @@ def parse_dnds(input_folder, output, ext):
     trees = dict()
 
     branch_header = None
-    just_printed_sites = False
-    just_parsed_counts = False
-    next_line_is_poly_breakdown = False
-    tree_next = False
-    poly_breakdown_length = None
 
-    for f in files:
+    # Site statistics straight from the codon alignments, all genes at once.
+    site_stats = dict(zip(alignments.keys(), bulk_statistics(alignments.values(), jobs)))
 
-        branch_observed = False
+    for f, parsed in zip(files, parsed_files):
 
         # Get input name, which is filename without extension.
         input_name = f.replace(ext, '')
@@ -44,63 +78,31 @@ def parse_dnds(input_folder, output, ext):
         summary_tab[input_name]['summed_N'] = 0
         summary_tab[input_name]['summed_S'] = 0
 
-        with open(os.path.join(input_folder, f)) as file:
-            lines = file.readlines()
-            for line in lines:
-                line_split = line.rstrip().split()
-
-                if len(line_split) == 0:
-                    continue
-
-                if next_line_is_poly_breakdown:
-                    if poly_breakdown_length is not None and len(line_split) == poly_breakdown_length:
-                        all_pos = ''.join(line_split[1:])
-                        seq_poly_pos = set([i for i, x in enumerate(all_pos) if x != '.'])
-                        poly_pos[input_name] = poly_pos[input_name].union(seq_poly_pos)
-                    else:
-                        next_line_is_poly_breakdown = False
-
-                if line.startswith('Printing out site pattern counts'):
-                    just_printed_sites = True
-                elif just_printed_sites:
-                    just_printed_sites = False
-                    summary_tab[input_name]['num_seq'] = line_split[0]
-                    summary_tab[input_name]['num_sites'] = line_split[1]
-                    just_parsed_counts = True
-                elif just_parsed_counts:
-                    next_line_is_poly_breakdown = True
-                    just_parsed_counts = False
-                    poly_breakdown_length = len(line_split)
-                elif line_split[0] == 'kappa':
-                    summary_tab[input_name]['kappa'] = line_split[3]
-                elif line_split[0] == 'omega':
-                    summary_tab[input_name]['omega'] = line_split[3]
-                elif line.startswith("w (dN/dS) for branches:"):
-                    summary_tab[input_name]['omega1'] = line_split[-2]
-                    summary_tab[input_name]['omega2'] = line_split[-1]
-                elif line.startswith('tree length for dN:'):
-                    summary_tab[input_name]['total_dN'] = line_split[-1]
-                elif line.startswith('tree length for dS:'):
-                    summary_tab[input_name]['total_dS'] = line_split[-1]
-                if line.startswith('tree length = '):
-                    summary_tab[input_name]['tree_length'] = line_split[-1]
-                    tree_next = True
-                elif tree_next:
-                    trees[input_name] = line.rstrip()
-                    tree_next = False
-                elif line_split[0] == 'branch':
-                    if branch_header is None:
-                        branch_header = '\t'.join(['locus'] + line_split)
-                    # Get mapping of which column index corresponds to 'N' and 'S'.
-                    N_index = line_split.index('N')
-                    S_index = line_split.index('S')
-                    branch_num_col = len(line_split)
-                    branch_observed = True
-                elif branch_observed and len(line_split) == branch_num_col:
-                    branch_tab.append('\t'.join([input_name] + line_split))
-                    summary_tab[input_name]['num_compare'] += 1.0
-                    summary_tab[input_name]['summed_N'] += float(line_split[N_index])
-                    summary_tab[input_name]['summed_S'] += float(line_split[S_index])
+        for key in ['num_seq', 'num_sites', 'kappa', 'omega', 'total_dN', 'total_dS', 'tree_length']:
+            if parsed[key] is not None:
+                summary_tab[input_name][key] = parsed[key]
+
+        if parsed['omegas'] is not None and len(parsed['omegas']) >= 2:
+            summary_tab[input_name]['omega1'] = parsed['omegas'][-2]
+            summary_tab[input_name]['omega2'] = parsed['omegas'][-1]
+
+        if len(parsed['trees']) > 0:
+            trees[input_name] = parsed['trees'][0]
+
+        # Without its alignment, a gene's polymorphic sites come from codeml's site pattern printout.
+        poly_pos[input_name] = parsed['poly_positions']
+
+        if parsed['branch_header'] is not None:
+            if branch_header is None:
+                branch_header = '\t'.join(['locus'] + parsed['branch_header'])
+            # Get mapping of which column index corresponds to 'N' and 'S'.
+            N_index = parsed['branch_header'].index('N')
+            S_index = parsed['branch_header'].index('S')
+            for line_split in parsed['branches']:
+                branch_tab.append('\t'.join([input_name] + line_split))
+                summary_tab[input_name]['num_compare'] += 1.0
+                summary_tab[input_name]['summed_N'] += float(line_split[N_index])
+                summary_tab[input_name]['summed_S'] += float(line_split[S_index])
 
     # Check that all info parsed per locus.
     loci_w_missing_info = set()
@@ -122,10 +124,10 @@ def parse_dnds(input_folder, output, ext):
 
         if 'omega1' not in summary_tab[locus]:
             summary_header = '\t'.join(['locus', 'kappa', 'omega', 'total_dN', 'total_dS', 'mean_N', 'mean_S',
-                                        'num_polymorphic_sites'])
+                                        'num_polymorphic_sites'] + COLUMNS)
         else:
             summary_header = '\t'.join(['locus', 'kappa', 'omega1', 'omega2', 'total_dN', 'total_dS', 'mean_N', 'mean_S',
-                                        'num_polymorphic_sites'])
+                                        'num_polymorphic_sites'] + COLUMNS)
         outfile.write(summary_header + '\n')
 
         for locus in sorted(summary_tab.keys()):
@@ -137,7 +139,12 @@ def parse_dnds(input_folder, output, ext):
             mean_N = str(summary_tab[locus]['summed_N'] / summary_tab[locus]['num_compare'])
             mean_S = str(summary_tab[locus]['summed_S'] / summary_tab[locus]['num_compare'])
 
-            num_polymorphisms = str(len(poly_pos[locus]))
+            if locus in site_stats:
+                num_polymorphisms = str(site_stats[locus]['num_polymorphic_sites'])
+                site_columns = [str(round(site_stats[locus][column], 6)) for column in COLUMNS]
+            else:
+                num_polymorphisms = str(len(poly_pos[locus]))
+                site_columns = ['NA'] * len(COLUMNS)
 
             if 'omega' in summary_tab[locus]:
                 omega = summary_tab[locus]['omega']
@@ -151,7 +158,7 @@ def parse_dnds(input_folder, output, ext):
                                       summary_tab[locus]['total_dS'],
                                       mean_N,
                                       mean_S,
-                                      num_polymorphisms])
+                                      num_polymorphisms] + site_columns)
             outfile.write(summary_line + '\n')
 
     with open(os.path.join(output, 'branch_tab.tsv'), 'w') as branchfile:
@@ -166,23 +173,30 @@ def parse_dnds(input_folder, output, ext):
         with open(os.path.join(output, 'trees', locus + '.tre'), 'w') as treefile:
             treefile.write(trees[locus])
 
+    manifest.record('parse_dnds', manifest_key, signature, outputs)
+    telemetry.finish(extension=ext, files=len(files), outputs=outputs)
+
 
 def main(argv=None):
     args_parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="INFO:\nThis script will parse raw CODEML output files for further analysis.",
         epilog='*******************************************************************\n\n*******************************************************************\n\nMake sure you cite our book chapter!')
-    args_parser.add_argument('-i', '--input', required=True, help='Input folder where codeml output files are located.')
+    args_parser.add_argument('-i', '--input', required=True, nargs='+', help='Input folder where codeml output files are located. Give several folders (e.g., one per shard) to merge their outputs into one summary.')
     args_parser.add_argument('-o', '--output', required=True, help='Folder where output files will go.')
     args_parser.add_argument('-e', '--ext', required=False, default=".cml.out", help='Extension of codeml output files. Default is .cml.out.')
+    args_parser.add_argument('-j', '--jobs', required=False, default=int(1), help='Number of processes used to parse the codeml output files. Default is 1.')
+    args_parser.add_argument('--force', required=False, action='store_true', help='Parse the codeml output files even if they did not change since the last run.')
     args_parser = args_parser.parse_args()
 
     # Setting up parameters.
     input_folder = args_parser.input
     output = args_parser.output
     extension = args_parser.ext
+    force = args_parser.force
+    jobs = int(args_parser.jobs)
 
-    parse_dnds(input_folder, output, extension)
+    parse_dnds(input_folder, output, extension, force, jobs)
 
 
 if __name__ == '__main__':
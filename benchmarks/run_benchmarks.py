@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# Times each pipeline stage on synthetic data of increasing size and reports
+# how it scales. Every stage runs in a freshly started Python process, so its
+# peak memory is its own: the peak RSS of the stage's process, and the largest
+# peak RSS among the tools and worker processes it started. On Linux a tool's
+# peak RSS is at least the RSS of the process that started it.
+
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from dnds_pipeline.cli import STAGE_ORDER, stage_function
+from synthetic import codeml_outputs, generate
+
+HYPOTHESES = [(0, "0", ".null"), (2, "0", ".alt")]
+PAIRS = [(".null", ".alt", 1)]
+DEFAULT_SCALES = ["4x25x200", "8x25x200", "8x50x200", "8x50x400"]
+COLUMNS = ["Scale", "Genomes", "Genes", "Codons", "Stage", "Repeat", "Wall (s)", "CPU (s)", "Peak RSS (MB)", "Peak tool RSS (MB)", "Exit code"]
+
+
+def parse_scale(text):
+    try:
+        genomes, genes, length = [int(value) for value in text.lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Scales are GENOMESxGENESxCODONS (e.g., 8x50x300), not " + text)
+    if genomes < 3 or genes < 1 or length < 3:
+        raise argparse.ArgumentTypeError("A scale needs at least 3 genomes, 1 gene and 3 codons per gene: " + text)
+    return genomes, genes, length
+
+
+def stage_call(stage, folders, threads):
+    genome_dir, prodigal_dir, core_dir, out_dir = folders
+    function = stage_function(stage)
+    if stage == "predict_proteins":
+        predicted = os.path.join(out_dir, "predicted")
+        os.makedirs(predicted, exist_ok=True)
+        return lambda: function(genome_dir, predicted, 0, threads, True)
+    if stage == "gene_trees":
+        return lambda: function(core_dir, prodigal_dir, "G1", 0, threads, True)
+    if stage == "codon_alignment":
+        return lambda: function(core_dir, 0, threads, True)
+    if stage == "run_codeml":
+        return lambda: function(core_dir, None, None, None, 0, 0, True, threads, None, HYPOTHESES, True)
+    if stage == "lrt_test":
+        return lambda: function(core_dir, None, None, None, 0.05, True, threads, PAIRS, "bonferroni")
+    if stage == "parse_dnds":
+        return lambda: [function(core_dir, os.path.join(out_dir, extension.lstrip(".") + "_codeml_summary"), extension, True, threads) for model, nssites, extension in HYPOTHESES]
+
+
+def measure(stage, folders, threads, log_path, results):
+    # Runs in the child process. All output, the tools' included, goes to the log.
+    call = stage_call(stage, folders, threads)
+    log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    sys.stdout = os.fdopen(1, "w", buffering=1)
+    sys.stderr = os.fdopen(2, "w", buffering=1)
+    exit_code = 0
+    start = time.perf_counter()
+    try:
+        call()
+    except SystemExit as error:
+        exit_code = error.code if isinstance(error.code, int) else 1
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        exit_code = 1
+    wall = time.perf_counter() - start
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    #ru_maxrss is in kilobytes on Linux
+    results.put({
+        "wall": wall,
+        "cpu": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        "rss": own.ru_maxrss / 1024.0,
+        "tool_rss": children.ru_maxrss / 1024.0,
+        "exit_code": exit_code,
+    })
+
+
+def run_stage(stage, folders, threads, log_path):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    child = context.Process(target=measure, args=(stage, folders, threads, log_path, results))
+    child.start()
+    child.join()
+    if results.empty():
+        return {"wall": float("nan"), "cpu": float("nan"), "rss": float("nan"), "tool_rss": float("nan"), "exit_code": child.exitcode}
+    return results.get()
+
+
+def stages_to_run(stages):
+    # codeml needs the trees and codon alignments. Without run_codeml, the LRT
+    # and summary stages read synthetic codeml outputs instead.
+    needed = set(stages)
+    if "run_codeml" in needed:
+        needed.update(["gene_trees", "codon_alignment"])
+    return [stage for stage in STAGE_ORDER if stage in needed]
+
+
+def scaling(rows, stage):
+    # Least-squares fit of log(wall time) = a + b1 log(genomes) + b2 log(genes) + b3 log(codons)
+    # over the median time of every scale. Only dimensions that vary are fitted,
+    # and only when there are at least as many scales as coefficients.
+    by_scale = dict()
+    for row in rows:
+        if row["Stage"] == stage and row["Exit code"] == 0:
+            by_scale.setdefault((row["Genomes"], row["Genes"], row["Codons"]), list()).append(row["Wall (s)"])
+    if len(by_scale) < 2:
+        return None
+    sizes = np.log(np.array(list(by_scale.keys()), dtype=float))
+    times = np.log(np.maximum([np.median(values) for values in by_scale.values()], 1e-6))
+    varying = [dimension for dimension in range(3) if np.ptp(sizes[:, dimension]) > 0]
+    exponents = dict()
+    design = np.column_stack([np.ones(len(times))] + [sizes[:, dimension] for dimension in varying])
+    if np.linalg.matrix_rank(design) == design.shape[1]:
+        coefficients = np.linalg.lstsq(design, times, rcond=None)[0]
+        exponents = dict((["genomes", "genes", "codons"][dimension], coefficients[k + 1]) for k, dimension in enumerate(varying))
+    total = np.polyfit(sizes.sum(axis=1), times, 1)[0]
+    return exponents, total
+
+
+def main(argv=None):
+    args_parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO:\nBenchmarks the pipeline stages on synthetic genomes, with stand-in tools (benchmarks/bin) instead of Prodigal, MAFFT, FastTree and codeml.\nReports the wall time, CPU time and peak memory of every stage at every scale, then how each stage scales with the number of genomes, core genes and codons per gene.")
+    args_parser.add_argument('-s', '--scale', required=False, action='append', type=parse_scale, help='Input size as GENOMESxGENESxCODONS, e.g. -s 8x50x300. Can be given several times. Default is ' + " ".join("-s " + scale for scale in DEFAULT_SCALES) + '.')
+    args_parser.add_argument('--stages', required=False, default=",".join(STAGE_ORDER), help='Comma-separated stages to time. Default is all of them: ' + ",".join(STAGE_ORDER) + '.')
+    args_parser.add_argument('-t', '--threads', required=False, type=int, default=1, help='Cores given to each stage. Default is 1.')
+    args_parser.add_argument('-r', '--repeat', required=False, type=int, default=1, help='How many times to time each stage at each scale. The median is used for scaling. Default is 1.')
+    args_parser.add_argument('-o', '--output', required=False, help='Write the timings as a tab-separated table to this file. Default is the screen.')
+    args_parser.add_argument('-w', '--workdir', required=False, help='Folder for the synthetic data and stage logs. Default is a temporary folder, removed at the end.')
+    args_parser.add_argument('--real_tools', required=False, action='store_true', help='Use the tools on your PATH instead of the stand-ins.')
+    args = args_parser.parse_args(argv)
+
+    scales = args.scale or [parse_scale(scale) for scale in DEFAULT_SCALES]
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    for stage in stages:
+        if stage not in STAGE_ORDER:
+            sys.exit('Error: unknown stage ' + stage + '. Stages are: ' + ", ".join(STAGE_ORDER))
+    if not args.real_tools:
+        os.environ["PATH"] = os.path.join(BENCHMARK_DIR, "bin") + os.pathsep + os.environ.get("PATH", "")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dnds_benchmark.")
+
+    rows = list()
+    try:
+        for genomes, genes, length in scales:
+            scale = str(genomes) + "x" + str(genes) + "x" + str(length)
+            scale_dir = os.path.join(workdir, scale)
+            shutil.rmtree(scale_dir, ignore_errors=True)
+            print("Generating", scale, "(genomes x core genes x codons)", file=sys.stderr)
+            genome_dir, prodigal_dir, core_dir = generate(scale_dir, genomes, genes, length)
+            folders = (genome_dir, prodigal_dir, core_dir, scale_dir)
+            run = stages_to_run(stages)
+            if "run_codeml" not in run and ("lrt_test" in run or "parse_dnds" in run):
+                codeml_outputs(core_dir, HYPOTHESES)
+
+            for stage in run:
+                for repeat in range(1, args.repeat + 1):
+                    log_path = os.path.join(scale_dir, stage + "." + str(repeat) + ".log")
+                    result = run_stage(stage, folders, args.threads, log_path)
+                    rows.append({"Scale": scale, "Genomes": genomes, "Genes": genes, "Codons": length, "Stage": stage, "Repeat": repeat,
+                        "Wall (s)": result["wall"], "CPU (s)": result["cpu"], "Peak RSS (MB)": result["rss"], "Peak tool RSS (MB)": result["tool_rss"], "Exit code": result["exit_code"]})
+                    print(scale, stage, "run", repeat, "took", round(result["wall"], 3), "s" + ("" if result["exit_code"] == 0 else ", failed (see " + log_path + ")"), file=sys.stderr)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    table = ["\t".join(COLUMNS)]
+    for row in rows:
+        table.append("\t".join(str(round(row[column], 3)) if isinstance(row[column], float) else str(row[column]) for column in COLUMNS))
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write("\n".join(table) + "\n")
+    else:
+        print("\n".join(table))
+
+    print("\nScaling (wall time ~ size^exponent):")
+    for stage in STAGE_ORDER:
+        fit = scaling(rows, stage)
+        if fit is None:
+            continue
+        exponents, total = fit
+        print(stage + ":", "".join(dimension + " " + str(round(exponent, 2)) + ", " for dimension, exponent in exponents.items()) + "total codons (genomes x genes x codons) " + str(round(total, 2)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# Synthetic inputs for the benchmarks: genomes, their Prodigal output, a
+# CoreCruncher-style core set and codeml outputs, at any scale. The stand-in
+# tools in benchmarks/bin use the same gene calling and codeml report code, so
+# a benchmark run sees the files the real pipeline would see.
+
+import argparse
+import os
+import random
+import re
+
+STOPS = ("TAA", "TAG", "TGA")
+SENSE_CODONS = [a + b + c for a in "ACGT" for b in "ACGT" for c in "ACGT" if a + b + c not in STOPS]
+CODE = dict(zip([a + b + c for a in "TCAG" for b in "TCAG" for c in "TCAG"], "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"))
+# No ATG can start in a spacer, or across a stop codon and a spacer.
+SPACER = "CCCCCCCCCCCC"
+
+
+def translate(cds):
+    return "".join(CODE.get(cds[i:i + 3], "X") for i in range(0, len(cds) - 2, 3))
+
+
+def read_fasta(path):
+    records = list()
+    with open(path) as handle:
+        for line in handle:
+            line = line.rstrip()
+            if line.startswith(">"):
+                records.append([line[1:], []])
+            elif records:
+                records[-1][1].append(line)
+    return [(header, "".join(chunks)) for header, chunks in records]
+
+
+def call_genes(sequence, min_codons=30):
+    # Forward-strand ORFs, ATG to the first in-frame stop, as (start, end)
+    # 1-based coordinates including the stop codon.
+    genes = list()
+    position = sequence.find("ATG")
+    while position != -1:
+        end = None
+        for codon in range(position, len(sequence) - 2, 3):
+            if sequence[codon:codon + 3] in STOPS:
+                end = codon + 3
+                break
+        if end is None:
+            break
+        if (end - position) // 3 > min_codons:
+            genes.append((position + 1, end))
+            position = sequence.find("ATG", end)
+        else:
+            position = sequence.find("ATG", position + 1)
+    return genes
+
+
+def write_prodigal(genome_fasta, prot, nucl):
+    # Same file names and headers as Prodigal -a/-d: <contig>_<n> # start # end # strand # ...
+    with open(prot, "w") as proteins, open(nucl, "w") as genes:
+        for header, sequence in read_fasta(genome_fasta):
+            contig = header.split()[0]
+            for number, (start, end) in enumerate(call_genes(sequence), 1):
+                cds = sequence[start - 1:end]
+                name = contig + "_" + str(number) + " # " + str(start) + " # " + str(end) + " # 1 # ID=1_" + str(number)
+                genes.write(">" + name + "\n" + cds + "\n")
+                proteins.write(">" + name + "\n" + translate(cds) + "\n")
+
+
+def caterpillar_tree(names, ingroup=None, lengths=True):
+    def tip(name):
+        label = name + " #1" if name == ingroup else name
+        return label + (":0.1" if lengths else "")
+    tree = "(" + tip(names[0]) + "," + tip(names[1]) + ")"
+    for name in names[2:-1]:
+        tree = "(" + tree + (":0.05" if lengths else "") + "," + tip(name) + ")"
+    if len(names) > 2:
+        tree = "(" + tree[1:-1] + "," + tip(names[-1]) + ")"
+    return tree + ";"
+
+
+def codeml_report(out, seqfile, names, sequences, tree, model, rng, lnl_offset=0.0):
+    # A codeml output file with every section the parser reads: site pattern
+    # counts, lnL, the trees, kappa, omega(s), the branch table and dN/dS tree lengths.
+    n_taxa = len(names)
+    n_codons = len(sequences[0]) // 3
+    columns = [tuple(sequence[3 * codon:3 * codon + 3] for sequence in sequences) for codon in range(n_codons)]
+    counts = dict()
+    for column in columns:
+        counts[column] = counts.get(column, 0) + 1
+    patterns = sorted(counts)
+    labels = re.sub(r"\s*#\d+", "", re.sub(r":[0-9.eE-]+", "", tree))
+
+    out.write("CODONML (in paml version 4.9j, February 2020)  " + seqfile + "\n")
+    out.write("Model: " + ("One dN/dS ratio, " if model == 0 else "several dN/dS ratios for branches, ") + "\n")
+    out.write("Codon frequency model: F1x4\nns = %4d  ls = %4d\n\n" % (n_taxa, n_codons))
+    out.write("Printing out site pattern counts\n\n\n%10d %10d  P\n\n" % (n_taxa, len(patterns) * 3))
+    for k, name in enumerate(names):
+        cells = list()
+        for pattern in patterns:
+            if k == 0:
+                cells.append(pattern[0])
+            else:
+                cells.append("".join("." if a == b else a for a, b in zip(pattern[k], pattern[0])))
+        out.write("%-20s%s\n" % (name, " ".join(cells)))
+    out.write("\n" + "    ".join(str(counts[pattern]) for pattern in patterns) + "\n\n")
+
+    lnl = -rng.uniform(0.5, 5.0) * n_codons * n_taxa + (rng.uniform(0, 3) if model else 0.0) + lnl_offset
+    n_branches = 2 * n_taxa - 3
+    out.write("TREE #  1:  " + labels + "   MP score: -1\n")
+    out.write("lnL(ntime: %2d  np: %2d):  %.6f      +0.000000\n" % (n_branches, n_branches + 2 + (1 if model else 0), lnl))
+    named = re.sub(r"([^(),;\s]+|\))(?=[,)])", lambda match: "%s: %.5f" % (match.group(1), rng.uniform(0.01, 0.2)), labels)
+    numbered = named
+    for k, name in enumerate(names):
+        numbered = re.sub(r"(?<=[(,])%s:" % re.escape(name), "%d:" % (k + 1), numbered)
+    out.write("\ntree length =   %.5f\n\n%s\n\n%s\n\n" % (0.1 * n_branches, numbered, named))
+
+    kappa = rng.uniform(1.5, 4.5)
+    omegas = [rng.uniform(0.01, 0.3) for _ in range(2)]
+    out.write("Detailed output identifying parameters\n\nkappa (ts/tv) =  %.5f\n\n" % kappa)
+    if model == 0:
+        out.write("omega (dN/dS) =  %.5f\n\n" % omegas[0])
+    else:
+        out.write("w (dN/dS) for branches:  %.5f %.5f\n\n" % tuple(omegas))
+    out.write("dN & dS for each branch\n\n branch          t       N       S   dN/dS      dN      dS  N*dN  S*dS\n\n")
+    total_dn = total_ds = 0.0
+    sites = n_codons * 3
+    for branch in range(n_branches):
+        dn, ds = rng.uniform(0, 0.05), rng.uniform(0, 0.5)
+        total_dn += dn
+        total_ds += ds
+        n = sites * 0.75
+        out.write("  %3d..%-3d   %6.3f %7.1f %7.1f  %6.4f  %6.4f  %6.4f  %5.1f  %5.1f\n" % (n_taxa + 1, branch + 1, dn + ds, n, sites - n, omegas[0], dn, ds, n * dn, (sites - n) * ds))
+    out.write("\ntree length for dN:       %.4f\ntree length for dS:       %.4f\n" % (total_dn, total_ds))
+
+
+def mutate(gene, rate, indel_rate, rng):
+    # Codon substitutions (never to a stop codon, never in the start codon) and codon deletions.
+    codons = [gene[i:i + 3] for i in range(0, len(gene), 3)]
+    body = list()
+    for codon in codons[1:-1]:
+        if rng.random() < indel_rate:
+            continue
+        if rng.random() < rate:
+            codon = rng.choice(SENSE_CODONS)
+        body.append(codon)
+    return "".join([codons[0]] + body + [codons[-1]])
+
+
+def generate(output, genomes, genes, length, rate=0.05, indel_rate=0.002, seed=1):
+    # Writes <output>/genomes (genome FASTAs), <output>/prodigal (their gene
+    # calls) and <output>/core (one <family>.faa per core gene, records named
+    # <genome>.faa&<protein> as in CoreCruncher's output). Every gene is
+    # `length` codons long, start and stop codons included.
+    rng = random.Random(seed)
+    genome_dir = os.path.join(output, "genomes")
+    prodigal_dir = os.path.join(output, "prodigal")
+    core_dir = os.path.join(output, "core")
+    for folder in (genome_dir, prodigal_dir, core_dir):
+        os.makedirs(folder, exist_ok=True)
+
+    ancestors = ["ATG" + "".join(rng.choice(SENSE_CODONS) for _ in range(length - 2)) + rng.choice(STOPS) for _ in range(genes)]
+    families = [list() for _ in range(genes)]
+    for number in range(genomes):
+        genome = "G" + str(number)
+        contig = genome + "_c"
+        sequence = SPACER + SPACER.join(mutate(gene, rate, indel_rate, rng) for gene in ancestors) + SPACER
+        with open(os.path.join(genome_dir, genome + ".fna"), "w") as out:
+            out.write(">" + contig + "\n")
+            for start in range(0, len(sequence), 80):
+                out.write(sequence[start:start + 80] + "\n")
+        write_prodigal(os.path.join(genome_dir, genome + ".fna"), os.path.join(prodigal_dir, genome + ".faa"), os.path.join(prodigal_dir, genome + ".genes.fna"))
+        for family, (header, protein) in zip(families, read_fasta(os.path.join(prodigal_dir, genome + ".faa"))):
+            family.append((genome + ".faa&" + header.split()[0], protein))
+
+    for number, family in enumerate(families):
+        with open(os.path.join(core_dir, "fam" + str(number) + ".faa"), "w") as out:
+            for name, protein in family:
+                out.write(">" + name + "\n" + protein + "\n")
+    return genome_dir, prodigal_dir, core_dir
+
+
+def codeml_outputs(core_dir, hypotheses, ingroup="G1", seed=1):
+    # Writes a codeml output (<family><extension>) for every core gene and
+    # (model, NSsites, extension) hypothesis, as if run_codeml had run.
+    rng = random.Random(seed)
+    for file in sorted(os.listdir(core_dir)):
+        if not file.endswith(".faa"):
+            continue
+        family = file[:-len(".faa")]
+        records = [(name.split("&")[0].replace(".faa", ""), protein.rstrip("*")) for name, protein in read_fasta(os.path.join(core_dir, file))]
+        names = [name for name, protein in records]
+        n_codons = min(len(protein) for name, protein in records)
+        sequences = ["".join(rng.choice(SENSE_CODONS) if rng.random() < 0.1 else "ATG" for _ in range(n_codons)) for _ in names]
+        tree = caterpillar_tree(names, ingroup, lengths=False)
+        for model, nssites, extension in hypotheses:
+            with open(os.path.join(core_dir, family + extension), "w") as out:
+                codeml_report(out, family + ".pal2nal", names, sequences, tree, model, rng)
+
+
+def main(argv=None):
+    args_parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO:\nWrites synthetic genomes, their gene calls, a CoreCruncher-style core set and, optionally, codeml outputs.")
+    args_parser.add_argument('-o', '--output', required=True, help='Output folder.')
+    args_parser.add_argument('-g', '--genomes', required=False, type=int, default=8, help='Number of genomes. Default is 8.')
+    args_parser.add_argument('-n', '--genes', required=False, type=int, default=50, help='Number of core genes. Default is 50.')
+    args_parser.add_argument('-l', '--length', required=False, type=int, default=300, help='Length of each core gene, in codons. Default is 300.')
+    args_parser.add_argument('--rate', required=False, type=float, default=0.05, help='Substitution rate per codon. Default is 0.05.')
+    args_parser.add_argument('--indel_rate', required=False, type=float, default=0.002, help='Deletion rate per codon. Default is 0.002.')
+    args_parser.add_argument('--codeml', required=False, action='store_true', help='Also write .null and .alt codeml outputs for every core gene.')
+    args_parser.add_argument('--seed', required=False, type=int, default=1, help='Random seed. Default is 1.')
+    args = args_parser.parse_args(argv)
+
+    genome_dir, prodigal_dir, core_dir = generate(args.output, args.genomes, args.genes, args.length, args.rate, args.indel_rate, args.seed)
+    if args.codeml:
+        codeml_outputs(core_dir, [(0, "0", ".null"), (2, "0", ".alt")], seed=args.seed)
+    print("Genomes:", genome_dir)
+    print("Prodigal output:", prodigal_dir)
+    print("Core genes:", core_dir)
+
+
+if __name__ == '__main__':
+    main()
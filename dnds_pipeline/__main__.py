@@ -0,0 +1,4 @@
+from dnds_pipeline.cli import main
+
+if __name__ == '__main__':
+    status = main()
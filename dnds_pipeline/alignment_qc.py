@@ -0,0 +1,112 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from dnds_pipeline.paml_io import read_paml, write_paml
+from dnds_pipeline.site_patterns import GAP, load_codons
+
+# Byte -> True for the unambiguous bases.
+BASES = np.zeros(256, dtype=bool)
+BASES[list(b"ACGTU")] = True
+# Columns of the report, after the core gene.
+COLUMNS = ["taxa", "codons", "gap_fraction", "ambiguous_fraction", "effective_codons", "mean_identity", "min_identity", "trimmed_codons", "decision", "reasons"]
+TRIMMED = ".pal2nal.trimmed"
+# (threshold, profile metric, True if the threshold is a minimum)
+CHECKS = [
+    ("max_gap_fraction", "gap_fraction", False),
+    ("max_ambiguous_fraction", "ambiguous_fraction", False),
+    ("min_codons", "effective_codons", True),
+    ("min_identity", "mean_identity", True),
+    ("max_identity", "mean_identity", False),
+]
+
+
+def missing_codons(codons):
+    # (taxa, codons) masks of the gap codons and of the codons with an
+    # ambiguous base (N, R, Y, ...).
+    gaps = (codons == GAP).any(axis=2)
+    ambiguous = ~BASES[codons].all(axis=2) & ~gaps
+    return gaps, ambiguous
+
+
+def pairwise_identity(codons, missing):
+    # Fraction of identical codons between every pair of taxa, over the codon
+    # columns where both have a codon. Returns the mean and the minimum over
+    # the pairs (1 with fewer than two taxa).
+    n_taxa = codons.shape[0]
+    if n_taxa < 2:
+        return 1.0, 1.0
+    values = (codons.astype(np.int64) << np.array([16, 8, 0])).sum(axis=2)
+    present = ~missing
+    identities = list()
+    for taxon in range(n_taxa - 1):
+        shared = present[taxon] & present[taxon + 1:]
+        same = (values[taxon] == values[taxon + 1:]) & shared
+        counts = shared.sum(axis=1)
+        identities.extend(np.where(counts > 0, same.sum(axis=1) / np.maximum(counts, 1), 0.0))
+    return float(np.mean(identities)), float(np.min(identities))
+
+
+def profile(path, trim=None):
+    # Quality profile of one .pal2nal codon alignment. With trim, codon columns
+    # where more than that fraction of the taxa has a gap or an ambiguous codon
+    # are removed first, and the trimmed alignment is written next to the
+    # original (<gene>.pal2nal.trimmed). The profile is then the trimmed one.
+    codons = load_codons(path)
+    gaps, ambiguous = missing_codons(codons)
+    result = {"taxa": codons.shape[0], "codons": codons.shape[1], "trimmed_codons": 0, "alignment": path}
+    if trim is not None and codons.shape[1] > 0:
+        keep = (gaps | ambiguous).mean(axis=0) <= trim
+        result["trimmed_codons"] = int((~keep).sum())
+        if result["trimmed_codons"] > 0:
+            codons, gaps, ambiguous = codons[:, keep], gaps[:, keep], ambiguous[:, keep]
+            trimmed = path[:-len(".pal2nal")] + TRIMMED
+            write_paml([(name, codons[row].tobytes().decode()) for row, (name, sequence) in enumerate(read_paml(path))], trimmed)
+            result["alignment"] = trimmed
+
+    missing = gaps | ambiguous
+    empty = missing.size == 0
+    result["gap_fraction"] = 0.0 if empty else float(gaps.mean())
+    result["ambiguous_fraction"] = 0.0 if empty else float(ambiguous.mean())
+    # The codons codeml keeps with cleandata = 1.
+    result["effective_codons"] = int((~missing).all(axis=0).sum())
+    result["mean_identity"], result["min_identity"] = pairwise_identity(codons, missing)
+    return result
+
+
+def assess(result, thresholds):
+    # Reasons the profiled alignment fails the thresholds (none if it passes).
+    # Thresholds that are missing or None are not checked.
+    reasons = list()
+    for threshold, metric, minimum in CHECKS:
+        limit = thresholds.get(threshold)
+        if limit is None:
+            continue
+        value = result[metric]
+        if (minimum and value < limit) or (not minimum and value > limit):
+            reasons.append(metric + " " + str(round(value, 4)) + (" < " if minimum else " > ") + str(limit))
+    return reasons
+
+
+def profile_alignments(paths, trim=None, jobs=1):
+    # profile() of many alignments, spread over a pool of `jobs` processes.
+    # Results come back in the same order as the paths.
+    paths = list(paths)
+    if jobs <= 1 or len(paths) < 2:
+        return [profile(path, trim) for path in paths]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(profile, paths, [trim] * len(paths), chunksize=max(1, len(paths) // (jobs * 8))))
+
+
+def write_report(rows, path):
+    # rows are (core gene, profile with its decision and reasons) pairs.
+    with open(path, "w") as out:
+        out.write("\t".join(["core_gene"] + COLUMNS) + "\n")
+        for core_gene, result in rows:
+            cells = [core_gene]
+            for column in COLUMNS:
+                value = result[column]
+                if column == "reasons":
+                    value = "; ".join(value) or "NA"
+                cells.append(str(round(value, 4)) if isinstance(value, float) else str(value))
+            out.write("\t".join(cells) + "\n")
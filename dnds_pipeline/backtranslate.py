@@ -0,0 +1,80 @@
+import numpy as np
+
+# Standard genetic code (codeml icode = 0), codons in TCAG order: TTT, TTC, TTA, TTG, TCT, ...
+BASES = b"TCAG"
+CODE = np.frombuffer(b"FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG", dtype=np.uint8)
+START_CODONS = (b"ATG", b"GTG", b"TTG", b"CTG", b"ATT", b"ATC", b"ATA")
+GAP = ord("-")
+STOP = ord("*")
+UNKNOWN = ord("X")
+
+# Byte -> base index (0-3), 4 for anything that is not an unambiguous base.
+BASE_INDEX = np.full(256, 4, dtype=np.uint8)
+for index, base in enumerate(BASES):
+    BASE_INDEX[base] = index
+    BASE_INDEX[base + 32] = index
+BASE_INDEX[ord("U")] = BASE_INDEX[ord("u")] = 0
+
+
+def as_bytes(sequence):
+    return np.frombuffer(sequence.upper().encode(), dtype=np.uint8)
+
+
+def translate(codons):
+    # Translates an (n, 3) array of codon bytes. Codons with an ambiguous base give X.
+    index = BASE_INDEX[codons]
+    ambiguous = (index == 4).any(axis=1)
+    index = index.astype(np.intp)
+    amino_acids = CODE[(index[:, 0] * 16 + index[:, 1] * 4 + index[:, 2]) & 63]
+    return np.where(ambiguous, UNKNOWN, amino_acids).astype(np.uint8)
+
+
+def back_translate(name, protein, cds):
+    # Puts the codons of `cds` under the residues of the aligned `protein`.
+    # Returns an (alignment length, 3) array of codon bytes, "---" under gaps.
+    # Raises ValueError if the CDS does not encode the protein. A start codon
+    # read as M, an X in the protein and codons with ambiguous bases are
+    # accepted, like PAL2NAL does.
+    protein = as_bytes(protein)
+    residues = protein != GAP
+    n_residues = int(residues.sum())
+    cds = as_bytes(cds)
+    n_codons = len(cds) // 3
+    if n_codons < n_residues:
+        raise ValueError(name + ": the CDS has " + str(n_codons) + " codons for " + str(n_residues) + " residues.")
+    #A trailing stop codon missing from the protein is simply left out
+    codons = cds[:3 * n_residues].reshape(n_residues, 3)
+
+    expected = protein[residues]
+    translated = translate(codons)
+    agree = (translated == expected) | (expected == UNKNOWN) | (translated == UNKNOWN)
+    if n_residues > 0 and not agree[0] and expected[0] == ord("M") and codons[0].tobytes() in START_CODONS:
+        agree[0] = True
+    if not agree.all():
+        mismatches = np.flatnonzero(~agree)
+        raise ValueError(name + ": protein and CDS disagree at residue(s) " + ", ".join(str(i + 1) for i in mismatches[:10]) + (" ..." if len(mismatches) > 10 else "") + ".")
+
+    aligned = np.full((len(protein), 3), GAP, dtype=np.uint8)
+    aligned[residues] = codons
+    return aligned
+
+
+def align_codons(proteins, cds):
+    # Codon alignment of the aligned proteins (a list of (name, aligned
+    # sequence)), with the CDS of each one taken from the `cds` dict by name.
+    # As with PAL2NAL -nogap, codon columns with a gap or a stop codon in any
+    # sequence are removed. Returns a list of (name, codon sequence).
+    if len(proteins) == 0:
+        return []
+    missing = [name for name, sequence in proteins if name not in cds]
+    if len(missing) > 0:
+        raise ValueError("No CDS for: " + ", ".join(missing) + ".")
+    lengths = set(len(sequence) for name, sequence in proteins)
+    if len(lengths) > 1:
+        raise ValueError("The aligned proteins do not all have the same length.")
+
+    codons = np.stack([back_translate(name, sequence, cds[name]) for name, sequence in proteins])
+    columns = np.stack([as_bytes(sequence) for name, sequence in proteins])
+    keep = ~((columns == GAP) | (columns == STOP)).any(axis=0)
+    kept = codons[:, keep]
+    return [(name, kept[row].tobytes().decode()) for row, (name, sequence) in enumerate(proteins)]
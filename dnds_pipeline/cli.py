@@ -0,0 +1,175 @@
+import argparse
+import contextlib
+import importlib
+import os
+import sys
+import time
+
+from dnds_pipeline.layout import LAYOUTS
+from dnds_pipeline.options import parse_hypothesis, parse_pair, parse_shard, quality_thresholds
+
+# The numbered scripts live next to this package. Their stage functions are
+# imported only when their stage runs, so starting the driver does not pay for
+# Biopython, NumPy or SciPy up front.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+STAGES = {
+    "predict_proteins": ("1_predict_proteins_prodigal", "predict_proteins"),
+    "gene_trees": ("2_generate_gene_trees_core_genome", "gene_trees"),
+    "codon_alignment": ("3_create_codon_alignments", "codon_alignment"),
+    "run_codeml": ("4_estimate_omega_core_genes", "run_codeml"),
+    "lrt_test": ("5_LRT_test_omega", "lrt_test"),
+    "parse_dnds": ("6_parse_raw_codeml_files", "parse_dnds"),
+}
+STAGE_ORDER = ["predict_proteins", "gene_trees", "codon_alignment", "run_codeml", "lrt_test", "parse_dnds"]
+DEFAULT_STAGES = STAGE_ORDER[1:]
+
+
+def stage_function(stage):
+    module, function = STAGES[stage]
+    return getattr(importlib.import_module(module), function)
+
+
+def parse_stages(text):
+    stages = [stage.strip() for stage in text.split(",") if stage.strip()]
+    for stage in stages:
+        if stage not in STAGES:
+            raise argparse.ArgumentTypeError("Unknown stage " + stage + ". Stages are: " + ", ".join(STAGE_ORDER))
+    return [stage for stage in STAGE_ORDER if stage in stages]
+
+
+def run(args):
+    stages = args.stages
+    hypotheses = args.hypothesis or [(0, "0", ".null"), (2, "0", ".alt")]
+    pairs = args.pair or [(".null", ".alt", 1)]
+    os.makedirs(args.output, exist_ok=True)
+
+    for stage, needed in [("predict_proteins", ["genome_fasta", "genomes"]), ("gene_trees", ["genomes", "ingroup_branch"]), ("codon_alignment", ["ingroup_branch"] if args.codon_trees else [])]:
+        if stage in stages:
+            for option in needed:
+                if getattr(args, option) is None:
+                    sys.exit("Error: --" + option + " is required to run " + stage + ".")
+    if args.codon_trees and args.species_tree is not None:
+        sys.exit("Error: use either --codon_trees or --species_tree.")
+    if args.retries < 0 or args.starts < 1:
+        sys.exit("Error: --retries must be 0 or more, and --starts 1 or more.")
+    if args.shard is not None:
+        for stage in ["predict_proteins", "lrt_test", "parse_dnds"]:
+            if stage in stages:
+                sys.exit("Error: " + stage + " cannot run on a shard. Run it once every shard is done (-s " + stage + ").")
+
+    if not args.no_check:
+        preflight_check(args, stages)
+
+    # The CoreCruncher core set is read once and shared by the stages that need it.
+    core_set = None
+    if "gene_trees" in stages or "codon_alignment" in stages:
+        from dnds_pipeline.core_set import CoreSet
+        core_set = CoreSet(args.core)
+
+    for stage in stages:
+        start = time.time()
+        print("### Starting stage", stage)
+        function = stage_function(stage)
+        if stage == "predict_proteins":
+            function(args.genome_fasta, args.genomes, args.quiet, args.threads, args.force)
+        elif stage == "gene_trees":
+            function(args.core, args.genomes, args.ingroup_branch, args.quiet, args.threads, args.force, core_set, args.codon_trees, args.shard, args.species_tree, args.layout)
+        elif stage == "codon_alignment":
+            function(args.core, args.quiet, args.threads, args.force, core_set, args.ingroup_branch, args.codon_trees, args.shard, args.layout)
+        elif stage == "run_codeml":
+            function(args.core, None, None, None, args.clean, args.rubbish, args.force, args.threads, args.tmp, hypotheses, not args.no_warm_start, args.shard, False, quality_thresholds(args), args.compress, args.timeout_factor, args.min_timeout, args.retries, args.starts, args.sqlite_wal)
+        elif stage == "lrt_test":
+            with open(os.path.join(args.output, "lrt.tsv"), "w") as table, contextlib.redirect_stdout(table):
+                function(args.core, None, None, None, args.alpha, args.force, args.threads, pairs, args.method)
+        elif stage == "parse_dnds":
+            for model, nssites, extension in hypotheses:
+                function(args.core, os.path.join(args.output, extension.lstrip(".") + "_codeml_summary"), extension, args.force, args.threads)
+        print("### Finished stage", stage, "in", round(time.time() - start, 2), "seconds")
+
+
+def preflight_check(args, stages):
+    from dnds_pipeline.preflight import preflight, report
+    start = time.time()
+    count = report(preflight(args.core, args.genomes, args.ingroup_branch, stages, args.codon_trees, args.species_tree, args.shard, args.layout))
+    if count > 0:
+        sys.exit("Error: the pre-flight check found " + str(count) + " problem(s), nothing was run.")
+    print("### Pre-flight check passed in", round(time.time() - start, 2), "seconds")
+
+
+def check(args):
+    if args.codon_trees and args.species_tree is not None:
+        sys.exit("Error: use either --codon_trees or --species_tree.")
+    preflight_check(args, args.stages)
+
+
+def telemetry(args):
+    from dnds_pipeline.telemetry import summarize, telemetry_files
+    if len(telemetry_files(args.path)) == 0:
+        sys.exit("Error: no telemetry found in " + args.path + ".")
+    summarize(args.path, args.top)
+
+
+def main(argv=None):
+    args_parser = argparse.ArgumentParser(prog="dnds-pipeline", formatter_class=argparse.RawDescriptionHelpFormatter, description="INFO:\nRuns the workflow stages one after the other in a single process.\nCoreCruncher still has to be run between predict_proteins and gene_trees.", epilog='*******************************************************************\n\n*******************************************************************\n\nMake sure you cite Prodigal, MAFFT, FastTree, PAL2NAL, PAML and our book chapter!')
+    subparsers = args_parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Run the pipeline stages in one process.")
+    run_parser.add_argument('-c', '--core', required=True, help='Core genome folder (CoreCruncher output). All per-gene files are written here.')
+    run_parser.add_argument('-g', '--genomes', required=False, help='Folder with the Prodigal output files (.genes.fna). Output folder of predict_proteins.')
+    run_parser.add_argument('--genome_fasta', required=False, help='Folder with the genome files (.fna). Only needed for predict_proteins.')
+    run_parser.add_argument('-ib', '--ingroup_branch', required=False, help='Ingroup branch, written exactly as it appears in your tree. Needed for gene_trees.')
+    run_parser.add_argument('-o', '--output', required=True, help='Folder for the LRT table (lrt.tsv) and the codeml summaries (one <extension>_codeml_summary folder per hypothesis).')
+    run_parser.add_argument('-s', '--stages', required=False, type=parse_stages, default=DEFAULT_STAGES, help='Comma-separated stages to run, out of ' + ", ".join(STAGE_ORDER) + '. Default is every stage after CoreCruncher.')
+    run_parser.add_argument('-H', '--hypothesis', required=False, action='append', type=parse_hypothesis, help='codeml hypothesis as MODEL:NSSITES:EXTENSION, from the simplest to the most complex. Default is -H 0:0:.null -H 2:0:.alt.')
+    run_parser.add_argument('-p', '--pair', required=False, action='append', type=parse_pair, help='Hypothesis pair for the LRT as NULL:ALTERNATIVE:DF. Default is -p .null:.alt:1.')
+    run_parser.add_argument('--codon_trees', required=False, action='store_true', help='Build the gene trees from the codon alignments instead of a separate nucleotide MAFFT alignment.')
+    run_parser.add_argument('--species_tree', required=False, help='Prune this species tree (Newick) to the taxa of each core gene instead of building a gene tree with MAFFT and FastTree.')
+    run_parser.add_argument('--layout', required=False, choices=LAYOUTS, help='Where to write the per-gene files: flat (all in the core folder) or genes (one folder per gene under <core>/genes/). Default is the layout of the previous run, or flat.')
+    run_parser.add_argument('-t', '--threads', required=False, type=int, default=1, help='Number of cores every stage can use. Default is 1.')
+    run_parser.add_argument('-q', '--quiet', required=False, type=int, default=1, help='Run Prodigal and MAFFT quietly? yes? use 0, no? use 1. Default is 1.')
+    run_parser.add_argument('--clean', required=False, default=0, help='codeml cleandata option. Default is 0.')
+    run_parser.add_argument('-r', '--rubbish', required=False, type=int, default=0, help='From 0 to 3, how much codeml rubbish do you want on your screen? Default is 0.')
+    run_parser.add_argument('--tmp', required=False, default=None, help='Folder for the scratch directory of each codeml run. Default is the system temporary folder.')
+    run_parser.add_argument('--no_warm_start', required=False, action='store_true', help='Start every codeml model from scratch instead of from the estimates of the previous one.')
+    run_parser.add_argument('--compress', required=False, action='store_true', help='gzip-compress the codeml output files as they are written, keeping their names.')
+    run_parser.add_argument('--timeout_factor', required=False, type=float, help='Kill a codeml run that takes more than this many times its predicted time, which scales with the size of its alignment. Needs codeml timings from a previous run in the core folder telemetry. No time limit by default.')
+    run_parser.add_argument('--min_timeout', required=False, type=float, default=60, help='Shortest time limit given to a codeml run with --timeout_factor, in seconds. Default is 60.')
+    run_parser.add_argument('--retries', required=False, type=int, default=0, help='Fit a model again, from other starting omega and kappa values and with twice the time limit, when its codeml runs all failed or timed out, up to this many times. Default is 0.')
+    run_parser.add_argument('--starts', required=False, type=int, default=1, help='Fit every codeml model from this many starting omega and kappa values at the same time, and keep the best lnL. Default is 1.')
+    run_parser.add_argument('--sqlite_wal', required=False, action='store_true', help='Use SQLite write-ahead logging for the results database. Only when every process using the core folder runs on the same host.')
+    run_parser.add_argument('--max_gap_fraction', required=False, type=float, help='Skip core genes whose codon alignment has more than this fraction of gap codons. Not checked by default.')
+    run_parser.add_argument('--max_ambiguous_fraction', required=False, type=float, help='Skip core genes whose codon alignment has more than this fraction of codons with ambiguous bases. Not checked by default.')
+    run_parser.add_argument('--min_codons', required=False, type=int, help='Skip core genes with fewer codon columns free of gaps and ambiguous bases than this. Not checked by default.')
+    run_parser.add_argument('--min_identity', required=False, type=float, help='Skip core genes whose sequences share less than this mean fraction of identical codons. Not checked by default.')
+    run_parser.add_argument('--max_identity', required=False, type=float, help='Skip core genes whose sequences share more than this mean fraction of identical codons. Not checked by default.')
+    run_parser.add_argument('--trim_columns', required=False, type=float, help='Before the checks, remove codon columns where more than this fraction of the sequences has a gap or an ambiguous codon. Not done by default.')
+    run_parser.add_argument('--qc_action', required=False, default="skip", choices=["skip", "flag"], help='Skip the core genes that fail the quality thresholds, or only flag them in alignment_qc.tsv. Default is skip.')
+    run_parser.add_argument('-alpha', '--alpha', required=False, type=float, default=0.05, help='Alpha value for P-values correction. Default is 0.05.')
+    run_parser.add_argument('-m', '--method', required=False, default="bonferroni", choices=["bonferroni", "fdr_bh", "fdr_by"], help='P-value correction method. Default is bonferroni.')
+    run_parser.add_argument('--shard', required=False, type=parse_shard, help='Only run one share of the core genes through gene_trees, codon_alignment and run_codeml, given as INDEX/COUNT (e.g., --shard $SLURM_ARRAY_TASK_ID/8 with --array=1-8).')
+    run_parser.add_argument('--force', required=False, action='store_true', help='Redo every stage, even for outputs that are up to date.')
+    run_parser.add_argument('--no_check', required=False, action='store_true', help='Skip the pre-flight check of the inputs and tools (see dnds-pipeline check).')
+    run_parser.set_defaults(handler=run)
+
+    check_parser = subparsers.add_parser("check", help="Check the inputs and tools of the stages without running anything.")
+    check_parser.add_argument('-c', '--core', required=True, help='Core genome folder (CoreCruncher output).')
+    check_parser.add_argument('-g', '--genomes', required=False, help='Folder with the Prodigal output files (.genes.fna). Needed to check the CDS of the core proteins.')
+    check_parser.add_argument('-ib', '--ingroup_branch', required=False, help='Ingroup branch, checked to be one of the genomes of every core gene.')
+    check_parser.add_argument('-s', '--stages', required=False, type=parse_stages, default=DEFAULT_STAGES, help='Comma-separated stages to check for, out of ' + ", ".join(STAGE_ORDER) + '. Default is every stage after CoreCruncher.')
+    check_parser.add_argument('--codon_trees', required=False, action='store_true', help='The gene trees will be built from the codon alignments.')
+    check_parser.add_argument('--species_tree', required=False, help='The species tree the gene trees will be pruned from. Its tips are checked against the genomes.')
+    check_parser.add_argument('--layout', required=False, choices=LAYOUTS, help='Where step 2 wrote the per-gene files, for a codon_alignment check without gene_trees. Default is the layout of the previous run, or flat.')
+    check_parser.add_argument('--shard', required=False, type=parse_shard, help='Only check the .fna files of one share of the core genes, given as INDEX/COUNT, for a codon_alignment check without gene_trees.')
+    check_parser.set_defaults(handler=check)
+
+    telemetry_parser = subparsers.add_parser("telemetry", help="Summarize the telemetry of the stages run in a folder.")
+    telemetry_parser.add_argument('path', help='Folder with a .dnds_telemetry.jsonl file (e.g., the core folder, or the Prodigal output folder), or the file itself.')
+    telemetry_parser.add_argument('-n', '--top', required=False, type=int, default=10, help='How many of the slowest and largest genes to list. Default is 10.')
+    telemetry_parser.set_defaults(handler=telemetry)
+
+    args = args_parser.parse_args(argv)
+    args.handler(args)
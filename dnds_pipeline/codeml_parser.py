@@ -0,0 +1,113 @@
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from dnds_pipeline.compression import open_text
+
+LNL_LINE = re.compile(r"lnL\(ntime:\s*(\d+)\s+np:\s*(\d+)\):\s*(\S+)")
+
+
+def parse_codeml(path):
+    # Reads a codeml output file once, line by line, and returns everything the
+    # LRT and summary stages need. Parameter values are kept as printed by
+    # codeml (strings), except lnL (float) and ntime/np (int). If a value is
+    # printed more than once, the last one wins.
+    #
+    #   lnL, ntime, np     from the "lnL(ntime: .. np: ..):" line
+    #   kappa, omega       "kappa (ts/tv) =" and "omega (dN/dS) =" lines
+    #   omegas             "w (dN/dS) for branches:" line (branch models)
+    #   tree_length, trees "tree length =" and the trees printed after it
+    #                      (with branch numbers, then with taxon names)
+    #   total_dN, total_dS "tree length for dN:" / "tree length for dS:"
+    #   branch_header, branches   the "dN & dS for each branch" table
+    #   num_seq, num_sites, poly_positions   the site pattern counts printout
+    result = {
+        "file": path,
+        "lnL": None, "ntime": None, "np": None,
+        "kappa": None, "omega": None, "omegas": None,
+        "tree_length": None, "trees": [],
+        "total_dN": None, "total_dS": None,
+        "branch_header": None, "branches": [],
+        "num_seq": None, "num_sites": None, "poly_positions": set(),
+    }
+
+    # All state is local to this file.
+    just_printed_sites = False
+    just_parsed_counts = False
+    next_line_is_poly_breakdown = False
+    poly_breakdown_length = None
+    reading_trees = False
+    branch_num_col = None
+
+    with open_text(path) as handle:
+        for line in handle:
+            line_split = line.split()
+            if len(line_split) == 0:
+                continue
+            first = line_split[0]
+
+            if next_line_is_poly_breakdown:
+                if len(line_split) == poly_breakdown_length:
+                    all_pos = "".join(line_split[1:])
+                    result["poly_positions"].update(i for i, x in enumerate(all_pos) if x != ".")
+                    continue
+                next_line_is_poly_breakdown = False
+
+            if reading_trees:
+                if first.startswith("("):
+                    result["trees"].append(line.strip())
+                    continue
+                reading_trees = False
+
+            if branch_num_col is not None:
+                if len(line_split) == branch_num_col:
+                    result["branches"].append(line_split)
+                    continue
+                branch_num_col = None
+
+            if just_printed_sites:
+                just_printed_sites = False
+                result["num_seq"] = line_split[0]
+                result["num_sites"] = line_split[1] if len(line_split) > 1 else None
+                just_parsed_counts = True
+            elif just_parsed_counts:
+                just_parsed_counts = False
+                next_line_is_poly_breakdown = True
+                poly_breakdown_length = len(line_split)
+            elif line.startswith("Printing out site pattern counts"):
+                just_printed_sites = True
+            elif line.startswith("lnL("):
+                match = LNL_LINE.match(line)
+                if match:
+                    result["ntime"] = int(match.group(1))
+                    result["np"] = int(match.group(2))
+                    result["lnL"] = float(match.group(3))
+            elif first == "kappa" and len(line_split) > 3:
+                result["kappa"] = line_split[3]
+            elif first == "omega" and len(line_split) > 3:
+                result["omega"] = line_split[3]
+            elif line.startswith("w (dN/dS) for branches:"):
+                result["omegas"] = line_split[4:]
+            elif line.startswith("tree length for dN:"):
+                result["total_dN"] = line_split[-1]
+            elif line.startswith("tree length for dS:"):
+                result["total_dS"] = line_split[-1]
+            elif line.startswith("tree length ="):
+                result["tree_length"] = line_split[-1]
+                result["trees"] = []
+                reading_trees = True
+            elif first == "branch":
+                result["branch_header"] = line_split
+                result["branches"] = []
+                branch_num_col = len(line_split)
+
+    return result
+
+
+def parse_files(paths, jobs=1):
+    # Parses many codeml output files, spread over a pool of `jobs` processes.
+    # Results come back in the same order as the paths.
+    paths = list(paths)
+    if jobs <= 1 or len(paths) < 2:
+        return [parse_codeml(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(parse_codeml, paths, chunksize=max(1, len(paths) // (jobs * 8))))
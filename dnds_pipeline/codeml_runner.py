@@ -0,0 +1,228 @@
+import os
+import re
+import shutil
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from Bio import Phylo
+from Bio.Phylo.PAML import codeml
+
+from dnds_pipeline.codeml_parser import parse_codeml
+from dnds_pipeline.compression import compress_file, copy_plain, open_text
+from dnds_pipeline.jobs import run_measured
+
+# Starting (omega, kappa) of the extra starts of a multi-start fit, and of the
+# retries of a fit whose starts all failed or timed out, spread around the
+# usual estimates for core genes.
+STARTS = [(0.1, 1.0), (1.5, 4.0), (0.02, 0.5), (4.0, 8.0), (0.8, 2.5)]
+
+
+def set_codeml_options(cml, model, nssites, clean, rubbish):
+    cml.set_options(noisy=rubbish) #Limited information on screen
+    cml.set_options(verbose=1) #Details of output file
+    cml.set_options(seqtype=1) #Analysis on codons
+    cml.set_options(ndata = 1) #Number of alignments
+    cml.set_options(icode = 0) #Universal genetic code
+    cml.set_options(cleandata=clean) #Remove positions with ambiguous data (might be bad if too many positions are)
+    cml.set_options(runmode=0) #Analysis will use tree topology
+    cml.set_options(model = model) #Compute an omega value for each branch
+    cml.set_options(NSsites = [int(site) for site in str(nssites).replace(",", " ").split()])#One omega for all sites
+    cml.set_options(CodonFreq=1) #Mutation-selection model with observed codon frequencies used as estimates. This model accounts for the mutational bias and selection affecting codon usage,
+    cml.set_options(clock=0) #Clock assumption is not used (unrooted phylogeny must be used)
+    cml.set_options(fix_omega=0)#Estimate omega (not used for seqtype 1)
+    cml.set_options(omega=0.5)#Starting omega value (not used for seqtype 1)
+
+
+def warm_start_values(codeml_output):
+    # Estimates of a finished codeml run that can seed a more complex model:
+    # kappa, omega (when a single omega was fitted) and the tree with its
+    # fitted branch lengths (the named tree printed after "tree length =").
+    parsed = parse_codeml(codeml_output)
+    values = dict()
+    if len(parsed["trees"]) > 1:
+        values["tree"] = parsed["trees"][1]
+    if parsed["kappa"] is not None:
+        values["kappa"] = float(parsed["kappa"])
+    if parsed["omega"] is not None:
+        values["omega"] = float(parsed["omega"])
+    return values
+
+
+def seeded_tree(tree, fitted_tree, output):
+    # Writes `tree` (a CODEML .nwk file, "#1"-style labels included) with the
+    # branch lengths of `fitted_tree`. Branches are matched by the split of
+    # taxa they define, so the rooting of the two trees does not matter.
+    # Returns False, writing nothing, if the two trees do not have the same taxa.
+    with open_text(tree) as handle:
+        header, newick = handle.read().split("\n", 1)
+    protected = re.sub(r"\s*#(\d+)", r"__mark\1__", newick.strip())
+    target = Phylo.read(StringIO(protected), "newick")
+    fitted = Phylo.read(StringIO(fitted_tree.replace(" ", "")), "newick")
+
+    def leaves(clade):
+        return frozenset(re.sub(r"__mark\d+__", "", str(tip.name)) for tip in clade.get_terminals())
+
+    all_taxa = leaves(fitted.root)
+    if leaves(target.root) != all_taxa:
+        return False
+    lengths = dict()
+    for clade in fitted.find_clades():
+        if clade.branch_length is not None and clade != fitted.root:
+            split = leaves(clade)
+            lengths[split] = clade.branch_length
+            lengths.setdefault(all_taxa - split, clade.branch_length)
+    for clade in target.find_clades():
+        if clade != target.root:
+            clade.branch_length = lengths.get(leaves(clade), clade.branch_length)
+
+    handle = StringIO()
+    Phylo.write(target, handle, "newick")
+    newick = re.sub(r"__mark(\d+)__", r" #\1", handle.getvalue()).replace("'", "")
+    with open(output, "w") as out:
+        out.write(header + "\n" + newick)
+    return True
+
+
+def start_values(number, seed):
+    # Starting (omega, kappa) of the number-th start of a fit (0 is the first):
+    # the warm start values, or codeml's defaults (None), for the first one,
+    # then the values in STARTS.
+    if number == 0:
+        if seed is None:
+            return None, None
+        return seed.get("omega"), seed.get("kappa")
+    return STARTS[(number - 1) % len(STARTS)]
+
+
+def run_start(folder, alignment, tree, out_name, model, nssites, clean, rubbish, seed, omega, kappa, timeout=None):
+    # One codeml run of a model in its own folder, from the given starting
+    # omega and kappa (None keeps codeml's defaults) and, with a seed, the
+    # fitted branch lengths of the previous model. A run still going after
+    # `timeout` seconds is killed. Returns (0 or the error message, usage as
+    # given by jobs.run_measured, output file, lnL).
+    os.makedirs(folder, exist_ok=True)
+    usage = dict()
+    try:
+        cml = codeml.Codeml()
+        cml.alignment = alignment
+        cml.tree = tree
+        cml.out_file = os.path.join(folder, out_name)
+        cml.working_dir = folder
+        set_codeml_options(cml, model, nssites, clean, rubbish)
+
+        if seed is not None:
+            warm_tree = os.path.join(folder, "warm_start.nwk")
+            if "tree" in seed and seeded_tree(tree, seed["tree"], warm_tree):
+                cml.tree = warm_tree
+                cml.set_options(fix_blength=1) #Branch lengths in the tree are starting values
+        if kappa is not None:
+            cml.set_options(kappa=kappa) #Starting kappa value
+        if omega is not None:
+            cml.set_options(omega=omega) #Starting omega value
+
+        cml.print_options()#Print the options on the screen
+
+        #codeml runs from its folder, which the control file's relative paths point from
+        cml.ctl_file = os.path.join(folder, "codeml.ctl")
+        cml.write_ctl_file()
+        exit_code, usage = run_measured("codeml codeml.ctl", cwd=folder, timeout=timeout)
+        if usage.get("timed_out"):
+            return "codeml timed out after " + str(round(timeout, 1)) + " seconds", usage, None, None
+        if exit_code != 0:
+            raise RuntimeError("codeml has failed (return code " + str(exit_code) + ")")
+        return 0, usage, cml.out_file, parse_codeml(cml.out_file)["lnL"]
+    except Exception as error:
+        traceback.print_exc()
+        return str(error) or type(error).__name__, usage, None, None
+
+
+def run_gene(core_gene, alignment, tree, hypotheses, clean, rubbish, tmp_dir=None, warm_start=True, compress=False, timeouts=None, retries=0, starts=1):
+    # Runs codeml for one core gene in its own scratch directory, so the rst,
+    # rub, 2NG.*, lnf and control files of genes running side by side never
+    # collide. Only the codeml output files are moved back next to the alignment.
+    #
+    # hypotheses is a list of (model, NSsites, output file, up to date) to fit
+    # one after the other, from the simplest to the most complex, while the
+    # gene's files are still hot. With warm_start, the branch lengths, kappa
+    # and omega of each model are the starting values of the next one. Models
+    # that are up to date are not run again, but their output still seeds the
+    # next model. With compress, the outputs are gzip-compressed (keeping their
+    # names) before they are moved back.
+    #
+    # Each model is fitted from `starts` starting values at the same time (see
+    # start_values), and the output with the best lnL is kept. timeouts gives
+    # the seconds each output's runs may take ({output file: seconds}, none if
+    # missing); runs still going then are killed. If every start of a model
+    # failed or timed out, the model is fitted again from the next starting
+    # values, up to `retries` times, each time with twice the time limit.
+    # Returns a list of (output file, 0 on success or the error message, the
+    # runs made for it), each run being its usage (as given by
+    # jobs.run_measured) with its attempt, start, starting omega and kappa,
+    # time limit, exit status and lnL, and whether its output was kept.
+    results = list()
+    scratch = tempfile.mkdtemp(prefix=core_gene + ".codeml.", dir=tmp_dir)
+    try:
+        #Local copies keep the paths in the control file short, which PAML requires
+        #codeml only reads plain text, so compressed inputs are decompressed on the way
+        local_alignment = os.path.join(scratch, os.path.basename(alignment))
+        local_tree = os.path.join(scratch, os.path.basename(tree))
+        copy_plain(alignment, local_alignment)
+        copy_plain(tree, local_tree)
+
+        seed = None
+        for model, nssites, codeml_output, up_to_date in hypotheses:
+            if up_to_date:
+                seed = warm_start_values(codeml_output) if warm_start else None
+                continue
+            print("Running codeml for core gene:", core_gene, "model =", model, "NSsites =", nssites)
+            out_name = os.path.basename(codeml_output)
+            timeout = None if timeouts is None else timeouts.get(codeml_output)
+            runs = list()
+            best = None
+            for attempt in range(retries + 1):
+                numbers = range(attempt * starts, (attempt + 1) * starts)
+                #A run that timed out may just have needed longer than predicted
+                limit = None if timeout is None else timeout * 2 ** attempt
+                #Every start runs in its own folder; they only wait on codeml, so threads are enough
+                with ThreadPoolExecutor(max_workers=starts) as pool:
+                    futures = [pool.submit(run_start, os.path.join(scratch, out_name + ".start" + str(number + 1)), local_alignment, local_tree, out_name,
+                        model, nssites, clean, rubbish, seed, *start_values(number, seed), limit) for number in numbers]
+                for number, future in zip(numbers, futures):
+                    status, usage, out_file, lnL = future.result()
+                    omega, kappa = start_values(number, seed)
+                    runs.append(dict(usage, attempt=attempt + 1, start=number + 1, start_omega=omega, start_kappa=kappa, timeout=limit, status=status, lnL=lnL, kept=False))
+                    if status == 0 and (best is None or (lnL is not None and (best[1] is None or lnL > best[1]))):
+                        best = (out_file, lnL, len(runs) - 1)
+                if best is not None:
+                    break
+                if attempt < retries:
+                    print("codeml failed or timed out for every start of core gene", core_gene, "model =", model, "NSsites =", str(nssites) + ", retrying from other starting values.")
+
+            try:
+                if best is None:
+                    raise RuntimeError(runs[-1]["status"])
+                out_file, lnL, kept = best
+                runs[kept]["kept"] = True
+                if starts > 1:
+                    print("Best lnL for core gene", core_gene, "model =", model, "NSsites =", nssites, "is", lnL, "from start", runs[kept]["start"])
+                if compress:
+                    compress_file(out_file)
+                shutil.move(out_file, codeml_output)
+                results.append((codeml_output, 0, runs))
+                seed = warm_start_values(codeml_output) if warm_start else None
+            except Exception as error:
+                if best is not None:
+                    traceback.print_exc()
+                results.append((codeml_output, str(error) or type(error).__name__, runs))
+                seed = None
+    except Exception as error:
+        traceback.print_exc()
+        done = set(result[0] for result in results)
+        for model, nssites, codeml_output, up_to_date in hypotheses:
+            if not up_to_date and codeml_output not in done:
+                results.append((codeml_output, str(error) or type(error).__name__, list()))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
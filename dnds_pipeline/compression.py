@@ -0,0 +1,58 @@
+import gzip
+import os
+import shutil
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def is_compressed(path):
+    # gzip and bgzip files alike, whatever their name.
+    with open(path, "rb") as handle:
+        return handle.read(2) == GZIP_MAGIC
+
+
+def is_bgzf(path):
+    # bgzip files are gzip files whose blocks carry a "BC" extra field, which
+    # allows random access (see Bio.bgzf).
+    with open(path, "rb") as handle:
+        header = handle.read(18)
+    return len(header) == 18 and header[:2] == GZIP_MAGIC and header[3] & 4 and header[12:14] == b"BC"
+
+
+def open_text(path, mode="r"):
+    # Opens a text file that may be gzip- or bgzip-compressed. Files are read
+    # compressed or not, going by their content rather than their name, and
+    # written compressed when their name ends in .gz.
+    if "r" in mode:
+        if is_compressed(path):
+            return gzip.open(path, "rt")
+        return open(path, mode)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode.replace("t", "") + "t")
+    return open(path, mode)
+
+
+def existing(path):
+    # The path, or the path with .gz appended if only that one exists.
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        return path + ".gz"
+    return path
+
+
+def copy_plain(source, destination):
+    # Copies a file, decompressing it if needed, for tools that only read plain text.
+    if is_compressed(source):
+        with gzip.open(source, "rb") as handle, open(destination, "wb") as out:
+            shutil.copyfileobj(handle, out)
+    else:
+        shutil.copyfile(source, destination)
+
+
+def compress_file(path, level=6):
+    # gzip-compresses a file in place, keeping its name, so every path the
+    # pipeline records stays valid. zcat and zless read it.
+    temporary = path + ".gz.tmp"
+    with open(path, "rb") as handle, open(temporary, "wb") as raw:
+        with gzip.GzipFile(os.path.basename(path), "wb", level, raw) as out:
+            shutil.copyfileobj(handle, out)
+    os.replace(temporary, path)
@@ -0,0 +1,30 @@
+import os
+from collections import defaultdict
+
+from dnds_pipeline.compression import open_text
+
+
+class CoreSet:
+    # The CoreCruncher core genome: for every core gene (one .faa file in the
+    # core folder), the names of its proteins, and the genome each protein
+    # comes from. CoreCruncher names records "<genome>.faa&<protein>".
+
+    def __init__(self, core_genome):
+        self.core_genome = core_genome
+        self.proteins = defaultdict(list)
+        self.protein2genome = dict()
+        for file in sorted(os.listdir(core_genome)):
+            if file.endswith(".faa"):
+                core_gene = file.replace(".faa", "")
+                # Only the record names are needed, so the headers are read
+                # without parsing the sequences.
+                with open_text(os.path.join(core_genome, file)) as handle:
+                    for line in handle:
+                        if line.startswith(">"):
+                            seq_name = line[1:].split()[0].split("&")
+                            protein_name = seq_name[1]
+                            self.proteins[core_gene].append(protein_name)
+                            self.protein2genome[protein_name] = seq_name[0].replace(".faa", "")
+
+    def genes(self):
+        return sorted(self.proteins.keys())
@@ -0,0 +1,99 @@
+import heapq
+import math
+
+import numpy as np
+
+# Rough codeml cost of each model relative to model = 0, NSsites = 0. The
+# branch models add omegas on top of the one-ratio model (model = 1 adds one
+# per branch), and the site models add site classes (M7 and M8 fit a beta
+# distribution over 10 classes). They only matter until the model is
+# calibrated with timings of this dataset.
+MODEL_FACTORS = {0: 1.0, 2: 1.5}
+NSSITES_FACTORS = {0: 1.0, 1: 2.0, 2: 3.0, 3: 4.0, 7: 8.0, 8: 10.0}
+# Seconds per branch and codon for model = 0, NSsites = 0.
+DEFAULT_SCALE = 2e-5
+# Timings needed to fit how the cost of a (model, NSsites) grows with size.
+MIN_FIT_SAMPLES = 5
+
+
+def complexity(model, nssites, branches):
+    model = int(model)
+    if model == 1:
+        factor = 1.0 + branches / 4.0
+    else:
+        factor = MODEL_FACTORS.get(model, 2.0)
+    sites = [int(site) for site in str(nssites).replace(",", " ").split()] or [0]
+    return factor * sum(NSSITES_FACTORS.get(site, 10.0) for site in sites)
+
+
+class CostModel:
+    # Predicts the seconds one codeml run takes from the size of its codon
+    # alignment (taxa and codons, read from the .pal2nal header) and its
+    # model and NSsites. Uncalibrated, the cost is proportional to
+    # branches x codons x complexity(model, NSsites). calibrate() fits it to
+    # the codeml timings recorded in the telemetry of previous runs: a common
+    # scale, and, for every (model, NSsites) with enough timings, its own
+    # power law of branches x codons. Runs killed by their time limit are
+    # lower bounds: the predictions of their model are raised to at least the
+    # time they ran.
+
+    def __init__(self):
+        self.scale = DEFAULT_SCALE
+        self.fits = dict()
+        self.samples = 0
+
+    def size(self, taxa, codons):
+        return max(1, 2 * int(taxa) - 3) * max(1, int(codons))
+
+    def predict(self, taxa, codons, model, nssites):
+        size = self.size(taxa, codons)
+        fit = self.fits.get((int(model), str(nssites)))
+        if fit is not None:
+            log_scale, exponent = fit
+            return math.exp(log_scale) * size ** exponent
+        return self.scale * size * complexity(model, nssites, max(1, 2 * int(taxa) - 3))
+
+    def calibrate(self, events):
+        # events are telemetry events; the codeml ones carry model, nssites,
+        # taxa and codons. Returns the number of timings used.
+        samples = dict()
+        for event in events:
+            if event.get("type") == "tool" and event.get("stage") == "run_codeml" and event.get("exit_code") == 0 and "model" in event and event.get("wall", 0) > 0:
+                samples.setdefault((int(event["model"]), str(event["nssites"])), list()).append((event["taxa"], event["codons"], event["wall"]))
+        ratios = list()
+        for (model, nssites), timings in samples.items():
+            sizes = np.array([self.size(taxa, codons) for taxa, codons, wall in timings], dtype=float)
+            walls = np.array([wall for taxa, codons, wall in timings], dtype=float)
+            branches = np.array([max(1, 2 * taxa - 3) for taxa, codons, wall in timings], dtype=float)
+            ratios.extend(walls / (sizes * np.array([complexity(model, nssites, n) for n in branches])))
+            if len(timings) >= MIN_FIT_SAMPLES and np.ptp(np.log(sizes)) > 0:
+                exponent, log_scale = np.polyfit(np.log(sizes), np.log(walls), 1)
+                self.fits[(model, nssites)] = (float(log_scale), float(exponent))
+            else:
+                self.fits[(model, nssites)] = (float(np.log(np.median(walls / sizes))), 1.0)
+        if len(ratios) > 0:
+            self.scale = float(np.median(ratios))
+
+        bounds = dict()
+        for event in events:
+            if event.get("type") == "tool" and event.get("stage") == "run_codeml" and event.get("timed_out") and "model" in event and event.get("wall", 0) > 0:
+                bounds.setdefault((int(event["model"]), str(event["nssites"])), list()).append((event["taxa"], event["codons"], event["wall"]))
+        for (model, nssites), timings in bounds.items():
+            if (model, nssites) not in self.fits:
+                self.fits[(model, nssites)] = (float(np.log(max(wall / self.size(taxa, codons) for taxa, codons, wall in timings))), 1.0)
+                continue
+            factor = max(wall / self.predict(taxa, codons, model, nssites) for taxa, codons, wall in timings)
+            if factor > 1:
+                log_scale, exponent = self.fits[(model, nssites)]
+                self.fits[(model, nssites)] = (log_scale + float(np.log(factor)), exponent)
+        self.samples = sum(len(timings) for timings in samples.values()) + sum(len(timings) for timings in bounds.values())
+        return self.samples
+
+
+def makespan(costs, workers):
+    # Wall time of running jobs of the given costs, in this order, on
+    # `workers` workers that each take the next job as soon as they are free.
+    finish = [0.0] * max(1, int(workers))
+    for cost in costs:
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
@@ -0,0 +1,75 @@
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_command(cmd, stdout_path, stderr_path):
+    # Run one external command with its own log files and return the exit code.
+    # A missing executable is reported as 127, like the shell does.
+    return run_measured(cmd, stdout_path, stderr_path)[0]
+
+
+def run_measured(cmd, stdout_path=None, stderr_path=None, cwd=None, timeout=None):
+    # Like run_command, but also returns what the command used, as
+    # {"wall": seconds, "cpu": user + system seconds, "max_rss_mb": peak RSS}.
+    # The process is reaped with wait4, so the usage is its own even when
+    # other commands run at the same time. Without a path, the output goes
+    # to the screen. With a timeout (seconds), a command still running then
+    # is killed, and its usage has "timed_out": True.
+    start = time.time()
+    out = open(stdout_path, "w") if stdout_path is not None else None
+    err = open(stderr_path, "w") if stderr_path is not None else None
+    try:
+        try:
+            process = subprocess.Popen(shlex.split(cmd), stdout=out, stderr=err, cwd=cwd)
+        except OSError as error:
+            (err or sys.stderr).write(str(error) + "\n")
+            return 127, {"wall": time.time() - start, "cpu": 0.0, "max_rss_mb": 0.0}
+        timer = None
+        killed = threading.Event()
+        if timeout is not None:
+            def kill():
+                killed.set()
+                process.kill()
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        for handle in (out, err):
+            if handle is not None:
+                handle.close()
+    #ru_maxrss is in kilobytes on Linux
+    measured = {"wall": time.time() - start, "cpu": usage.ru_utime + usage.ru_stime, "max_rss_mb": usage.ru_maxrss / 1024.0}
+    if killed.is_set():
+        measured["timed_out"] = True
+    return process.returncode, measured
+
+
+def run_pool(tasks, jobs):
+    # tasks is a list of (name, function, args). The functions run in a pool of
+    # `jobs` threads (they only wait on external programs) and the results come
+    # back in the same order as the tasks.
+    jobs = max(1, int(jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [(name, pool.submit(function, *args)) for name, function, args in tasks]
+        return [(name, future.result()) for name, future in futures]
+
+
+def print_status_table(results, label):
+    # results is a list of (name, exit code) pairs.
+    failed = [name for name, code in results if code != 0]
+    print(label + "\tStatus\tExit code")
+    for name, code in results:
+        status = "OK" if code == 0 else "FAILED"
+        print(name + "\t" + status + "\t" + str(code))
+    print("Finished:", len(results) - len(failed), "succeeded,", len(failed), "failed.")
+    return failed
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+
+LAYOUT_NAME = ".dnds_layout.json"
+LAYOUTS = ["flat", "genes"]
+
+
+class Layout:
+    # Where the per-gene files of a core folder live.
+    #
+    #   flat    every file in the core folder itself (the default)
+    #   genes   one folder per gene, <core>/genes/<bucket>/<gene>/, where the
+    #           bucket is the first two hex digits of the SHA-1 of the gene
+    #           name, so no folder ever holds more than a few hundred entries
+    #
+    # The CoreCruncher protein files (<gene>.faa) stay in the core folder in
+    # both layouts. Steps 2 and 3 save the layout and an index of the core
+    # genes (with the size of their .faa, which shards.py uses to balance
+    # shards) in .dnds_layout.json. Later stages read it and look up the files
+    # of each gene directly instead of listing the core folder.
+
+    def __init__(self, folder, name=None):
+        # name is "flat" or "genes"; None keeps the saved layout (flat if none
+        # was saved yet).
+        self.folder = folder
+        self.index = None
+        saved = None
+        path = os.path.join(folder, LAYOUT_NAME)
+        if os.path.exists(path):
+            with open(path) as handle:
+                saved = json.load(handle)
+            self.index = saved["genes"]
+        self.name = name or (saved["layout"] if saved is not None else "flat")
+        if name is not None and saved is not None and saved["layout"] != name:
+            # Outputs written in the other layout are not found any more.
+            self.index = None
+
+    def gene_dir(self, gene):
+        if self.name == "flat":
+            return self.folder
+        return os.path.join(self.folder, "genes", hashlib.sha1(gene.encode()).hexdigest()[:2], gene)
+
+    def path(self, gene, suffix):
+        # The path of a gene's file, e.g. path("fam1", ".pal2nal").
+        if suffix == ".faa":
+            return os.path.join(self.folder, gene + suffix)
+        return os.path.join(self.gene_dir(gene), gene + suffix)
+
+    def log_dir(self, gene):
+        if self.name == "flat":
+            return os.path.join(self.folder, "logs")
+        return self.gene_dir(gene)
+
+    def save(self, genes):
+        # Records the layout and the core genes, and makes the gene folders.
+        self.index = dict((gene, os.path.getsize(self.path(gene, ".faa")) if os.path.exists(self.path(gene, ".faa")) else 0) for gene in sorted(genes))
+        for gene in self.index:
+            os.makedirs(self.log_dir(gene), exist_ok=True)
+        # Shards save the same index at the same time: write it whole, then rename.
+        path = os.path.join(self.folder, LAYOUT_NAME)
+        temporary = path + "." + str(os.getpid())
+        with open(temporary, "w") as out:
+            json.dump({"layout": self.name, "genes": self.index}, out)
+        os.replace(temporary, path)
+
+    def files(self, extension):
+        # {gene: path} of the existing files ending in `extension`. Indexed
+        # genes in the per-gene layout are looked up one by one; a flat folder
+        # is listed once, so files copied into it are found too.
+        if self.name == "genes" and self.index is not None:
+            paths = dict((gene, self.path(gene, extension)) for gene in sorted(self.index))
+            return dict((gene, path) for gene, path in paths.items() if os.path.exists(path))
+        return dict((file[:-len(extension)], os.path.join(self.folder, file)) for file in sorted(os.listdir(self.folder)) if file.endswith(extension))
+
+
+def layout_root(path):
+    # The core folder a gene file belongs to, in either layout.
+    gene_dir = os.path.dirname(path)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(gene_dir)))
+    if os.path.basename(os.path.dirname(os.path.dirname(gene_dir))) == "genes" and os.path.exists(os.path.join(root, LAYOUT_NAME)):
+        return root
+    return gene_dir
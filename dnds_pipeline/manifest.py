@@ -0,0 +1,131 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from dnds_pipeline.shards import shard_suffix
+
+MANIFEST_NAME = ".dnds_manifest.jsonl"
+
+
+def tool_fingerprint(tool):
+    # Identify the installed version of an external tool without running it
+    # (codeml, for one, would go looking for a codeml.ctl): its resolved path,
+    # size and modification time change whenever the tool is reinstalled.
+    path = shutil.which(tool)
+    if path is None:
+        return tool + ":missing"
+    path = os.path.realpath(path)
+    info = os.stat(path)
+    return ":".join([tool, path, str(info.st_size), str(info.st_mtime_ns)])
+
+
+class Manifest:
+    # Records, for every stage and gene (or genome), a content hash of the
+    # inputs, parameters and tool versions that produced its outputs. A stage
+    # asks is_current() before redoing a gene and calls record() once the gene
+    # is done.
+    #
+    # The manifest is an append-only JSONL file, so a crash in the middle of a
+    # batch keeps everything recorded up to that point. File digests are cached
+    # by size and mtime, so unchanged inputs are not hashed again on reruns.
+    #
+    # A shard (see shards.py) appends to its own file,
+    # .dnds_manifest.shard-I-of-N.jsonl, but every manifest reads the records
+    # of all shards. The most recent record of a gene wins.
+
+    def __init__(self, folder, force=False, shard=None):
+        self.path = os.path.join(folder, MANIFEST_NAME.replace(".jsonl", shard_suffix(shard) + ".jsonl"))
+        self.force = force
+        self.records = dict()
+        self.digests = dict()
+        self.lock = threading.Lock()
+        lines = 0
+        for path in sorted(glob.glob(os.path.join(glob.escape(folder), MANIFEST_NAME.replace(".jsonl", "*.jsonl")))):
+            with open(path) as handle:
+                for line in handle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash.
+                        continue
+                    if path == self.path:
+                        lines += 1
+                    if entry["type"] == "digest":
+                        self.digests[entry["file"]] = entry
+                    else:
+                        key = (entry["stage"], entry["key"])
+                        if key not in self.records or entry.get("time", 0) >= self.records[key].get("time", 0):
+                            self.records[key] = entry
+        #Other shards may still be appending to their own files, so only the unsharded manifest is compacted
+        if shard is None and lines > 2 * (len(self.records) + len(self.digests)) + 100:
+            self._compact()
+
+    def _compact(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as handle:
+            for entry in list(self.digests.values()) + list(self.records.values()):
+                handle.write(json.dumps(entry) + "\n")
+        os.replace(temporary, self.path)
+
+    def _append(self, entry):
+        with open(self.path, "a") as handle:
+            handle.write(json.dumps(entry) + "\n")
+
+    def file_digest(self, path):
+        path = os.path.abspath(path)
+        info = os.stat(path)
+        with self.lock:
+            cached = self.digests.get(path)
+        if cached is not None and cached["size"] == info.st_size and cached["mtime"] == info.st_mtime_ns:
+            return cached["sha256"]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""):
+                sha.update(block)
+        entry = {"type": "digest", "file": path, "size": info.st_size, "mtime": info.st_mtime_ns, "sha256": sha.hexdigest()}
+        with self.lock:
+            self.digests[path] = entry
+            self._append(entry)
+        return entry["sha256"]
+
+    def signature(self, inputs, params=None, tools=()):
+        # Inputs are identified by file name and content, so moving a run
+        # folder around does not invalidate it. A missing input gives a
+        # signature that never matches.
+        sha = hashlib.sha256()
+        for path in inputs:
+            if not os.path.exists(path):
+                return None
+            sha.update(os.path.basename(path).encode() + b"\0" + self.file_digest(path).encode() + b"\n")
+        sha.update(json.dumps(params or dict(), sort_keys=True, default=str).encode())
+        for tool in tools:
+            sha.update(tool_fingerprint(tool).encode())
+        return sha.hexdigest()
+
+    def is_current(self, stage, key, signature, outputs=()):
+        if self.force or signature is None:
+            return False
+        with self.lock:
+            entry = self.records.get((stage, key))
+        if entry is None or entry["signature"] != signature:
+            return False
+        return all(os.path.exists(path) for path in outputs)
+
+    def get(self, stage, key):
+        with self.lock:
+            return self.records.get((stage, key))
+
+    def record(self, stage, key, signature, outputs=(), data=None):
+        if signature is None:
+            return
+        entry = {"type": "stage", "stage": stage, "key": key, "signature": signature, "outputs": list(outputs), "time": time.time()}
+        if data is not None:
+            entry["data"] = data
+        with self.lock:
+            self.records[(stage, key)] = entry
+            self._append(entry)
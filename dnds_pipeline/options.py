@@ -0,0 +1,40 @@
+import argparse
+
+
+def parse_hypothesis(text):
+    # MODEL:NSSITES:EXTENSION, e.g. 0:0:.null
+    fields = text.split(":")
+    if len(fields) != 3:
+        raise argparse.ArgumentTypeError("Hypotheses look like MODEL:NSSITES:EXTENSION, e.g. 0:0:.null, not " + text)
+    return (int(fields[0]), fields[1], fields[2])
+
+
+def parse_pair(text):
+    # NULL:ALTERNATIVE:DF, e.g. .null:.alt:1
+    fields = text.split(":")
+    if len(fields) != 3:
+        raise argparse.ArgumentTypeError("Hypothesis pairs look like NULL:ALTERNATIVE:DF, e.g. .null:.alt:1, not " + text)
+    return (fields[0], fields[1], int(fields[2]))
+
+
+def parse_shard(text):
+    # INDEX/COUNT, e.g. 2/8, with INDEX from 1 to COUNT
+    fields = text.split("/")
+    try:
+        index, count = int(fields[0]), int(fields[1])
+    except (ValueError, IndexError):
+        index, count = 0, 0
+    if len(fields) != 2 or count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("Shards look like INDEX/COUNT with INDEX from 1 to COUNT, e.g. 2/8, not " + text)
+    return (index, count)
+
+
+def quality_thresholds(args):
+    # The alignment quality thresholds given on the command line, as the qc
+    # dict run_codeml takes, or None if none was given.
+    names = ["max_gap_fraction", "max_ambiguous_fraction", "min_codons", "min_identity", "max_identity", "trim"]
+    values = dict((name, getattr(args, "trim_columns" if name == "trim" else name)) for name in names)
+    if all(value is None for value in values.values()):
+        return None
+    values["action"] = args.qc_action
+    return values
@@ -0,0 +1,51 @@
+from dnds_pipeline.compression import open_text
+
+
+def read_paml(path):
+    # Reads a sequential PAML alignment, as written by PAL2NAL with -output paml:
+    # a "<taxa> <sites>" header, then each name on its own line followed by its
+    # sequence, possibly over several lines. Returns a list of (name, sequence).
+    with open_text(path) as handle:
+        tokens = handle.read().split()
+    if len(tokens) < 2:
+        return []
+    n_taxa, n_sites = int(tokens[0]), int(tokens[1])
+    records = list()
+    position = 2
+    for taxon in range(n_taxa):
+        name = tokens[position]
+        position += 1
+        chunks = list()
+        length = 0
+        while length < n_sites:
+            chunks.append(tokens[position])
+            length += len(tokens[position])
+            position += 1
+        records.append((name, "".join(chunks)))
+    return records
+
+
+def alignment_size(path):
+    # (taxa, codons) from the header of a PAML alignment, without reading the sequences.
+    with open_text(path) as handle:
+        n_taxa, n_sites = handle.readline().split()[:2]
+    return int(n_taxa), int(n_sites) // 3
+
+
+def write_paml(records, path, width=60):
+    # Writes (name, sequence) pairs in the same layout as PAL2NAL's paml output.
+    n_sites = len(records[0][1]) if records else 0
+    with open(path, "w") as out:
+        out.write(" " + str(len(records)) + " " + str(n_sites) + "\n\n")
+        for name, sequence in records:
+            out.write(name + "\n")
+            for start in range(0, len(sequence), width):
+                out.write(sequence[start:start + width] + "\n")
+
+
+def write_fasta(records, path, width=60):
+    with open(path, "w") as out:
+        for name, sequence in records:
+            out.write(">" + name + "\n")
+            for start in range(0, len(sequence), width):
+                out.write(sequence[start:start + width] + "\n")
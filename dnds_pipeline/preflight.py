@@ -0,0 +1,165 @@
+import os
+import shutil
+import sys
+
+from dnds_pipeline.compression import open_text
+from dnds_pipeline.layout import Layout
+from dnds_pipeline.seqindex import GeneIndex
+from dnds_pipeline.shards import folder_shard
+
+# Order the checks are reported in.
+CHECKS = ["tools", "inputs", "ids", "cds", "lengths", "ingroup", "species_tree"]
+
+
+def required_tools(stages, codon_trees=False, species_tree=None):
+    # {tool: [stages that run it]}, with the tools named as the stages call them.
+    tools = dict()
+    if "predict_proteins" in stages:
+        tools.setdefault("prodigal", []).append("predict_proteins")
+    if "gene_trees" in stages and species_tree is None and not codon_trees:
+        tools.setdefault("mafft", []).append("gene_trees")
+        tools.setdefault("fasttree", []).append("gene_trees")
+    if "codon_alignment" in stages:
+        tools.setdefault("mafft", []).append("codon_alignment")
+        if codon_trees:
+            tools.setdefault("fasttree", []).append("codon_alignment")
+    if "run_codeml" in stages:
+        tools.setdefault("codeml", []).append("run_codeml")
+    return tools
+
+
+def record_lengths(path):
+    # [(record name, sequence length)] of a FASTA file, in file order.
+    records = list()
+    with open_text(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if line.startswith(">"):
+                records.append([line[1:].split()[0] if len(line) > 1 else "", 0])
+            elif len(records) > 0:
+                records[-1][1] += len(line)
+                if line.endswith("*"):
+                    # Prodigal ends its proteins with the stop codon.
+                    records[-1][1] -= 1
+    return [(name, length) for name, length in records]
+
+
+def check_length(core_gene, protein, length, cds_length, problems):
+    # A CDS is one codon per residue, plus the stop codon if it was kept.
+    if cds_length % 3 != 0 or cds_length // 3 not in (length, length + 1):
+        problems.append(("lengths", core_gene + ": " + protein + " has " + str(length) + " residues but its CDS has " + str(cds_length) + " bases"))
+
+
+def read_core_proteins(core_genome, problems):
+    # {core gene: [(genome, protein, protein length)]} from the CoreCruncher
+    # files, reading the records the way CoreSet does. Records whose name is
+    # not "<genome>.faa&<protein>" are reported and left out.
+    proteins = dict()
+    for file in sorted(os.listdir(core_genome)):
+        if not file.endswith(".faa"):
+            continue
+        core_gene = file.replace(".faa", "")
+        proteins[core_gene] = list()
+        for name, length in record_lengths(os.path.join(core_genome, file)):
+            seq_name = name.split("&")
+            if len(seq_name) != 2 or seq_name[0] == "" or seq_name[1] == "":
+                problems.append(("ids", core_gene + ": record " + repr(name) + " is not named <genome>.faa&<protein>"))
+                continue
+            proteins[core_gene].append((seq_name[0].replace(".faa", ""), seq_name[1], length))
+    return proteins
+
+
+def preflight(core_genome, genome_folder=None, ingroup_branch=None, stages=(), codon_trees=False, species_tree=None, shard=None, layout=None):
+    # Checks the inputs of the stages before any of them runs, and returns
+    # every problem found as (check, message) pairs. Only record names, .fai
+    # indexes and file sizes are read, so this takes seconds even for large
+    # core genomes. The CDS of a codon alignment run on its own are those
+    # step 2 wrote (<gene>.fna, in the given layout), for the genes of the
+    # shard only.
+    problems = list()
+    for tool, users in sorted(required_tools(stages, codon_trees, species_tree).items()):
+        if shutil.which(tool) is None:
+            problems.append(("tools", tool + " is not on PATH (needed by " + ", ".join(users) + ")"))
+
+    if "gene_trees" not in stages and "codon_alignment" not in stages:
+        return problems
+    if not os.path.isdir(core_genome):
+        problems.append(("inputs", "the core genome folder " + core_genome + " does not exist"))
+        return problems
+    proteins = read_core_proteins(core_genome, problems)
+    if len(proteins) == 0:
+        problems.append(("inputs", "no core gene (.faa) in " + core_genome))
+        return problems
+
+    # CoreSet maps every protein name to a single genome.
+    protein2genome = dict()
+    for core_gene, records in sorted(proteins.items()):
+        genomes = [genome for genome, protein, length in records]
+        for genome in sorted(set(genome for genome in genomes if genomes.count(genome) > 1)):
+            problems.append(("ids", core_gene + ": genome " + genome + " has " + str(genomes.count(genome)) + " proteins (codeml needs one sequence per genome)"))
+        for genome, protein, length in records:
+            if protein2genome.setdefault(protein, genome) != genome:
+                problems.append(("ids", core_gene + ": protein " + protein + " is named in both genomes " + protein2genome[protein] + " and " + genome))
+
+    if "gene_trees" in stages and "predict_proteins" not in stages:
+        if genome_folder is None or not os.path.isdir(genome_folder):
+            problems.append(("inputs", "the Prodigal output folder " + str(genome_folder) + " does not exist"))
+        else:
+            gene_index = GeneIndex(genome_folder)
+            for core_gene, records in sorted(proteins.items()):
+                for genome, protein, length in records:
+                    try:
+                        cds_length = gene_index.length(genome, protein)
+                    except (OSError, ValueError) as error:
+                        problems.append(("cds", core_gene + ": " + protein + " could not be read (" + str(error) + ")"))
+                        continue
+                    if cds_length is None:
+                        problems.append(("cds", core_gene + ": protein " + protein + " of " + genome + " has no CDS in " + genome_folder))
+                    else:
+                        check_length(core_gene, protein, length, cds_length, problems)
+
+    if "codon_alignment" in stages and "gene_trees" not in stages:
+        gene_files = Layout(core_genome, layout)
+        selected = folder_shard(core_genome, shard)
+        for core_gene, records in sorted(proteins.items()):
+            if selected is not None and core_gene not in selected:
+                continue
+            path = gene_files.path(core_gene, ".fna")
+            if not os.path.exists(path):
+                problems.append(("cds", core_gene + ": " + path + " does not exist (written by step 2)"))
+                continue
+            # Step 2 names each CDS after its genome.
+            cds_lengths = dict(record_lengths(path))
+            for genome, protein, length in records:
+                if genome not in cds_lengths:
+                    problems.append(("cds", core_gene + ": protein " + protein + " of " + genome + " has no CDS in " + path))
+                else:
+                    check_length(core_gene, protein, length, cds_lengths[genome], problems)
+
+    if ingroup_branch is not None:
+        for core_gene, records in sorted(proteins.items()):
+            if ingroup_branch not in [genome for genome, protein, length in records]:
+                problems.append(("ingroup", core_gene + ": the ingroup branch " + ingroup_branch + " is not one of its genomes"))
+
+    if species_tree is not None and "gene_trees" in stages:
+        from dnds_pipeline.trees import read_species_tree
+        try:
+            tips = set(str(tip.name) for tip in read_species_tree(species_tree).get_terminals())
+        except Exception as error:
+            problems.append(("species_tree", species_tree + " could not be read (" + str(error) + ")"))
+        else:
+            genomes = set(genome for records in proteins.values() for genome, protein, length in records)
+            for genome in sorted(genomes - tips):
+                problems.append(("species_tree", "genome " + genome + " is not a tip of " + species_tree))
+    return problems
+
+
+def report(problems, out=sys.stderr):
+    # Prints the problems grouped by check. Returns how many there are.
+    for check in CHECKS:
+        messages = [message for name, message in problems if name == check]
+        if len(messages) > 0:
+            print("Pre-flight check " + check + ": " + str(len(messages)) + " problem(s)", file=out)
+            for message in messages:
+                print("  " + message, file=out)
+    return len(problems)
@@ -0,0 +1,201 @@
+import glob
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from dnds_pipeline.codeml_parser import parse_files
+from dnds_pipeline.layout import Layout, layout_root
+from dnds_pipeline.shards import shard_suffix
+
+RESULTS_NAME = "dnds_results.sqlite"
+# parse_codeml fields kept in the results table; the lists are stored as JSON.
+FIELDS = ["lnL", "ntime", "np", "kappa", "omega", "omegas", "tree_length", "trees", "total_dN", "total_dS", "branch_header", "num_seq", "num_sites", "poly_positions"]
+JSON_FIELDS = ["omegas", "trees", "branch_header", "poly_positions"]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    gene TEXT NOT NULL, extension TEXT NOT NULL, file TEXT NOT NULL,
+    size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, updated REAL NOT NULL,
+    lnL REAL, ntime INTEGER, np INTEGER, kappa TEXT, omega TEXT, omegas TEXT,
+    tree_length TEXT, trees TEXT, total_dN TEXT, total_dS TEXT, branch_header TEXT,
+    num_seq TEXT, num_sites TEXT, poly_positions TEXT,
+    PRIMARY KEY (gene, extension)
+);
+CREATE INDEX IF NOT EXISTS results_extension ON results (extension);
+CREATE TABLE IF NOT EXISTS branches (
+    gene TEXT NOT NULL, extension TEXT NOT NULL, branch INTEGER NOT NULL, fields TEXT NOT NULL,
+    PRIMARY KEY (gene, extension, branch)
+);
+"""
+
+
+class ResultsStore:
+    # SQLite copy of the parsed codeml outputs of a folder, one row per gene
+    # and extension (plus one row per branch of its branch table), kept in
+    # dnds_results.sqlite next to the outputs. run_codeml upserts a gene as
+    # soon as its codeml run finishes, so other processes can query partial
+    # results of a running batch. Each row remembers the size and mtime of the
+    # file it was parsed from, so an output changed since is parsed again
+    # (see load_results).
+    #
+    # Like the manifest, a shard writes to its own file
+    # (dnds_results.shard-I-of-N.sqlite), and readers query all of them.
+    # With wal, the store uses SQLite's write-ahead log, so readers never wait
+    # for a writer; it only works when every process using the store runs on
+    # the same host, so it is not the default.
+
+    def __init__(self, folder, shard=None, wal=False):
+        self.path = os.path.join(folder, RESULTS_NAME.replace(".sqlite", shard_suffix(shard) + ".sqlite"))
+        self.connection = connect(self.path, wal)
+        self.connection.executescript(SCHEMA)
+
+    def upsert(self, gene, extension, path, parsed):
+        info = os.stat(path)
+        row = [gene, extension, os.path.abspath(path), info.st_size, info.st_mtime_ns, time.time()]
+        for field in FIELDS:
+            value = parsed[field]
+            if field in JSON_FIELDS and value is not None:
+                value = json.dumps(sorted(value) if field == "poly_positions" else value)
+            row.append(value)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO results (gene, extension, file, size, mtime_ns, updated, " + ", ".join(FIELDS) + ") VALUES (" + ", ".join(["?"] * len(row)) + ")", row)
+            self.connection.execute("DELETE FROM branches WHERE gene = ? AND extension = ?", (gene, extension))
+            self.connection.executemany("INSERT INTO branches (gene, extension, branch, fields) VALUES (?, ?, ?, ?)",
+                [(gene, extension, number, json.dumps(fields)) for number, fields in enumerate(parsed["branches"])])
+
+    def close(self):
+        self.connection.close()
+
+
+def connect(path, wal=False):
+    # Writers wait for each other instead of failing, and readers see the
+    # last committed genes while a batch is still writing. The default
+    # rollback journal works over network filesystems, the write-ahead log
+    # (wal) does not.
+    connection = sqlite3.connect(path, timeout=60)
+    if wal:
+        connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+def stored_results(folder, extension):
+    # {gene: parse_codeml-style dict} of every output with this extension in
+    # the stores of a folder. With several shard stores, the most recent row
+    # of a gene wins. Each dict also carries the size and mtime of its file.
+    rows = dict()
+    for path in sorted(glob.glob(os.path.join(glob.escape(folder), RESULTS_NAME.replace(".sqlite", "*.sqlite")))):
+        try:
+            connection = sqlite3.connect(path, timeout=60)
+            try:
+                connection.row_factory = sqlite3.Row
+                results = connection.execute("SELECT * FROM results WHERE extension = ?", (extension,)).fetchall()
+                branches = dict()
+                for row in connection.execute("SELECT gene, fields FROM branches WHERE extension = ? ORDER BY gene, branch", (extension,)):
+                    branches.setdefault(row["gene"], list()).append(json.loads(row["fields"]))
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            # Not a results store (yet): its genes are parsed again.
+            continue
+        for row in results:
+            if row["gene"] in rows and rows[row["gene"]]["updated"] >= row["updated"]:
+                continue
+            parsed = dict((field, row[field]) for field in FIELDS)
+            for field in JSON_FIELDS:
+                if parsed[field] is not None:
+                    parsed[field] = json.loads(parsed[field])
+            parsed["poly_positions"] = set(parsed["poly_positions"] or [])
+            parsed["trees"] = parsed["trees"] or []
+            parsed["branches"] = branches.get(row["gene"], [])
+            parsed.update({"file": row["file"], "size": row["size"], "mtime_ns": row["mtime_ns"], "updated": row["updated"]})
+            rows[row["gene"]] = parsed
+    return rows
+
+
+def load_results(paths, extension, jobs=1):
+    # The parsed codeml outputs (as parse_codeml returns them) of the paths, in
+    # the same order, looked up in the results stores of their core folders. Outputs
+    # missing from the stores, or changed since they were stored, are parsed
+    # (over `jobs` processes) and stored.
+    paths = list(paths)
+    results = [None] * len(paths)
+    missing = list()
+    stored = dict()
+    infos = dict()
+    for number, path in enumerate(paths):
+        folder = layout_root(path)
+        if folder not in stored:
+            stored[folder] = stored_results(folder, extension)
+        row = stored[folder].get(os.path.basename(path)[:-len(extension)])
+        info = os.stat(path)
+        if row is not None and row["size"] == info.st_size and row["mtime_ns"] == info.st_mtime_ns:
+            row["file"] = path
+            results[number] = row
+        else:
+            missing.append(number)
+            infos[number] = info
+
+    stores = dict()
+    try:
+        for number, parsed in zip(missing, parse_files([paths[number] for number in missing], jobs)):
+            parsed.update({"file": paths[number], "size": infos[number].st_size, "mtime_ns": infos[number].st_mtime_ns})
+            results[number] = parsed
+            folder = layout_root(paths[number])
+            if folder not in stores:
+                try:
+                    stores[folder] = ResultsStore(folder)
+                except sqlite3.Error:
+                    # A read-only folder: its results are simply not stored.
+                    stores[folder] = None
+            if stores[folder] is not None:
+                stores[folder].upsert(os.path.basename(paths[number])[:-len(extension)], extension, paths[number], parsed)
+    finally:
+        for store in stores.values():
+            if store is not None:
+                store.close()
+    return results
+
+
+def collect_results(folders, extension, jobs=1, verify=False):
+    # Every codeml output ending in `extension` across one or more core folders
+    # (e.g., one per shard), in either layout, as (path, parsed) pairs sorted
+    # by file name. A file name found in more than one folder is taken from
+    # the first. Step 4 stores each output as it writes it, so the outputs the
+    # results stores know are taken from them without even a stat. Only the
+    # other outputs, found by listing the folder (or through the gene index of
+    # the per-gene layout), are looked at, parsed and stored. With verify,
+    # every output is checked against the size and mtime it was stored with,
+    # and parsed again if it changed (see load_results).
+    if isinstance(folders, str):
+        folders = [folders]
+    paths = dict()
+    trusted = dict()
+    for folder in folders:
+        layout = Layout(folder)
+        stored = stored_results(folder, extension)
+        if layout.name == "genes" and layout.index is not None:
+            candidates = dict((gene, layout.path(gene, extension)) for gene in set(layout.index) | set(stored))
+            found = dict((gene, path) for gene, path in candidates.items() if (gene in stored and not verify) or os.path.exists(path))
+        else:
+            found = layout.files(extension)
+        for gene, path in sorted(found.items()):
+            file = os.path.basename(path)
+            if file in paths:
+                print("Found " + file + " in " + os.path.dirname(paths[file]) + " and " + folder + ", using the first one.", file=sys.stderr)
+                continue
+            paths[file] = path
+            if gene in stored and not verify:
+                stored[gene]["file"] = path
+                trusted[file] = stored[gene]
+    files = sorted(paths)
+    unknown = [paths[file] for file in files if file not in trusted]
+    parsed = dict(zip(unknown, load_results(unknown, extension, jobs)))
+    return [(paths[file], trusted[file] if file in trusted else parsed[paths[file]]) for file in files]
+
+
+def results_signature(results):
+    # What steps 5 and 6 compare with the manifest: the name, size and mtime
+    # each output was stored with, so an up-to-date check reads no file.
+    return [[os.path.basename(path), parsed["size"], parsed["mtime_ns"]] for path, parsed in results]
+
@@ -0,0 +1,146 @@
+import heapq
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from dnds_pipeline.jobs import run_measured
+from dnds_pipeline.telemetry import measure_call
+
+
+class Job:
+    # One step of a per-gene chain: either an external command (with its own
+    # stdout/stderr files) or a Python function. A job only starts once all of
+    # its deps finished with exit code 0, and it holds `threads` cores while it
+    # runs. With a telemetry, the job's usage is recorded as a tool event of
+    # its gene (key).
+
+    def __init__(self, name, cmd=None, stdout=None, stderr=None, function=None, args=(), threads=1, deps=(), telemetry=None, key=None):
+        self.name = name
+        self.cmd = cmd
+        self.stdout = stdout
+        self.stderr = stderr
+        self.function = function
+        self.args = args
+        self.threads = max(1, int(threads))
+        self.deps = list(deps)
+        self.telemetry = telemetry
+        self.key = key if key is not None else name
+
+    def run(self):
+        if self.cmd is not None:
+            print("Running: ", self.cmd)
+            exit_code, usage = run_measured(self.cmd, self.stdout, self.stderr)
+        else:
+            try:
+                exit_code, usage = measure_call(self.function, *self.args)
+            except Exception:
+                traceback.print_exc()
+                exit_code, usage = 1, dict()
+        if self.telemetry is not None:
+            self.telemetry.tool(self.key, self.name, exit_code, usage, self.cmd)
+        return exit_code
+
+
+def split_cores(n_chains, cores, max_threads=8):
+    # How many threads each multi-threaded step (MAFFT) gets. With more chains
+    # than cores, many single-threaded jobs keep every core busy; with only a
+    # few large genes left, fewer jobs with --thread N use the spare cores.
+    # MAFFT stops scaling well past a handful of threads, hence max_threads.
+    cores = max(1, int(cores))
+    if n_chains >= cores:
+        return 1
+    return max(1, min(max_threads, cores // max(1, n_chains)))
+
+
+def run_jobs(jobs, cores):
+    # Run a dependency graph of jobs without ever using more than `cores` cores.
+    # Ready jobs are started in list order, so listing each gene's chain
+    # together lets a gene's next step start as soon as its own previous step
+    # is done. Returns {job name: exit code}; jobs whose deps failed are
+    # skipped and reported with exit code None.
+    #
+    # Each job keeps a count of its unfinished deps, and a finished job only
+    # updates its own dependents, so scheduling stays linear in the number of
+    # jobs. Ready jobs wait in one heap (by list position) per thread count.
+    cores = max(1, int(cores))
+    results = dict()
+    position = dict((id(job), number) for number, job in enumerate(jobs))
+    waiting = [len(job.deps) for job in jobs]
+    dependents = [list() for job in jobs]
+    for number, job in enumerate(jobs):
+        for dep in job.deps:
+            if id(dep) in position:
+                dependents[position[id(dep)]].append(number)
+    ready = dict()
+
+    def queue(number):
+        heapq.heappush(ready.setdefault(min(jobs[number].threads, cores), list()), number)
+
+    def skip(number):
+        # A failed job skips everything downstream of it.
+        stack = list(dependents[number])
+        while stack:
+            dependent = stack.pop()
+            if jobs[dependent].name not in results:
+                results[jobs[dependent].name] = None
+                stack.extend(dependents[dependent])
+
+    for number in range(len(jobs)):
+        if waiting[number] == 0:
+            queue(number)
+    running = dict()
+    free = cores
+
+    with ThreadPoolExecutor(max_workers=cores) as pool:
+        while True:
+            while True:
+                heaps = [heap for threads, heap in ready.items() if threads <= free and heap]
+                if not heaps:
+                    break
+                number = heapq.heappop(min(heaps, key=lambda heap: heap[0]))
+                if jobs[number].name in results:
+                    continue
+                threads = min(jobs[number].threads, cores)
+                free -= threads
+                running[pool.submit(jobs[number].run)] = (number, threads)
+
+            if not running:
+                break
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                number, threads = running.pop(future)
+                free += threads
+                results[jobs[number].name] = future.result()
+                if results[jobs[number].name] != 0:
+                    skip(number)
+                    continue
+                for dependent in dependents[number]:
+                    waiting[dependent] -= 1
+                    if waiting[dependent] == 0 and jobs[dependent].name not in results:
+                        queue(dependent)
+
+    # Only jobs waiting on deps that will never run are left.
+    for job in jobs:
+        results.setdefault(job.name, None)
+    return results
+
+
+def chain_status(results, chain):
+    # Exit code of a gene's chain of jobs: the first one that failed, None if
+    # a job was skipped, 0 if they all succeeded.
+    for job in chain:
+        if results.get(job.name) != 0:
+            return results.get(job.name)
+    return 0
+
+
+def report_failures(results, label):
+    # Print the jobs that failed or were skipped and return their names.
+    failed = sorted(name for name, code in results.items() if code != 0)
+    if len(failed) > 0:
+        print(label + " failed or skipped:", file=sys.stderr)
+        for name in failed:
+            code = results[name]
+            print(name + "\t" + ("skipped" if code is None else "exit code " + str(code)), file=sys.stderr)
+    return failed
@@ -0,0 +1,175 @@
+import gzip
+import os
+
+from Bio import bgzf
+
+from dnds_pipeline.compression import existing, is_bgzf, is_compressed
+
+
+class FastaIndex:
+    # Random access to the records of one FASTA file through a samtools-style
+    # .fai index (name, length, offset, line bases, line width). The index is
+    # written next to the FASTA file and reused as long as it is newer than it.
+    # Compressed files are indexed in memory instead: bgzip files by the
+    # virtual offset of each record, while plain gzip files, which can not be
+    # read at random, are loaded whole.
+
+    def __init__(self, fasta):
+        self.fasta = fasta
+        self.fai = fasta + ".fai"
+        self.entries = dict()
+        self.sequences = None
+        self.bgzf = False
+        if is_compressed(self.fasta):
+            self._build_compressed()
+        elif os.path.exists(self.fai) and os.path.getmtime(self.fai) >= os.path.getmtime(self.fasta):
+            self._load()
+        else:
+            self._build()
+
+    def _load(self):
+        with open(self.fai) as fai:
+            for line in fai:
+                name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")[:5]
+                self.entries[name] = (int(length), int(offset), int(line_bases), int(line_width))
+
+    def _build(self):
+        # Same rules as samtools faidx: every line of a record but the last one
+        # must have the same length, otherwise offsets can not be computed.
+        entries = dict()
+        order = list()
+        name = None
+        with open(self.fasta, "rb") as handle:
+            position = 0
+            for line in handle:
+                if line.startswith(b">"):
+                    name = line[1:].split()[0].decode()
+                    if name in entries:
+                        raise ValueError("Duplicate sequence name " + name + " in " + self.fasta)
+                    entries[name] = [0, position + len(line), 0, 0, False]
+                    order.append(name)
+                elif name is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    entry = entries[name]
+                    if bases > 0 and (entry[4] or (entry[2] and bases > entry[2])):
+                        raise ValueError("Different line length in sequence " + name + " of " + self.fasta)
+                    if entry[2] == 0:
+                        entry[2] = bases
+                        entry[3] = len(line)
+                    elif bases < entry[2]:
+                        entry[4] = True
+                    entry[0] += bases
+                position += len(line)
+
+        # Shards index the same genomes at the same time: write the index whole,
+        # then rename it, so no shard ever loads a partly written one.
+        temporary = self.fai + "." + str(os.getpid())
+        with open(temporary, "w") as fai:
+            for name in order:
+                length, offset, line_bases, line_width = entries[name][:4]
+                self.entries[name] = (length, offset, line_bases, line_width)
+                fai.write("\t".join([name, str(length), str(offset), str(line_bases), str(line_width)]) + "\n")
+        os.replace(temporary, self.fai)
+
+    def _build_compressed(self):
+        if is_bgzf(self.fasta):
+            self.bgzf = True
+            with bgzf.BgzfReader(self.fasta, "rb") as handle:
+                for line in iter(handle.readline, b""):
+                    if line.startswith(b">"):
+                        name = line[1:].split()[0].decode()
+                        if name in self.entries:
+                            raise ValueError("Duplicate sequence name " + name + " in " + self.fasta)
+                        self.entries[name] = handle.tell()
+            return
+        self.sequences = dict()
+        name = None
+        with gzip.open(self.fasta, "rt") as handle:
+            for line in handle:
+                if line.startswith(">"):
+                    name = line[1:].split()[0]
+                    if name in self.sequences:
+                        raise ValueError("Duplicate sequence name " + name + " in " + self.fasta)
+                    self.sequences[name] = list()
+                elif name is not None:
+                    self.sequences[name].append(line.strip())
+        for name in self.sequences:
+            self.sequences[name] = "".join(self.sequences[name])
+            self.entries[name] = None
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def length(self, name):
+        if self.sequences is not None:
+            return len(self.sequences[name])
+        if self.bgzf:
+            return len(self.fetch(name))
+        return self.entries[name][0]
+
+    def fetch(self, name):
+        if self.sequences is not None:
+            return self.sequences[name]
+        if self.bgzf:
+            lines = list()
+            with bgzf.BgzfReader(self.fasta, "rb") as handle:
+                handle.seek(self.entries[name])
+                for line in iter(handle.readline, b""):
+                    if line.startswith(b">"):
+                        break
+                    lines.append(line.strip())
+            return b"".join(lines).decode()
+        length, offset, line_bases, line_width = self.entries[name]
+        if line_bases == 0:
+            return ""
+        full_lines, rest = divmod(length, line_bases)
+        with open(self.fasta, "rb") as handle:
+            handle.seek(offset)
+            block = handle.read(full_lines * line_width + rest)
+        return block.decode().replace("\n", "").replace("\r", "")
+
+
+class GeneIndex:
+    # Looks up Prodigal gene sequences (.genes.fna, or .genes.fna.gz) by genome
+    # and gene name, opening the index of a genome only when one of its genes
+    # is requested.
+
+    def __init__(self, genome_folder, extension=".genes.fna"):
+        self.genome_folder = genome_folder
+        self.extension = extension
+        self.indexes = dict()
+        self.name2genome = None
+
+    def _index(self, genome):
+        if genome not in self.indexes:
+            self.indexes[genome] = FastaIndex(existing(os.path.join(self.genome_folder, genome + self.extension)))
+        return self.indexes[genome]
+
+    def _find(self, name):
+        # Only used when a gene is not in the file named after its genome.
+        if self.name2genome is None:
+            self.name2genome = dict()
+            for file in sorted(os.listdir(self.genome_folder)):
+                if file.endswith(self.extension) or file.endswith(self.extension + ".gz"):
+                    genome = file[:file.rindex(self.extension)]
+                    for seq_name in self._index(genome).entries:
+                        self.name2genome.setdefault(seq_name, genome)
+        return self.name2genome[name]
+
+    def length(self, genome, name):
+        # Length of a gene's sequence, or None if it is in no genes file.
+        if os.path.exists(existing(os.path.join(self.genome_folder, genome + self.extension))):
+            index = self._index(genome)
+            if name in index:
+                return index.length(name)
+        try:
+            return self._index(self._find(name)).length(name)
+        except KeyError:
+            return None
+
+    def fetch(self, genome, name):
+        if os.path.exists(existing(os.path.join(self.genome_folder, genome + self.extension))):
+            index = self._index(genome)
+            if name in index:
+                return index.fetch(name)
+        return self._index(self._find(name)).fetch(name)
@@ -0,0 +1,56 @@
+import os
+
+from dnds_pipeline.layout import Layout
+
+
+def shard_suffix(shard):
+    # File name suffix for the manifest and telemetry of one shard, so shards
+    # running at the same time on different nodes never append to the same file.
+    if shard is None:
+        return ""
+    return ".shard-" + str(shard[0]) + "-of-" + str(shard[1])
+
+
+def file_costs(paths):
+    # Estimated cost of each gene from the size of its main input file
+    # ({gene: path}), which grows with the number of taxa times the alignment
+    # length. Missing files cost nothing.
+    return dict((gene, os.path.getsize(path) if os.path.exists(path) else 0) for gene, path in paths.items())
+
+
+def shard_genes(genes, costs, shard):
+    # The genes of shard (index, count), index from 1 to count. Genes are dealt
+    # out from the most to the least costly, each to the shard with the least
+    # total cost so far (ties go to the lowest shard, then by gene name), so
+    # every shard gets about the same amount of work. The split only depends
+    # on the gene names and costs, so every array task computes the same one.
+    # Without a shard, all genes are returned. Genes come back sorted by name.
+    if shard is None:
+        return sorted(genes)
+    index, count = shard
+    loads = [0] * count
+    members = [list() for _ in range(count)]
+    for gene in sorted(genes, key=lambda gene: (-costs.get(gene, 0), gene)):
+        target = min(range(count), key=lambda k: (loads[k], k))
+        loads[target] += costs.get(gene, 0)
+        members[target].append(gene)
+    return sorted(members[index - 1])
+
+
+def folder_shard(folder, shard, extension=".faa"):
+    # The core genes of shard (index, count) in a core folder, or None for
+    # all of them. The split is made over the CoreCruncher protein files
+    # (.faa), weighed by their size, so steps 2, 3 and 4 give every shard the
+    # same genes, whichever outputs of the other shards exist yet. The sizes
+    # come from the gene index of the layout when there is one. Without .faa
+    # files, the split is made over the files ending in `extension`.
+    if shard is None:
+        return None
+    layout = Layout(folder)
+    if layout.index is not None:
+        return set(shard_genes(layout.index.keys(), layout.index, shard))
+    for ending in (".faa", extension):
+        paths = dict((file[:-len(ending)], os.path.join(folder, file)) for file in os.listdir(folder) if file.endswith(ending))
+        if len(paths) > 0:
+            return set(shard_genes(paths.keys(), file_costs(paths), shard))
+    return set()
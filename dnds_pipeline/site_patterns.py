@@ -0,0 +1,81 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from dnds_pipeline.paml_io import read_paml
+
+GAP = ord("-")
+# Columns added to summary_tab.tsv, in this order.
+COLUMNS = ["polymorphic_codons", "polymorphic_nucleotides", "gap_fraction", "codon_diversity"]
+
+
+def load_codons(path):
+    # The codon alignment in a .pal2nal file as a (taxa, codons, 3) array of
+    # upper-case bytes.
+    records = read_paml(path)
+    if len(records) == 0:
+        return np.zeros((0, 0, 3), dtype=np.uint8)
+    sequences = np.frombuffer("".join(sequence.upper() for name, sequence in records).encode(), dtype=np.uint8)
+    return sequences.reshape(len(records), -1)[:, :3 * (len(records[0][1]) // 3)].reshape(len(records), -1, 3)
+
+
+def pattern_positions(codons):
+    # Number of variable nucleotide positions among the distinct codon site
+    # patterns, the count codeml's "site pattern counts" printout gives:
+    # identical columns count once, and a position is variable if any taxon
+    # differs from the first.
+    if codons.shape[0] < 2 or codons.shape[1] == 0:
+        return 0
+    patterns = np.unique(codons.transpose(1, 0, 2).reshape(codons.shape[1], -1), axis=0).reshape(-1, codons.shape[0], 3)
+    return int((patterns[:, 1:] != patterns[:, :1]).any(axis=1).sum())
+
+
+def site_statistics(path):
+    # Site statistics of one codon alignment:
+    #   num_polymorphic_sites     as codeml counts them (see pattern_positions)
+    #   polymorphic_codons        codon columns where the taxa do not all have the same codon
+    #   polymorphic_nucleotides   nucleotide columns where the taxa do not all have the same base
+    #   gap_fraction              fraction of codons that are gaps
+    #   codon_diversity           mean over codon columns of the chance that two
+    #                             taxa drawn without replacement carry different
+    #                             codons, gaps left out
+    codons = load_codons(path)
+    n_taxa, n_codons = codons.shape[:2]
+    statistics = {"num_polymorphic_sites": pattern_positions(codons)}
+    if n_taxa == 0 or n_codons == 0:
+        statistics.update(dict((column, 0) for column in COLUMNS))
+        return statistics
+
+    nucleotides = codons.reshape(n_taxa, -1)
+    statistics["polymorphic_nucleotides"] = int((nucleotides != nucleotides[:1]).any(axis=0).sum())
+    statistics["polymorphic_codons"] = int((codons != codons[:1]).any(axis=2).any(axis=0).sum())
+
+    gaps = (codons == GAP).any(axis=2)
+    statistics["gap_fraction"] = float(gaps.mean())
+
+    # Codons as integers, gaps as -1. Sorting each column puts equal codons in
+    # runs; the rank of a codon within its run is the number of earlier taxa
+    # with the same codon, so the ranks add up to the pairs of equal codons.
+    values = (codons.astype(np.int64) << np.array([16, 8, 0])).sum(axis=2)
+    ordered = np.sort(np.where(gaps, -1, values), axis=0)
+    rows = np.arange(n_taxa)[:, None]
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[1:] = ordered[1:] != ordered[:-1]
+    ranks = rows - np.maximum.accumulate(np.where(starts, rows, 0), axis=0)
+    present = ordered != -1
+    equal_pairs = (ranks * present).sum(axis=0)
+    observed = present.sum(axis=0)
+    pairs = observed * (observed - 1) / 2.0
+    diversity = np.where(pairs > 0, 1.0 - equal_pairs / np.maximum(pairs, 1), 0.0)
+    statistics["codon_diversity"] = float(diversity.mean())
+    return statistics
+
+
+def bulk_statistics(paths, jobs=1):
+    # site_statistics of many alignments, spread over a pool of `jobs`
+    # processes. Results come back in the same order as the paths.
+    paths = list(paths)
+    if jobs <= 1 or len(paths) < 2:
+        return [site_statistics(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(site_statistics, paths, chunksize=max(1, len(paths) // (jobs * 8))))
@@ -0,0 +1,164 @@
+import glob
+import json
+import os
+import resource
+import threading
+import time
+
+from dnds_pipeline.shards import shard_suffix
+
+TELEMETRY_NAME = ".dnds_telemetry.jsonl"
+
+
+def process_usage():
+    # CPU seconds used so far by this process and the children it waited
+    # for, and this process's peak RSS in MB.
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime, own.ru_maxrss / 1024.0
+
+
+class Telemetry:
+    # Appends structured events for one run of one stage to the JSONL file
+    # .dnds_telemetry.jsonl in the stage's folder (next to the manifest):
+    #
+    #   "tool"   one per external tool run or in-process step, for a gene (or
+    #            genome): name, exit code, wall and CPU seconds, peak RSS
+    #   "gene"   one per gene (or genome) the stage worked on: the totals of
+    #            its tools, its exit code (None if skipped), input sizes
+    #            (taxa, codons or bytes) and output paths
+    #   "stage"  one at the end of the stage: wall and CPU seconds, peak RSS
+    #
+    # Every event carries the stage, a run id and a timestamp. Shards write to
+    # their own .dnds_telemetry.shard-I-of-N.jsonl file.
+    # `dnds-pipeline telemetry <folder>` summarizes the files.
+
+    def __init__(self, folder, stage, shard=None):
+        self.path = os.path.join(folder, TELEMETRY_NAME.replace(".jsonl", shard_suffix(shard) + ".jsonl"))
+        self.stage = stage
+        self.run = time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid()) + shard_suffix(shard)
+        self.start = time.time()
+        self.start_cpu = process_usage()[0]
+        self.totals = dict()
+        self.lock = threading.Lock()
+
+    def _append(self, entry):
+        entry.update({"stage": self.stage, "run": self.run, "time": round(time.time(), 3)})
+        with self.lock:
+            with open(self.path, "a") as handle:
+                handle.write(json.dumps(entry) + "\n")
+
+    def tool(self, key, name, exit_code, usage, cmd=None, **fields):
+        entry = {"type": "tool", "key": key, "name": name, "exit_code": exit_code}
+        entry.update(usage)
+        if cmd is not None:
+            entry["cmd"] = cmd
+        entry.update(fields)
+        with self.lock:
+            total = self.totals.setdefault(key, {"wall": 0.0, "cpu": 0.0, "max_rss_mb": 0.0, "tools": 0})
+            total["wall"] += usage.get("wall", 0.0)
+            total["cpu"] += usage.get("cpu", 0.0)
+            total["max_rss_mb"] = max(total["max_rss_mb"], usage.get("max_rss_mb", 0.0))
+            total["tools"] += 1
+        self._append(entry)
+
+    def gene(self, key, exit_code, inputs=None, outputs=()):
+        with self.lock:
+            total = self.totals.pop(key, {"wall": 0.0, "cpu": 0.0, "max_rss_mb": 0.0, "tools": 0})
+        entry = {"type": "gene", "key": key, "exit_code": exit_code, "inputs": inputs or dict(), "outputs": list(outputs)}
+        entry.update(total)
+        self._append(entry)
+
+    def finish(self, **fields):
+        cpu, max_rss_mb = process_usage()
+        entry = {"type": "stage", "wall": time.time() - self.start, "cpu": cpu - self.start_cpu, "max_rss_mb": max_rss_mb}
+        entry.update(fields)
+        self._append(entry)
+
+
+def measure_call(function, *args):
+    # Runs an in-process step and returns (exit code, usage) in the same form
+    # as jobs.run_measured. CPU time is the calling thread's; the peak RSS is
+    # the whole process's, since threads share it.
+    start = time.time()
+    start_cpu = time.thread_time()
+    result = function(*args)
+    exit_code = 0 if result is None else result
+    return exit_code, {"wall": time.time() - start, "cpu": time.thread_time() - start_cpu, "max_rss_mb": process_usage()[1]}
+
+
+def telemetry_files(path):
+    # A telemetry file, or the telemetry files of a folder (one per shard).
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(glob.escape(path), TELEMETRY_NAME.replace(".jsonl", "*.jsonl"))))
+    return [path] if os.path.exists(path) else []
+
+
+def read_events(path):
+    # All events of a telemetry file, or of the telemetry files in a folder,
+    # in time order.
+    events = list()
+    for telemetry_file in telemetry_files(path):
+        with open(telemetry_file) as handle:
+            for line in handle:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a crash.
+                    continue
+    events.sort(key=lambda event: event.get("time", 0))
+    return events
+
+
+def summarize(path, top=10):
+    # Prints a per-stage time breakdown, the slowest genes, the genes that
+    # used the most memory and the failures. For each stage and gene, only
+    # the most recent record counts, so reruns do not count twice.
+    events = read_events(path)
+    genes = dict()
+    stages = dict()
+    tools = dict()
+    watchdog = list()
+    for event in events:
+        if event["type"] == "gene":
+            genes[(event["stage"], event["key"])] = event
+        elif event["type"] == "stage":
+            stages.setdefault(event["stage"], list()).append(event)
+        elif event["type"] == "tool" and event["exit_code"] != 0:
+            tools[(event["stage"], event["key"])] = event
+        if event["type"] == "tool" and (event.get("timed_out") or event.get("attempt", 1) > 1):
+            watchdog.append(event)
+
+    order = list(dict.fromkeys([event["stage"] for event in events]))
+    print("Stage\tRuns\tGenes\tFailed\tGene wall (s)\tGene CPU (s)\tLast run wall (s)\tTotal wall (s)")
+    for stage in order:
+        stage_genes = [gene for (name, key), gene in genes.items() if name == stage]
+        runs = stages.get(stage, list())
+        failed = [gene for gene in stage_genes if gene["exit_code"] != 0]
+        print("\t".join([stage, str(len(runs)), str(len(stage_genes)), str(len(failed)),
+            str(round(sum(gene["wall"] for gene in stage_genes), 2)), str(round(sum(gene["cpu"] for gene in stage_genes), 2)),
+            str(round(runs[-1]["wall"], 2)) if runs else "NA", str(round(sum(run["wall"] for run in runs), 2))]))
+
+    def gene_table(title, rows):
+        print("\n" + title)
+        print("Stage\tGene\tWall (s)\tCPU (s)\tPeak RSS (MB)\tTaxa\tCodons\tExit code")
+        for gene in rows:
+            print("\t".join([gene["stage"], gene["key"], str(round(gene["wall"], 2)), str(round(gene["cpu"], 2)), str(round(gene["max_rss_mb"], 1)),
+                str(gene["inputs"].get("taxa", "NA")), str(gene["inputs"].get("codons", "NA")), str(gene["exit_code"])]))
+
+    gene_table("Slowest genes", sorted(genes.values(), key=lambda gene: gene["wall"], reverse=True)[:top])
+    gene_table("Largest peak memory", sorted(genes.values(), key=lambda gene: gene["max_rss_mb"], reverse=True)[:top])
+
+    failures = [gene for gene in genes.values() if gene["exit_code"] != 0]
+    print("\nFailures:", len(failures))
+    for gene in failures:
+        tool = tools.get((gene["stage"], gene["key"]))
+        status = "skipped" if gene["exit_code"] is None else "exit code " + str(gene["exit_code"])
+        print("\t".join([gene["stage"], gene["key"], status, ("failed step: " + tool["name"]) if tool is not None else ""]).rstrip("\t"))
+
+    if len(watchdog) > 0:
+        print("\nTimeouts and retries:", sum(1 for event in watchdog if event.get("timed_out")), "timed out,", sum(1 for event in watchdog if event.get("attempt", 1) > 1), "retried")
+        print("Stage\tGene\tStep\tAttempt\tStart\tTime limit (s)\tWall (s)\tStatus")
+        for event in watchdog:
+            print("\t".join([event["stage"], event["key"], event["name"], str(event.get("attempt", 1)), str(event.get("start", 1)),
+                str(round(event["timeout"], 1)) if event.get("timeout") is not None else "NA", str(round(event.get("wall", 0.0), 2)), "timed out" if event.get("timed_out") else str(event["exit_code"])]))
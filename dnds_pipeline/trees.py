@@ -0,0 +1,113 @@
+import os
+import sys
+
+from Bio import Phylo
+
+from dnds_pipeline.compression import open_text
+from dnds_pipeline.jobs import run_measured
+
+
+def gene_tree(input_aln, gene_prefix, ingroup_branch, log_dir, telemetry=None):
+    # Builds a FastTree tree from a nucleotide alignment (FASTA) and writes it
+    # as <gene_prefix>.fasttree, then as a CODEML tree (<gene_prefix>.nwk) with
+    # the ingroup branch labelled "#1". Returns the FastTree exit code. The
+    # FastTree run is recorded in `telemetry`, if given.
+    family_name = os.path.basename(gene_prefix)
+    output_tree = gene_prefix + ".fasttree"
+
+    cmd = "fasttree -nt " + input_aln
+    print("Running your tree with FastTree --> ", cmd)
+    exit_code, usage = run_measured(cmd, output_tree, os.path.join(log_dir, family_name + ".fasttree.log"))
+    if telemetry is not None:
+        telemetry.tool(family_name, family_name + " fasttree", exit_code, usage, cmd)
+    if exit_code != 0:
+        return exit_code
+
+    print("Modifying your tree to have it ready for CODEML...")
+
+    treefile = Phylo.read(output_tree, "newick")
+    output_tree_mod = gene_prefix + ".temporary"
+    output_tree_nwk = open(gene_prefix + ".nwk", "w")
+
+    total_tips = 0
+    for tip in treefile.get_terminals():
+        total_tips = total_tips + 1
+        if str(tip.name) == ingroup_branch:
+            tip.name = ingroup_branch + " #1"
+
+    Phylo.write(treefile, output_tree_mod, "newick")
+
+    output_tree_nwk.write(str(total_tips) + "  1\n")
+    with open(output_tree_mod) as temporary:
+        for line in temporary:
+            line = line.rstrip()
+            line = line.replace("'", "")
+            output_tree_nwk.write(line + "\n")
+    output_tree_nwk.close()
+
+    os.remove(output_tree_mod)
+    print("Your output tree for CODEML is", family_name + ".nwk")
+    return 0
+
+
+def read_species_tree(path):
+    # Reads the reference (species) tree once, for species_gene_tree.
+    with open_text(path) as handle:
+        tree = Phylo.read(handle, "newick")
+    tips = [str(tip.name) for tip in tree.get_terminals()]
+    if len(set(tips)) != len(tips):
+        raise ValueError("the species tree " + path + " has duplicated tip names")
+    return tree
+
+
+def prune(clade, taxa):
+    # `clade` restricted to the tips in `taxa`, as [name, branch length,
+    # children]. Nodes left with a single child are removed, their branch
+    # length added to the child's. None if no tip of the clade is kept.
+    length = clade.branch_length or 0.0
+    if clade.is_terminal():
+        return [str(clade.name), length, []] if str(clade.name) in taxa else None
+    children = [node for node in (prune(child, taxa) for child in clade.clades) if node is not None]
+    if len(children) == 0:
+        return None
+    if len(children) == 1:
+        children[0][1] += length
+        return children[0]
+    return [None, length, children]
+
+
+def to_newick(node, ingroup_branch, lengths):
+    name, length, children = node
+    if len(children) == 0:
+        return name + " #1" if name == ingroup_branch else name
+    return "(" + ",".join(to_newick(child, ingroup_branch, lengths) + (":%1.5f" % child[1] if lengths else "") for child in children) + ")"
+
+
+def species_gene_tree(species_tree, taxa, gene_prefix, ingroup_branch):
+    # Writes the CODEML tree of one gene (<gene_prefix>.nwk) straight from the
+    # species tree: pruned to the gene's taxa, with the ingroup branch labelled
+    # "#1". Branch lengths are kept if the species tree has them. A root left
+    # with two branches is removed, as CODEML expects an unrooted tree when no
+    # clock is used. Returns 0, or 1 if a taxon of the gene is not in the
+    # species tree.
+    family_name = os.path.basename(gene_prefix)
+    taxa = set(taxa)
+    missing = taxa - set(str(tip.name) for tip in species_tree.get_terminals())
+    if len(missing) > 0:
+        print("Core gene " + family_name + " has taxa that are not in the species tree: " + ", ".join(sorted(missing)), file=sys.stderr)
+        return 1
+    if ingroup_branch not in taxa:
+        print("The ingroup branch " + ingroup_branch + " is not in core gene " + family_name + ", no branch is labelled #1.", file=sys.stderr)
+
+    root = prune(species_tree.root, taxa)
+    children = root[2]
+    if len(children) == 2 and len(children[0][2]) + len(children[1][2]) > 0:
+        inner, other = children if len(children[0][2]) > 0 else children[::-1]
+        other[1] += inner[1]
+        root[2] = inner[2] + [other]
+
+    lengths = any(clade.branch_length for clade in species_tree.find_clades())
+    with open(gene_prefix + ".nwk", "w") as output_tree_nwk:
+        output_tree_nwk.write(str(len(taxa)) + "  1\n")
+        output_tree_nwk.write(to_newick(root, ingroup_branch, lengths) + ";\n")
+    return 0